@@ -0,0 +1,537 @@
+import json
+import time
+import random
+import logging
+import threading
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from eth_abi import decode, encode
+from eth_utils import (
+    decode_hex,
+    encode_hex,
+    function_signature_to_4byte_selector,
+    keccak,
+)
+from web3 import Web3
+from synthetix.utils.multicall import multicall_erc7412, write_erc7412
+
+CHAIN_ID = 8453
+MULTICALL_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+ACCOUNT_PROXY_ADDRESS = "0x0000000000000000000000000000000000001001"
+MARKET_PROXY_ADDRESS = "0x0000000000000000000000000000000000001002"
+KEEPER_ADDRESS = "0x0000000000000000000000000000000000002001"
+
+BASE_FEE = 10**7
+PRIORITY_FEE = 10**6
+
+# gas charged for each call in a simulated transaction
+CALL_GAS = 50000
+LIQUIDATE_GAS = 400000
+TX_GAS = 21000
+
+# every active account holds one position in this market
+MARKET_ID = 100
+MARKET_PRICE = 2000 * 10**18
+
+# the error returned when an error is injected, recognised as an oversize error
+INJECTED_ERROR = {"code": -32000, "message": "response size exceeded"}
+
+CALL_ABI = {
+    "components": [
+        {"name": "target", "type": "address"},
+        {"name": "allowFailure", "type": "bool"},
+        {"name": "value", "type": "uint256"},
+        {"name": "callData", "type": "bytes"},
+    ],
+    "name": "calls",
+    "type": "tuple[]",
+}
+RESULT_ABI = {
+    "components": [
+        {"name": "success", "type": "bool"},
+        {"name": "returnData", "type": "bytes"},
+    ],
+    "name": "returnData",
+    "type": "tuple[]",
+}
+MULTICALL_ABI = [
+    {
+        "inputs": [CALL_ABI],
+        "name": "aggregate3Value",
+        "outputs": [RESULT_ABI],
+        "stateMutability": "payable",
+        "type": "function",
+    }
+]
+ACCOUNT_PROXY_ABI = [
+    {
+        "inputs": [],
+        "name": "totalSupply",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "stateMutability": "view",
+        "type": "function",
+    },
+    {
+        "inputs": [{"name": "index", "type": "uint256"}],
+        "name": "tokenByIndex",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "stateMutability": "view",
+        "type": "function",
+    },
+]
+MARKET_PROXY_ABI = [
+    {
+        "inputs": [{"name": "accountId", "type": "uint128"}],
+        "name": name,
+        "outputs": outputs,
+        "stateMutability": mutability,
+        "type": "function",
+    }
+    for name, outputs, mutability in [
+        ("totalCollateralValue", [{"name": "", "type": "uint256"}], "view"),
+        ("getAvailableMargin", [{"name": "", "type": "int256"}], "view"),
+        (
+            "getRequiredMargins",
+            [
+                {"name": "requiredInitialMargin", "type": "uint256"},
+                {"name": "requiredMaintenanceMargin", "type": "uint256"},
+                {"name": "maxLiquidationReward", "type": "uint256"},
+            ],
+            "view",
+        ),
+        ("canLiquidate", [{"name": "", "type": "bool"}], "view"),
+        ("liquidate", [{"name": "", "type": "uint256"}], "nonpayable"),
+        ("getAccountOpenPositions", [{"name": "", "type": "uint256[]"}], "view"),
+    ]
+] + [
+    {
+        "inputs": [
+            {"name": "accountId", "type": "uint128"},
+            {"name": "marketId", "type": "uint128"},
+        ],
+        "name": "getOpenPositionSize",
+        "outputs": [{"name": "", "type": "int128"}],
+        "stateMutability": "view",
+        "type": "function",
+    },
+    {
+        "inputs": [{"name": "marketId", "type": "uint128"}],
+        "name": "indexPrice",
+        "outputs": [{"name": "", "type": "uint256"}],
+        "stateMutability": "view",
+        "type": "function",
+    },
+]
+
+
+def get_selector(signature):
+    return function_signature_to_4byte_selector(signature)
+
+
+AGGREGATE_SELECTOR = get_selector("aggregate3Value((address,bool,uint256,bytes)[])")
+
+
+class Reverted(Exception):
+    """A simulated call reverted"""
+
+
+class InjectedError(Exception):
+    """An error injected by the fake endpoint"""
+
+
+class FakePerpsChain:
+    """
+    Synthetic perps market with ``num_accounts`` accounts.
+
+    A fraction of the accounts hold collateral, and a fraction of those can be
+    liquidated. Accounts are generated from ``seed`` so runs are repeatable.
+    """
+
+    def __init__(
+        self, num_accounts, active_fraction=0.1, liquidatable_fraction=0.01, seed=0
+    ):
+        rng = random.Random(seed)
+        self.account_ids = [rng.getrandbits(64) + 1 for _ in range(num_accounts)]
+        self.values = {}
+        self.liquidatable = set()
+        for account_id in self.account_ids:
+            if rng.random() < active_fraction:
+                self.values[account_id] = 1000 * 10**18
+                if rng.random() < liquidatable_fraction:
+                    self.liquidatable.add(account_id)
+
+        self.block_number = 1
+        self.receipts = {}
+        self._lock = threading.Lock()
+
+        self.functions = {
+            (ACCOUNT_PROXY_ADDRESS, get_selector("totalSupply()")): self.total_supply,
+            (
+                ACCOUNT_PROXY_ADDRESS,
+                get_selector("tokenByIndex(uint256)"),
+            ): self.token_by_index,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("totalCollateralValue(uint128)"),
+            ): self.total_collateral_value,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("getAvailableMargin(uint128)"),
+            ): self.get_available_margin,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("getRequiredMargins(uint128)"),
+            ): self.get_required_margins,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("canLiquidate(uint128)"),
+            ): self.can_liquidate,
+            (MARKET_PROXY_ADDRESS, get_selector("liquidate(uint128)")): self.liquidate,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("getAccountOpenPositions(uint128)"),
+            ): self.get_account_open_positions,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("getOpenPositionSize(uint128,uint128)"),
+            ): self.get_open_position_size,
+            (
+                MARKET_PROXY_ADDRESS,
+                get_selector("indexPrice(uint128)"),
+            ): self.index_price,
+        }
+
+    def total_supply(self, data):
+        return encode(["uint256"], [len(self.account_ids)]), CALL_GAS
+
+    def token_by_index(self, data):
+        (index,) = decode(["uint256"], data)
+        if index >= len(self.account_ids):
+            raise Reverted("index out of bounds")
+        return encode(["uint256"], [self.account_ids[index]]), CALL_GAS
+
+    def total_collateral_value(self, data):
+        (account_id,) = decode(["uint128"], data)
+        return encode(["uint256"], [self.values.get(account_id, 0)]), CALL_GAS
+
+    def get_available_margin(self, data):
+        (account_id,) = decode(["uint128"], data)
+        margin = 10 * 10**18 if account_id in self.liquidatable else 1000 * 10**18
+        return encode(["int256"], [margin]), CALL_GAS
+
+    def get_required_margins(self, data):
+        encoded = encode(
+            ["uint256", "uint256", "uint256"], [100 * 10**18, 50 * 10**18, 10**18]
+        )
+        return encoded, CALL_GAS
+
+    def can_liquidate(self, data):
+        (account_id,) = decode(["uint128"], data)
+        return encode(["bool"], [account_id in self.liquidatable]), CALL_GAS
+
+    def liquidate(self, data):
+        (account_id,) = decode(["uint128"], data)
+        if account_id not in self.liquidatable:
+            raise Reverted("not liquidatable")
+        return encode(["uint256"], [10**18]), LIQUIDATE_GAS
+
+    def get_account_open_positions(self, data):
+        (account_id,) = decode(["uint128"], data)
+        market_ids = [MARKET_ID] if account_id in self.values else []
+        return encode(["uint256[]"], [market_ids]), CALL_GAS
+
+    def get_open_position_size(self, data):
+        account_id, _ = decode(["uint128", "uint128"], data)
+        size = 10**18 if account_id in self.values else 0
+        return encode(["int128"], [size]), CALL_GAS
+
+    def index_price(self, data):
+        return encode(["uint256"], [MARKET_PRICE]), CALL_GAS
+
+    def call(self, to, data):
+        """Run a call, returning the return data and the gas used"""
+        to = Web3.to_checksum_address(to)
+        if to == MULTICALL_ADDRESS and data[:4] == AGGREGATE_SELECTOR:
+            return self.aggregate(data[4:])
+
+        function = self.functions.get((to, data[:4]))
+        if function is None:
+            raise Reverted("unknown function")
+        return function(data[4:])
+
+    def aggregate(self, data):
+        (calls,) = decode(["(address,bool,uint256,bytes)[]"], data)
+        results = []
+        total_gas = 0
+        for target, allow_failure, _, call_data in calls:
+            try:
+                return_data, gas = self.call(target, call_data)
+                results.append((True, return_data))
+                total_gas += gas
+            except Reverted:
+                if not allow_failure:
+                    raise Reverted("Multicall3: call failed")
+                results.append((False, b""))
+                total_gas += CALL_GAS
+        return encode(["(bool,bytes)[]"], [results]), total_gas
+
+    def get_block(self):
+        return {
+            "number": hex(self.block_number),
+            "hash": encode_hex(keccak(self.block_number.to_bytes(32, "big"))),
+            "parentHash": encode_hex(b"\x00" * 32),
+            "timestamp": hex(int(time.time())),
+            "baseFeePerGas": hex(BASE_FEE),
+            "gasLimit": hex(30000000),
+            "gasUsed": hex(0),
+            "miner": KEEPER_ADDRESS,
+            "transactions": [],
+        }
+
+    def send_transaction(self, tx):
+        """Mine a transaction immediately, returning its hash"""
+        with self._lock:
+            self.block_number += 1
+            tx_hash = encode_hex(
+                keccak(
+                    json.dumps(tx, sort_keys=True).encode()
+                    + self.block_number.to_bytes(32, "big")
+                )
+            )
+            try:
+                _, gas = self.call(tx["to"], decode_hex(tx["data"]))
+                status = 1
+            except Reverted:
+                gas = TX_GAS
+                status = 0
+            self.receipts[tx_hash] = {
+                "transactionHash": tx_hash,
+                "blockHash": self.get_block()["hash"],
+                "blockNumber": hex(self.block_number),
+                "transactionIndex": "0x0",
+                "from": tx.get("from", KEEPER_ADDRESS),
+                "to": tx["to"],
+                "gasUsed": hex(gas),
+                "cumulativeGasUsed": hex(gas),
+                "effectiveGasPrice": hex(BASE_FEE + PRIORITY_FEE),
+                "status": hex(status),
+                "logs": [],
+                "contractAddress": None,
+                "type": "0x2",
+            }
+            return tx_hash
+
+
+class FakeRpcHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        request = json.loads(body)
+        response = json.dumps(self.server.handle(request)).encode()
+
+        if not request["method"].startswith("bench_"):
+            self.server.record(request["method"], len(body), len(response))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeRpcServer(ThreadingHTTPServer):
+    """
+    JSON-RPC endpoint serving a ``FakePerpsChain``.
+
+    Every request is delayed by ``latency`` seconds, and a fraction
+    ``error_rate`` of multicalls fail with an oversize error. Request counts and
+    bytes transferred are read and reset with the ``bench_stats`` and
+    ``bench_reset`` methods, which are not counted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, chain, latency=0, error_rate=0, seed=0, port=0):
+        super().__init__(("127.0.0.1", port), FakeRpcHandler)
+        self.chain = chain
+        self.latency = latency
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {"requests": 0, "bytes_in": 0, "bytes_out": 0, "methods": {}}
+
+    def record(self, method, bytes_in, bytes_out):
+        with self._lock:
+            self.stats["requests"] += 1
+            self.stats["bytes_in"] += bytes_in
+            self.stats["bytes_out"] += bytes_out
+            self.stats["methods"][method] = self.stats["methods"].get(method, 0) + 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._rng.random() < self.error_rate
+
+    def handle(self, request):
+        method = request["method"]
+        params = request.get("params", [])
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+
+        if method == "bench_stats":
+            with self._lock:
+                response["result"] = json.loads(json.dumps(self.stats))
+            return response
+        if method == "bench_reset":
+            self.reset_stats()
+            response["result"] = True
+            return response
+
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+        try:
+            response["result"] = self.dispatch(method, params)
+        except Reverted as e:
+            response["error"] = {"code": 3, "message": f"execution reverted: {e}"}
+        except NotImplementedError:
+            response["error"] = {"code": -32601, "message": f"{method} not supported"}
+        except InjectedError:
+            response["error"] = INJECTED_ERROR
+        return response
+
+    def dispatch(self, method, params):
+        chain = self.chain
+        if method == "eth_chainId":
+            return hex(CHAIN_ID)
+        if method == "eth_blockNumber":
+            return hex(chain.block_number)
+        if method == "eth_getBlockByNumber":
+            return chain.get_block()
+        if method == "eth_gasPrice":
+            return hex(BASE_FEE + PRIORITY_FEE)
+        if method == "eth_maxPriorityFeePerGas":
+            return hex(PRIORITY_FEE)
+        if method == "eth_getTransactionCount":
+            return hex(0)
+        if method == "eth_call":
+            tx = params[0]
+            data = decode_hex(tx.get("data") or tx.get("input") or "0x")
+            if data[:4] == AGGREGATE_SELECTOR and self.should_fail():
+                raise InjectedError()
+            return encode_hex(chain.call(tx["to"], data)[0])
+        if method == "eth_estimateGas":
+            tx = params[0]
+            data = decode_hex(tx.get("data") or tx.get("input") or "0x")
+            return hex(TX_GAS + chain.call(tx["to"], data)[1])
+        if method == "eth_sendTransaction":
+            return chain.send_transaction(params[0])
+        if method == "eth_getTransactionReceipt":
+            return chain.receipts.get(params[0])
+        raise NotImplementedError(method)
+
+
+def _serve(chain_kwargs, server_kwargs, port_pipe):
+    server = FakeRpcServer(FakePerpsChain(**chain_kwargs), **server_kwargs)
+    port_pipe.send(server.server_address[1])
+    server.serve_forever()
+
+
+def start_fake_rpc(chain_kwargs, server_kwargs={}):
+    """
+    Start a fake endpoint in a separate process, so that its work is not
+    counted in the time and memory of the keeper routines.
+
+    :return: a tuple of the process and the endpoint url
+    :rtype: tuple
+    """
+    parent_pipe, child_pipe = multiprocessing.Pipe()
+    process = multiprocessing.Process(
+        target=_serve, args=(chain_kwargs, server_kwargs, child_pipe), daemon=True
+    )
+    process.start()
+    port = parent_pipe.recv()
+    return process, f"http://127.0.0.1:{port}"
+
+
+class FakePerps:
+    """The parts of the SDK perps module used by the keeper routines"""
+
+    def __init__(self, snx):
+        self.snx = snx
+        self.market_proxy = snx.web3.eth.contract(
+            address=MARKET_PROXY_ADDRESS, abi=MARKET_PROXY_ABI
+        )
+        self.account_proxy = snx.web3.eth.contract(
+            address=ACCOUNT_PROXY_ADDRESS, abi=ACCOUNT_PROXY_ABI
+        )
+
+    def get_can_liquidates(self, account_ids):
+        can_liquidates = multicall_erc7412(
+            self.snx,
+            self.market_proxy,
+            "canLiquidate",
+            [(account_id,) for account_id in account_ids],
+        )
+        return list(zip(account_ids, can_liquidates))
+
+    def liquidate(self, account_id, submit=False):
+        tx_params = write_erc7412(
+            self.snx, self.market_proxy, "liquidate", [account_id]
+        )
+        if submit:
+            return self.snx.execute_transaction(tx_params)
+        return tx_params
+
+
+class FakeSynthetix:
+    """
+    Stand-in for ``synthetix.Synthetix`` connected to a fake endpoint.
+
+    Only the attributes used by the keeper routines are provided. Transactions
+    are sent unsigned with ``eth_sendTransaction``.
+    """
+
+    def __init__(self, endpoint_uri):
+        self.web3 = Web3(Web3.HTTPProvider(endpoint_uri))
+        self.logger = logging.getLogger("benchmark")
+        self.address = KEEPER_ADDRESS
+        self.network_id = self.web3.eth.chain_id
+        self.nonce = 0
+        self.is_fork = False
+        self.multicall = self.web3.eth.contract(
+            address=MULTICALL_ADDRESS, abi=MULTICALL_ABI
+        )
+        self.perps = FakePerps(self)
+
+    def _get_tx_params(self, value=0, to=None):
+        tx_params = {
+            "from": self.address,
+            "chainId": self.network_id,
+            "value": value,
+            "nonce": self.nonce,
+        }
+        if to is not None:
+            tx_params["to"] = to
+        return tx_params
+
+    def execute_transaction(self, tx_data):
+        if "gas" not in tx_data:
+            tx_data["gas"] = self.web3.eth.estimate_gas(tx_data)
+        tx_hash = self.web3.eth.send_transaction(tx_data)
+        self.nonce += 1
+        return encode_hex(tx_hash)
+
+    def wait(self, tx_hash, timeout=120):
+        return self.web3.eth.wait_for_transaction_receipt(tx_hash, timeout=timeout)
+
+    def get_stats(self):
+        """Get the request counts of the fake endpoint"""
+        return self.web3.provider.make_request("bench_stats", [])["result"]
+
+    def reset_stats(self):
+        self.web3.provider.make_request("bench_reset", [])
@@ -0,0 +1,198 @@
+"""
+Benchmark the keeper routines against a local fake endpoint.
+
+Run from the repository root:
+
+    python -m benchmarks.run --accounts 1000,10000,100000 --latency 0.05
+
+Each routine is timed with the endpoint's request count, the bytes sent and
+received, and the peak memory traced while it runs. Memory tracing slows the
+routines down, pass ``--no-memory`` for comparable wall times.
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import tracemalloc
+from benchmarks.fake_rpc import FakeSynthetix, start_fake_rpc, MARKET_ID
+from utils.accounts import new_account_index
+from utils.screening import MarginScreen
+from utils.perps_v3 import (
+    get_active_accounts,
+    get_liquidatable_accounts,
+    liquidate_accounts,
+)
+
+
+def measure(snx, name, fn, trace_memory=True):
+    """Run ``fn`` and measure it, returning its result and the measurements"""
+    snx.reset_stats()
+    if trace_memory:
+        tracemalloc.start()
+
+    result = None
+    error = None
+    start_time = time.perf_counter()
+    try:
+        result = fn()
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start_time
+
+    peak_memory = None
+    if trace_memory:
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    stats = snx.get_stats()
+    return result, {
+        "routine": name,
+        "seconds": elapsed,
+        "requests": stats["requests"],
+        "bytes_in": stats["bytes_in"],
+        "bytes_out": stats["bytes_out"],
+        "peak_memory": peak_memory,
+        "methods": stats["methods"],
+        "error": error,
+    }
+
+
+def run_benchmark(num_accounts, args):
+    """Run every routine against a fresh endpoint with ``num_accounts`` accounts"""
+    process, endpoint_uri = start_fake_rpc(
+        {
+            "num_accounts": num_accounts,
+            "active_fraction": args.active_fraction,
+            "liquidatable_fraction": args.liquidatable_fraction,
+            "seed": args.seed,
+        },
+        {"latency": args.latency, "error_rate": args.error_rate, "seed": args.seed},
+    )
+    try:
+        snx = FakeSynthetix(endpoint_uri)
+        trace_memory = not args.no_memory
+        account_index = new_account_index()
+
+        results = []
+        active_accounts, result = measure(
+            snx,
+            "get_active_accounts",
+            lambda: get_active_accounts(snx, account_index),
+            trace_memory,
+        )
+        results.append(result)
+
+        _, result = measure(
+            snx,
+            "get_active_accounts (refresh)",
+            lambda: get_active_accounts(snx, account_index),
+            trace_memory,
+        )
+        results.append(result)
+
+        # estimate health after a 10% price drop, screening out healthy accounts
+        margin_screen = MarginScreen()
+        margin_screen.load(account_index, active_accounts or [])
+        due_accounts, result = measure(
+            snx,
+            "screen_accounts",
+            lambda: margin_screen.get_due_accounts({MARKET_ID: 1800}),
+            trace_memory,
+        )
+        results.append(result)
+
+        liquidatable_accounts, result = measure(
+            snx,
+            "get_liquidatable_accounts",
+            lambda: get_liquidatable_accounts(snx, due_accounts or []),
+            trace_memory,
+        )
+        results.append(result)
+
+        _, result = measure(
+            snx,
+            "liquidate_accounts",
+            lambda: liquidate_accounts(
+                snx, liquidatable_accounts or [], gas_budget=args.gas_budget
+            ),
+            trace_memory,
+        )
+        results.append(result)
+    finally:
+        process.terminate()
+        process.join()
+
+    for result in results:
+        result["accounts"] = num_accounts
+    return results
+
+
+def format_results(results):
+    lines = [
+        f"{'accounts':>9} {'routine':<30} {'seconds':>8} {'requests':>9} "
+        f"{'kb sent':>9} {'kb recv':>9} {'peak mb':>8}  error"
+    ]
+    for result in results:
+        peak_memory = (
+            f"{result['peak_memory'] / 1e6:8.1f}"
+            if result["peak_memory"] is not None
+            else f"{'-':>8}"
+        )
+        lines.append(
+            f"{result['accounts']:>9} {result['routine']:<30} "
+            f"{result['seconds']:8.2f} {result['requests']:>9} "
+            f"{result['bytes_in'] / 1e3:9.1f} {result['bytes_out'] / 1e3:9.1f} "
+            f"{peak_memory}  {result['error'] or ''}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--accounts",
+        default="1000,10000,100000",
+        help="comma separated account counts to benchmark",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="seconds added to each request"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0,
+        help="fraction of multicalls that fail with an oversize error",
+    )
+    parser.add_argument("--active-fraction", type=float, default=0.1)
+    parser.add_argument("--liquidatable-fraction", type=float, default=0.01)
+    parser.add_argument("--gas-budget", type=int, default=5000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory",
+        action="store_true",
+        help="skip memory tracing, which slows down the routines",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    results = []
+    for num_accounts in [int(count) for count in args.accounts.split(",")]:
+        benchmark_results = run_benchmark(num_accounts, args)
+        results.extend(benchmark_results)
+        print(format_results(benchmark_results), flush=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if any(result["error"] is not None for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,36 @@
 """A keeper for V3 perps, including orders and liquidations"""
 
 import os
-import time
+import threading
 from dotenv import load_dotenv
 from ape import chain, Contract
 from ape.api import BlockAPI
 from synthetix import Synthetix
 from utils.swap import execute_base_swap, execute_arbitrum_swap
 from utils.perps_l1 import (
-    settle_perps_order,
-    get_active_accounts,
-    get_liquidatable_accounts,
-    liquidate_accounts,
+    settle_perps_orders,
+    get_active_positions,
+    get_liquidatable_positions,
+    liquidate_positions,
+    update_accounts,
 )
+from utils.accounts import (
+    PendingAccounts,
+    new_account_index,
+    get_indexed_active_positions,
+)
+from utils.screening import MarginScreen, get_market_prices
+from utils.transactions import TransactionPipeline
+from utils.gas import GasPricer
+from utils.price_cache import PriceCache, install_price_cache
+from utils.rpc_pool import install_rpc_pool
+from utils.deployment_cache import install_deployment_cache
+from utils.settlement import SettlementQueue, get_settlement_time
+from utils.tasks import TaskScheduler, BlockInterval
+from utils.sharding import Shard, claim_signer
+from utils.tracing import SettlementTracer
+from utils.snapshot import get_snapshot_path, save_snapshot, load_snapshot
+from utils.metrics import ACTIVE_ACCOUNTS, observe_handler, start_metrics_server
 
 from silverback import SilverbackBot
 
@@ -29,12 +47,38 @@ NETWORK_10_RPC = os.environ.get("NETWORK_10_RPC")
 ORDER_DELAY_SECONDS = os.getenv("ORDER_DELAY_SECONDS")
 BLOCKS_LIQUIDATE = os.getenv("BLOCKS_LIQUIDATE")
 BLOCKS_ACCOUNT_REFRESH = os.getenv("BLOCKS_ACCOUNT_REFRESH")
+BLOCKS_SNAPSHOT = os.getenv("BLOCKS_SNAPSHOT")
+BLOCKS_SWEEP = os.getenv("BLOCKS_SWEEP")
+LIQUIDATION_GAS_BUDGET = os.getenv("LIQUIDATION_GAS_BUDGET")
+TX_REPLACE_SECONDS = os.getenv("TX_REPLACE_SECONDS")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+METRICS_PORT = os.getenv("METRICS_PORT")
+RPC_READ_URLS = os.getenv("RPC_READ_URLS")
+TRACE_FILE = os.getenv("TRACE_FILE")
+BACKGROUND_TASKS = os.getenv("BACKGROUND_TASKS")
+MAX_SETTLEMENT_TASKS = os.getenv("MAX_SETTLEMENT_TASKS")
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+SHARD_COUNT = os.getenv("SHARD_COUNT")
 
 ORDER_DELAY_SECONDS = 0 if ORDER_DELAY_SECONDS is None else int(ORDER_DELAY_SECONDS)
 BLOCKS_LIQUIDATE = 10 if BLOCKS_LIQUIDATE is None else int(BLOCKS_LIQUIDATE)
+# margin events do not identify the account, so the refresh stays frequent
 BLOCKS_ACCOUNT_REFRESH = (
     100 if BLOCKS_ACCOUNT_REFRESH is None else int(BLOCKS_ACCOUNT_REFRESH)
 )
+BLOCKS_SNAPSHOT = 50 if BLOCKS_SNAPSHOT is None else int(BLOCKS_SNAPSHOT)
+BLOCKS_SWEEP = 100 if BLOCKS_SWEEP is None else int(BLOCKS_SWEEP)
+LIQUIDATION_GAS_BUDGET = (
+    5000000 if LIQUIDATION_GAS_BUDGET is None else int(LIQUIDATION_GAS_BUDGET)
+)
+TX_REPLACE_SECONDS = 30 if TX_REPLACE_SECONDS is None else int(TX_REPLACE_SECONDS)
+SNAPSHOT_DIR = "snapshots" if SNAPSHOT_DIR is None else SNAPSHOT_DIR
+METRICS_PORT = None if METRICS_PORT is None else int(METRICS_PORT)
+RPC_READ_URLS = [] if RPC_READ_URLS is None else RPC_READ_URLS.split(",")
+BACKGROUND_TASKS = 1 if BACKGROUND_TASKS is None else int(BACKGROUND_TASKS)
+MAX_SETTLEMENT_TASKS = 8 if MAX_SETTLEMENT_TASKS is None else int(MAX_SETTLEMENT_TASKS)
+SHARD_INDEX = 0 if SHARD_INDEX is None else int(SHARD_INDEX)
+SHARD_COUNT = 1 if SHARD_COUNT is None else int(SHARD_COUNT)
 
 # set up an initial state
 app_state = {
@@ -45,6 +89,9 @@ app_state = {
 # Do this to initialize your app
 bot = SilverbackBot()
 
+# reuse the cannon deployment from previous runs instead of fetching it from ipfs
+install_deployment_cache(SNAPSHOT_DIR)
+
 # init snx
 snx = Synthetix(
     provider_rpc=bot.provider.uri,
@@ -61,39 +108,297 @@ snx = Synthetix(
     op_mainnet_rpc=NETWORK_10_RPC,
 )
 
+# reads are spread over several endpoints, writes stay on the bot's provider
+rpc_pool = None
+if len(RPC_READ_URLS) > 0:
+    rpc_pool = install_rpc_pool(snx, RPC_READ_URLS)
+
+
+# price updates are shared by every handler within a block
+price_cache = PriceCache()
+install_price_cache(snx, price_cache)
+
+# fees are estimated once per block and shared by every handler
+gas_pricer = GasPricer(snx)
+
+# all transactions share one nonce sequence
+pipeline = TransactionPipeline(
+    snx, replace_after=TX_REPLACE_SECONDS, gas_pricer=gas_pricer
+)
+
+# settlement stages are timed from commitment to receipt
+tracer = SettlementTracer(snx, trace_path=TRACE_FILE)
+
+# block work runs as background tasks, settlement preempts housekeeping
+scheduler = TaskScheduler(snx, background=BACKGROUND_TASKS > 0)
+# settlements run on the workers of the settlement queue, which bound them
+scheduler.add_lane("settlement", priority=0)
+scheduler.add_lane("liquidation", priority=1)
+scheduler.add_lane("accounts", priority=2)
+
+# orders are settled from a queue once their settlement time is reached,
+# orders due together are settled in one transaction
+settlement_queue = SettlementQueue(
+    snx,
+    lambda events: scheduler.run(
+        "settlement",
+        lambda: settle_perps_orders(
+            snx,
+            events,
+            pipeline=pipeline,
+            price_service_endpoint=PRICE_SERVICE_ENDPOINT,
+            price_cache=price_cache,
+            tracer=tracer,
+        ),
+    ),
+    max_workers=MAX_SETTLEMENT_TASKS,
+)
 
 # Get the perps proxy contract
 PerpsMarket = Contract(
     address=snx.perps.market_proxy.address, abi=snx.perps.market_proxy.abi
 )
 
+# replicas split the accounts, each one settles, screens and liquidates its own
+shard = Shard(SHARD_INDEX, SHARD_COUNT)
+# replicas sharing a signer would collide on nonces, refuse to start
+claim_signer(SNAPSHOT_DIR, "perps_bfp", snx.network_id, shard, snx.address)
+
+# the account index is shared between the block handler and the reconcile thread
+SNAPSHOT_PATH = get_snapshot_path(
+    SNAPSHOT_DIR, "perps_bfp", snx.network_id, shard.index
+)
+account_lock = threading.Lock()
+# held for the whole of a refresh, which only holds account_lock while it
+# changes the index
+refresh_lock = threading.Lock()
+
+# account health is estimated at the latest prices from the cached margins
+margin_screen = MarginScreen(sweep_blocks=BLOCKS_SWEEP)
+warning_interval = BlockInterval(BLOCKS_LIQUIDATE)
+
+# accounts changed by events are refreshed on the next block
+pending_accounts = PendingAccounts(shard)
+
+
+def set_active_accounts(positions):
+    """Count the accounts with an active position in any market"""
+    ACTIVE_ACCOUNTS.set(len({account_id for account_id, _ in positions}))
+
+
+def refresh_accounts(block_number):
+    """Refresh the active accounts list and snapshot the account index"""
+    with refresh_lock:
+        positions = get_active_positions(
+            snx, bot.state["account_index"], shard=shard, lock=account_lock
+        )
+        with account_lock:
+            bot.state["positions"] = positions
+            margin_screen.load(bot.state["account_index"], bot.state["positions"])
+            set_active_accounts(bot.state["positions"])
+            bot.state["account_block"] = block_number
+            save_snapshot(
+                SNAPSHOT_PATH,
+                snx.network_id,
+                block_number,
+                bot.state["account_index"],
+            )
+
+
+def update_pending_accounts():
+    """Refresh the accounts changed by events since the last block"""
+    # skip while a refresh changes the index, the accounts stay pending
+    if not account_lock.acquire(blocking=False):
+        return
+
+    try:
+        account_ids = pending_accounts.pop_all()
+        if len(account_ids) == 0:
+            return
+        try:
+            bot.state["positions"] = update_accounts(
+                snx, bot.state["account_index"], account_ids, shard=shard
+            )
+        except Exception as e:
+            snx.logger.error(f"Error updating accounts {account_ids}: {e}")
+            pending_accounts.add(account_ids)
+            return
+        margin_screen.load(bot.state["account_index"], bot.state["positions"])
+        set_active_accounts(bot.state["positions"])
+    finally:
+        account_lock.release()
+
+    if refresh_lock.locked():
+        # a running refresh may record older reads of these accounts, read
+        # them again on the next block
+        pending_accounts.add(account_ids)
+
 
 @bot.on_startup()
 def startup(state):
     """On startup, initialize the state"""
-    bot.state["account_ids"] = get_active_accounts(snx)
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+
+    account_index, snapshot_block = load_snapshot(SNAPSHOT_PATH, snx.network_id)
+    block_number = snx.web3.eth.block_number
+
+    if account_index is None:
+        # cold start, scan every account
+        bot.state["account_index"] = new_account_index()
+        refresh_accounts(block_number)
+    else:
+        # warm start, use the snapshot and reconcile in the background
+        snx.logger.info(f"Loaded account snapshot from block {snapshot_block}")
+        bot.state["account_index"] = account_index
+        bot.state["positions"] = get_indexed_active_positions(account_index, shard)
+        margin_screen.load(account_index, bot.state["positions"])
+        set_active_accounts(bot.state["positions"])
+        bot.state["account_block"] = snapshot_block
+        threading.Thread(
+            target=refresh_accounts, args=(block_number,), daemon=True
+        ).start()
     return {"message": "Starting..."}
 
 
 @bot.on_(PerpsMarket.OrderCommitted, new_block_timeout=60)
+@observe_handler("perps_order_committed")
 def perps_order_committed(event):
-    """Settle orders on the perps markets"""
-    settle_perps_order(snx, event, settle_delay=ORDER_DELAY_SECONDS)
+    """Queue orders on the perps markets for settlement"""
+    # each order is settled by the replica owning its account
+    if not shard.owns(event["accountId"]):
+        return {"message": f"Perps order committed on another shard: {event}"}
+
+    tracer.start(event)
+    settlement_time = get_settlement_time(snx, event, settle_delay=ORDER_DELAY_SECONDS)
+    settlement_queue.add(event, settlement_time)
     return {"message": f"Perps order committed: {event}"}
 
 
+@bot.on_(PerpsMarket.AccountCreated, new_block_timeout=60)
+@observe_handler("account_created")
+def account_created(event):
+    """Index accounts as soon as they are created"""
+    pending_accounts.add([event["accountId"]])
+    return {"message": f"Account created: {event}"}
+
+
+@bot.on_(PerpsMarket.OrderSettled, new_block_timeout=60)
+@observe_handler("order_settled")
+def order_settled(event):
+    """Refresh accounts when their positions change"""
+    pending_accounts.add([event["accountId"]])
+    return {"message": f"Order settled: {event}"}
+
+
+@bot.on_(PerpsMarket.PositionLiquidated, new_block_timeout=60)
+@observe_handler("position_liquidated")
+def position_liquidated(event):
+    """Refresh accounts when their positions are liquidated"""
+    pending_accounts.add([event["accountId"]])
+    return {"message": f"Position liquidated: {event}"}
+
+
+@bot.on_(PerpsMarket.MarginLiquidated, new_block_timeout=60)
+@observe_handler("margin_liquidated")
+def margin_liquidated(event):
+    """Refresh accounts when their margin is liquidated"""
+    pending_accounts.add([event["accountId"]])
+    return {"message": f"Margin liquidated: {event}"}
+
+
+@bot.on_(PerpsMarket.AccountSplit, new_block_timeout=60)
+@observe_handler("account_split")
+def account_split(event):
+    """Refresh both accounts when a position is split"""
+    pending_accounts.add([event["fromId"], event["toId"]])
+    return {"message": f"Account split: {event}"}
+
+
+@bot.on_(PerpsMarket.AccountsMerged, new_block_timeout=60)
+@observe_handler("accounts_merged")
+def accounts_merged(event):
+    """Refresh both accounts when positions are merged"""
+    pending_accounts.add([event["fromId"], event["toId"]])
+    return {"message": f"Accounts merged: {event}"}
+
+
+def check_liquidations(block_number):
+    """
+    Check liquidations, positions estimated near the threshold every block and
+    positions in the warning band every BLOCKS_LIQUIDATE blocks
+    """
+    update_pending_accounts()
+
+    check_warning = warning_interval.is_due(block_number)
+    prices = get_market_prices(snx, margin_screen.market_ids)
+    due_positions = margin_screen.get_due_accounts(prices, check_warning)
+    if check_warning:
+        warning_interval.complete(block_number)
+    if len(due_positions) == 0:
+        return
+
+    liquidatable_positions, liquidatable_margins, failed_positions = (
+        get_liquidatable_positions(snx, due_positions)
+    )
+    # positions that could not be checked are checked again on the next block
+    margin_screen.mark_due(failed_positions)
+    if len(liquidatable_positions) + len(liquidatable_margins) > 0:
+        margin_screen.mark_due(liquidatable_positions + liquidatable_margins)
+        liquidate_positions(
+            snx,
+            liquidatable_positions,
+            liquidatable_margins,
+            gas_budget=LIQUIDATION_GAS_BUDGET,
+            pipeline=pipeline,
+        )
+
+
+def reconcile_accounts(block_number):
+    """Re-check every position, unless a reconcile is already running"""
+    tracer.log_summary()
+    if not refresh_lock.locked():
+        refresh_accounts(block_number)
+
+
+def snapshot_accounts(block_number):
+    """Persist the account index between refreshes"""
+    if refresh_lock.locked() or bot.state["account_block"] >= block_number:
+        return
+    with account_lock:
+        save_snapshot(
+            SNAPSHOT_PATH, snx.network_id, block_number, bot.state["account_index"]
+        )
+
+
+def renew_signer(block_number):
+    """Renew the signer claim of this shard, so it does not expire while running"""
+    claim_signer(SNAPSHOT_DIR, "perps_bfp", snx.network_id, shard, snx.address)
+
+
+# jobs run once they are past their deadline, a job that falls behind
+# catches up with a single run on the latest block
+scheduler.add_job("liquidation", check_liquidations, "liquidation")
+scheduler.add_job(
+    "reconcile", reconcile_accounts, "accounts", blocks=BLOCKS_ACCOUNT_REFRESH
+)
+scheduler.add_job("snapshot", snapshot_accounts, "accounts", blocks=BLOCKS_SNAPSHOT)
+scheduler.add_job("signer", renew_signer, "accounts", blocks=BLOCKS_SNAPSHOT)
+
+
 @bot.on_(chain.blocks, new_block_timeout=60)
+@observe_handler("exec_block")
 def exec_block(block: BlockAPI):
     """Actions to take on every block"""
-    if block.number % BLOCKS_LIQUIDATE == 0:
-        # check liquidations
-        liquidatable_accounts = get_liquidatable_accounts(snx, bot.state["account_ids"])
-
-        if len(liquidatable_accounts) > 0:
-            liquidate_accounts(snx, liquidatable_accounts)
+    # blocks older than one already handled are dropped
+    if scheduler.is_stale(block.number):
+        return
 
-    if block.number % BLOCKS_ACCOUNT_REFRESH == 0:
-        # update account ids
-        bot.state["account_ids"] = get_active_accounts(snx)
+    if rpc_pool is not None:
+        rpc_pool.set_head(block.number)
+    price_cache.new_block(block.number)
+    gas_pricer.refresh(block.number)
 
-    pass
+    # the work runs in the background, so the next block and events are not
+    # held up by a long liquidation sweep
+    scheduler.on_block(block.number)
@@ -6,7 +6,18 @@ from ape import chain
 from ape.api import BlockAPI
 from synthetix import Synthetix
 from synthetix.utils.multicall import write_erc7412, multicall_erc7412
-from eth_utils import decode_hex
+from utils.price_cache import PriceCache, install_price_cache
+from utils.rpc_pool import install_rpc_pool
+from utils.deployment_cache import install_deployment_cache
+from utils.gas import GasPricer
+from utils.price_schedule import PriceSchedule, get_publish_times
+from utils.tasks import TaskScheduler
+from utils.metrics import (
+    TRANSACTIONS_SENT,
+    observe_handler,
+    record_receipt,
+    start_metrics_server,
+)
 
 from silverback import SilverbackBot
 
@@ -22,10 +33,30 @@ NETWORK_10_RPC = os.environ.get("NETWORK_10_RPC")
 # constant
 STALENESS_TOLERANCE = 3300
 MAX_ETH_COST = 0.05
+PUSH_RETRY_SECONDS = 60
+
+PUSH_LEAD_SECONDS = os.getenv("PUSH_LEAD_SECONDS")
+PUSH_BATCH_SECONDS = os.getenv("PUSH_BATCH_SECONDS")
+BLOCKS_FEED_REFRESH = os.getenv("BLOCKS_FEED_REFRESH")
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+METRICS_PORT = os.getenv("METRICS_PORT")
+RPC_READ_URLS = os.getenv("RPC_READ_URLS")
+BACKGROUND_TASKS = os.getenv("BACKGROUND_TASKS")
+
+PUSH_LEAD_SECONDS = 60 if PUSH_LEAD_SECONDS is None else int(PUSH_LEAD_SECONDS)
+PUSH_BATCH_SECONDS = 600 if PUSH_BATCH_SECONDS is None else int(PUSH_BATCH_SECONDS)
+BLOCKS_FEED_REFRESH = 30 if BLOCKS_FEED_REFRESH is None else int(BLOCKS_FEED_REFRESH)
+SNAPSHOT_DIR = "snapshots" if SNAPSHOT_DIR is None else SNAPSHOT_DIR
+METRICS_PORT = None if METRICS_PORT is None else int(METRICS_PORT)
+RPC_READ_URLS = [] if RPC_READ_URLS is None else RPC_READ_URLS.split(",")
+BACKGROUND_TASKS = 1 if BACKGROUND_TASKS is None else int(BACKGROUND_TASKS)
 
 # initialize the bot
 bot = SilverbackBot()
 
+# reuse the cannon deployment from previous runs instead of fetching it from ipfs
+install_deployment_cache(SNAPSHOT_DIR)
+
 # init snx
 snx = Synthetix(
     provider_rpc=bot.provider.uri,
@@ -42,75 +73,157 @@ snx = Synthetix(
     op_mainnet_rpc=NETWORK_10_RPC,
 )
 
-
-def check_prices(snx, feed_ids):
-    """For a list of feed ids, check if the prices are stale"""
-    # get the contract
-    contract = snx.contracts["pyth_erc7412_wrapper"]["PythERC7412Wrapper"]["contract"]
-    function_name = "getLatestPrice"
-
-    # encode the inputs
-    args_list = [(decode_hex(feed_id), STALENESS_TOLERANCE) for feed_id in feed_ids]
-
-    # prepare the initial calls
-    calls = [
-        (
-            contract.address,
-            False,
-            0,
-            contract.encodeABI(fn_name=function_name, args=args),
+# reads are spread over several endpoints, writes stay on the bot's provider
+rpc_pool = None
+if len(RPC_READ_URLS) > 0:
+    rpc_pool = install_rpc_pool(snx, RPC_READ_URLS)
+
+# price updates are shared by every handler within a block
+price_cache = PriceCache()
+install_price_cache(snx, price_cache)
+
+# fees are estimated once per block
+gas_pricer = GasPricer(snx)
+
+# deadlines at which each feed goes stale
+schedule = PriceSchedule(STALENESS_TOLERANCE)
+
+# pushes run in the background, so waiting for a receipt does not hold up blocks
+scheduler = TaskScheduler(snx, background=BACKGROUND_TASKS > 0)
+scheduler.add_lane("prices", priority=0)
+
+
+def push_prices(snx, feed_ids):
+    """Push fresh prices for a list of feeds in one transaction"""
+    # get pyth price update data
+    pyth_result = snx.pyth.get_price_from_ids(feed_ids)
+    price_update_data = pyth_result["price_update_data"]
+
+    # prepare a pyth call
+    pyth_contract = snx.contracts["Pyth"]["contract"]
+    tx_params = snx._get_tx_params(value=len(feed_ids))
+    tx_params = pyth_contract.functions.updatePriceFeeds(
+        price_update_data
+    ).build_transaction(tx_params)
+    gas_pricer.apply(tx_params, "price_update")
+    snx.logger.info(f"Tx: {tx_params}")
+
+    # send the transaction
+    eth_cost = gas_pricer.estimate_cost(tx_params["gas"], "price_update")
+    snx.logger.info(f"Estimated ETH cost: {eth_cost} ETH")
+
+    if eth_cost < MAX_ETH_COST:
+        tx_hash = snx.execute_transaction(tx_params)
+        TRANSACTIONS_SENT.inc(urgency="price_update")
+        tx_receipt = snx.wait(tx_hash)
+        record_receipt(tx_receipt, "price_update")
+
+        # log the result
+        if tx_receipt["status"] == 1:
+            snx.logger.info(f"Price feeds updated successfully")
+            return True
+        else:
+            snx.logger.error(f"Price feeds update failed")
+    else:
+        snx.logger.info("Too rich for my blood, brother")
+    return False
+
+
+@observe_handler("check_deadlines")
+def check_deadlines(snx, schedule, timestamp):
+    """
+    Push prices for feeds close to going stale.
+
+    Once any feed is within ``PUSH_LEAD_SECONDS`` of its deadline, every feed
+    going stale in the following ``PUSH_BATCH_SECONDS`` is re-read and pushed
+    in the same transaction.
+    """
+    next_deadline = schedule.next_deadline()
+    if next_deadline is None or next_deadline > timestamp + PUSH_LEAD_SECONDS:
+        return
+
+    # re-read the candidates, someone else may have pushed them already
+    candidate_feeds = schedule.pop_due(
+        timestamp + PUSH_LEAD_SECONDS + PUSH_BATCH_SECONDS
+    )
+
+    # feeds are scheduled again even if a read or push fails, failed feeds
+    # are retried after a delay instead of on every block
+    retry_time = timestamp + PUSH_LEAD_SECONDS + PUSH_RETRY_SECONDS
+    new_publish_times = {
+        feed_id: retry_time - STALENESS_TOLERANCE for feed_id in candidate_feeds
+    }
+    try:
+        publish_times = get_publish_times(snx, candidate_feeds)
+        deadlines = {
+            feed_id: publish_time + STALENESS_TOLERANCE
+            for feed_id, publish_time in publish_times.items()
+        }
+
+        push_feeds = []
+        if any(
+            deadline <= timestamp + PUSH_LEAD_SECONDS for deadline in deadlines.values()
+        ):
+            push_feeds = [
+                feed_id
+                for feed_id, deadline in deadlines.items()
+                if deadline <= timestamp + PUSH_LEAD_SECONDS + PUSH_BATCH_SECONDS
+            ]
+        new_publish_times.update(
+            {
+                feed_id: publish_time
+                for feed_id, publish_time in publish_times.items()
+                if feed_id not in push_feeds
+            }
         )
-        for args in args_list
-    ]
 
-    # call it
-    results = snx.multicall.functions.aggregate3Value(calls).call()
-    stale_feeds = [
-        feed_ids[ind] for ind, result in enumerate(results) if result[0] == False
+        if len(push_feeds) > 0:
+            snx.logger.info(f"Pushing prices for {len(push_feeds)} feeds")
+            if push_prices(snx, push_feeds):
+                new_publish_times.update({feed_id: timestamp for feed_id in push_feeds})
+    finally:
+        for feed_id, publish_time in new_publish_times.items():
+            schedule.update(feed_id, publish_time)
+
+
+def refresh_feeds(block_number):
+    """Schedule feeds added since the last refresh"""
+    price_feed_ids = [
+        feed_id
+        for feed_id in snx.pyth.price_feed_ids.values()
+        if feed_id not in schedule.deadlines
     ]
+    if len(price_feed_ids) == 0:
+        return
+
+    snx.logger.info(f"Scheduling {len(price_feed_ids)} new price feeds")
+    for feed_id, publish_time in get_publish_times(snx, price_feed_ids).items():
+        schedule.update(feed_id, publish_time)
 
-    if len(stale_feeds) > 0:
-        # get pyth price update data
-        pyth_result = snx.pyth.get_price_from_ids(stale_feeds)
-        price_update_data = pyth_result["price_update_data"]
-
-        # prepare a pyth call
-        pyth_contract = snx.contracts["Pyth"]["contract"]
-        tx_params = snx._get_tx_params(value=len(stale_feeds))
-        tx_params = pyth_contract.functions.updatePriceFeeds(
-            price_update_data
-        ).build_transaction(tx_params)
-        snx.logger.info(f"Tx: {tx_params}")
-
-        # send the transaction
-        eth_cost = (tx_params["gas"] * tx_params["maxFeePerGas"]) / 1e18
-        snx.logger.info(f"Estimated ETH cost: {eth_cost} ETH")
-
-        if eth_cost < MAX_ETH_COST:
-            tx_hash = snx.execute_transaction(tx_params)
-            tx_receipt = snx.wait(tx_hash)
-
-            # log the result
-            if tx_receipt["status"] == 1:
-                snx.logger.info(f"Price feeds updated successfully")
-            else:
-                snx.logger.error(f"Price feeds update failed")
-        else:
-            snx.logger.info("Too rich for my blood, brother")
-    else:
-        snx.logger.info(f"No stale prices found")
+
+# new feeds are picked up in the prices lane, so they never race a push
+scheduler.add_job("feeds", refresh_feeds, "prices", blocks=BLOCKS_FEED_REFRESH)
 
 
 @bot.on_startup()
 def startup(state):
+    if METRICS_PORT is not None:
+        start_metrics_server(METRICS_PORT)
+
     # log the available markets
     snx.logger.info(f"Available markets: {snx.perps.markets_by_name.keys()}")
-    pass
+
+    # schedule every feed by its on-chain publish time
+    refresh_feeds(None)
 
 
 # Log new blocks
 @bot.on_(chain.blocks)
+@observe_handler("exec_block")
 def exec_block(block: BlockAPI):
-    if block.number % 30 == 0:
-        price_feed_ids = list(snx.pyth.price_feed_ids.values())
-        check_prices(snx, price_feed_ids)
+    if rpc_pool is not None:
+        rpc_pool.set_head(block.number)
+    price_cache.new_block(block.number)
+    gas_pricer.refresh(block.number)
+    scheduler.on_block(block.number)
+    scheduler.submit("prices", check_deadlines, snx, schedule, block.timestamp)
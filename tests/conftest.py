@@ -0,0 +1,28 @@
+import pytest
+
+
+@pytest.fixture
+def fake_plan():
+    """
+    A ``ReadPlan`` stand-in returning ``results[function_name](args)`` for each
+    call, which checks that ``lock`` is not held while reading.
+    """
+
+    class FakePlan:
+        results = {}
+        lock = None
+
+        def __init__(self):
+            self.groups = []
+
+        def add(self, contract, function_name, args_list):
+            self.groups.append((function_name, list(args_list)))
+
+        def run(self, snx):
+            assert self.lock is None or not self.lock.locked()
+            return [
+                [self.results[function_name](args) for args in args_list]
+                for function_name, args_list in self.groups
+            ]
+
+    return FakePlan
@@ -0,0 +1,100 @@
+import threading
+from types import SimpleNamespace
+
+from utils import perps_l1, perps_v3
+from utils.accounts import accounts_to_refresh, new_account_index
+
+ONE_USD = 10**18
+
+
+def test_refresh_only_holds_the_lock_while_changing_the_index(monkeypatch, fake_plan):
+    lock = threading.Lock()
+    fake_plan.lock = lock
+    fake_plan.results = {
+        "getAvailableMargin": lambda args: 100 * ONE_USD,
+        "getRequiredMargins": lambda args: (0, 5 * ONE_USD, 5 * ONE_USD, 0),
+        "getAccountOpenPositions": lambda args: [],
+        "getOpenPositionSize": lambda args: 0,
+        "indexPrice": lambda args: ONE_USD,
+    }
+
+    def scan_new_accounts(snx, account_index):
+        assert lock.locked()
+        account_index["account_ids"].extend([1, 2])
+        return [1, 2]
+
+    def multicall_chunks(snx, contract, function_name, inputs):
+        assert not lock.locked()
+        return [10 * ONE_USD if account_id == 1 else 0 for account_id in inputs]
+
+    monkeypatch.setattr(perps_v3, "ReadPlan", fake_plan)
+    monkeypatch.setattr(perps_v3, "scan_new_accounts", scan_new_accounts)
+    monkeypatch.setattr(perps_v3, "multicall_chunks", multicall_chunks)
+    snx = SimpleNamespace(
+        perps=SimpleNamespace(market_proxy="proxy"),
+        logger=SimpleNamespace(info=lambda message: None),
+    )
+    account_index = new_account_index()
+
+    active_accounts = perps_v3.get_active_accounts(snx, account_index, lock=lock)
+
+    assert active_accounts == [1]
+    assert account_index["margins"][1]["margin"] == 100
+    assert not lock.locked()
+
+
+def test_bfp_updates_read_every_active_market(monkeypatch):
+    reads = []
+    monkeypatch.setattr(perps_l1, "scan_new_accounts", lambda snx, account_index: [])
+    monkeypatch.setattr(perps_l1, "get_market_ids", lambda snx: [100, 200])
+    monkeypatch.setattr(
+        perps_l1,
+        "read_account_digests",
+        lambda snx, account_index, account_ids, market_ids: reads.append(
+            (account_ids, market_ids)
+        ),
+    )
+    snx = SimpleNamespace(
+        perps=SimpleNamespace(markets_by_id={100: {}}),
+        logger=SimpleNamespace(info=lambda message: None),
+    )
+
+    perps_l1.update_accounts(snx, new_account_index(), [1, 2])
+
+    assert reads == [([1, 2], [100, 200])]
+
+
+def make_index(active_ids, dead_ids):
+    account_index = new_account_index()
+    account_index["account_ids"] = sorted(active_ids + dead_ids)
+    account_index["values"] = {account_id: ONE_USD for account_id in active_ids}
+    account_index["values"].update({account_id: 0 for account_id in dead_ids})
+    return account_index
+
+
+def test_inactive_accounts_are_swept_in_a_rotating_window():
+    account_index = make_index([1, 2], list(range(10, 30)))
+
+    swept = []
+    for _ in range(10):
+        refresh_ids = accounts_to_refresh(account_index, [])
+        assert refresh_ids[:2] == [1, 2]
+        swept.extend(refresh_ids[2:])
+    assert sorted(swept) == list(range(10, 30))
+
+
+def test_new_and_unread_accounts_are_always_refreshed():
+    account_index = make_index([1], [10, 11])
+    account_index["account_ids"].extend([20, 21])
+
+    refresh_ids = accounts_to_refresh(account_index, [21])
+
+    assert refresh_ids[:3] == [21, 20, 1]
+
+
+def test_every_inactive_account_is_refreshed_without_a_sweep():
+    account_index = make_index([1], list(range(10, 30)))
+
+    refresh_ids = accounts_to_refresh(account_index, [], dead_sweep_fraction=1)
+
+    assert sorted(refresh_ids) == [1] + list(range(10, 30))
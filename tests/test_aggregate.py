@@ -0,0 +1,80 @@
+import logging
+from types import SimpleNamespace
+
+from utils.aggregate import (
+    build_batched_transactions,
+    get_aggregate_calls,
+    pack_call_groups,
+)
+
+MULTICALL = "0x00000000000000000000000000000000000000ca"
+MARKET = "0x00000000000000000000000000000000000000bb"
+
+
+def call(data, value=0):
+    return (MARKET, True, value, data)
+
+
+def test_groups_are_packed_in_order_within_the_budget():
+    groups = [[call("a")], [call("b")], [call("c")], [call("d")]]
+
+    batches = pack_call_groups(groups, [40, 40, 40, 40], gas_budget=100)
+
+    assert batches == [
+        ([0, 1], [call("a"), call("b")]),
+        ([2, 3], [call("c"), call("d")]),
+    ]
+
+
+def test_groups_larger_than_the_budget_get_their_own_batch():
+    groups = [[call("a")], [call("b")], [call("c")]]
+
+    batches = pack_call_groups(groups, [40, 200, 40], gas_budget=100)
+
+    assert [indexes for indexes, _ in batches] == [[0], [1], [2]]
+
+
+def test_shared_oracle_calls_are_included_once():
+    oracle = call("oracle", value=1)
+    groups = [[oracle, call("a")], [oracle, call("b")]]
+
+    batches = pack_call_groups(groups, [40, 40], gas_budget=100)
+
+    assert batches == [([0, 1], [oracle, call("a"), call("b")])]
+
+
+def make_snx(built):
+    def aggregate3Value(calls):
+        def build_transaction(tx_params):
+            built.append((calls, tx_params))
+            return dict(tx_params, to=MULTICALL)
+
+        return SimpleNamespace(build_transaction=build_transaction)
+
+    return SimpleNamespace(
+        logger=logging.getLogger("test"),
+        multicall=SimpleNamespace(
+            address=MULTICALL,
+            functions=SimpleNamespace(aggregate3Value=aggregate3Value),
+        ),
+        _get_tx_params=lambda value=0: {"value": value},
+    )
+
+
+def test_plain_transactions_become_one_call():
+    tx = {"to": MARKET, "data": "a", "value": 2}
+
+    assert get_aggregate_calls(make_snx([]), tx) == [(MARKET, True, 2, "a")]
+
+
+def test_batches_are_capped_by_the_simulated_gas():
+    built = []
+    snx = make_snx(built)
+    txs = [{"to": MARKET, "data": data, "gas": 40} for data in "abc"]
+
+    batches = build_batched_transactions(snx, txs, gas_budget=100, gas_limit=70)
+
+    assert [indexes for indexes, _ in batches] == [[0, 1], [2]]
+    assert batches[0][1]["gas"] == 70
+    assert batches[1][1] is txs[2]
+    assert len(built) == 1
@@ -0,0 +1,92 @@
+import pytest
+
+from utils.batching import (
+    DEFAULT_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    TARGET_CHUNK_SECONDS,
+    BatchSizer,
+    is_oversize_error,
+)
+from utils.parallel import call_chunk
+
+
+def test_fast_full_chunks_grow():
+    sizer = BatchSizer()
+
+    sizer.record_success(DEFAULT_CHUNK_SIZE, TARGET_CHUNK_SECONDS / 4)
+
+    assert sizer.chunk_size > DEFAULT_CHUNK_SIZE
+
+
+def test_fast_partial_chunks_do_not_grow():
+    sizer = BatchSizer()
+
+    sizer.record_success(DEFAULT_CHUNK_SIZE // 2, TARGET_CHUNK_SECONDS / 4)
+
+    assert sizer.chunk_size == DEFAULT_CHUNK_SIZE
+
+
+def test_slow_chunks_shrink_towards_the_target():
+    sizer = BatchSizer()
+
+    sizer.record_success(DEFAULT_CHUNK_SIZE, TARGET_CHUNK_SECONDS * 2)
+
+    assert sizer.chunk_size == DEFAULT_CHUNK_SIZE // 2
+
+
+def test_failures_halve_the_chunk_size_down_to_the_minimum():
+    sizer = BatchSizer()
+
+    sizer.record_failure(DEFAULT_CHUNK_SIZE)
+    assert sizer.chunk_size == DEFAULT_CHUNK_SIZE // 2
+
+    for _ in range(20):
+        sizer.record_failure(sizer.chunk_size)
+    assert sizer.chunk_size == MIN_CHUNK_SIZE
+
+
+def test_only_size_errors_are_oversize():
+    assert is_oversize_error(ValueError("out of gas"))
+    assert is_oversize_error(ValueError("Response size exceeded"))
+    assert not is_oversize_error(ValueError("execution reverted"))
+    assert not is_oversize_error(TimeoutError("read timed out"))
+
+
+def test_oversize_chunks_are_split():
+    sizer = BatchSizer()
+    calls = []
+
+    def fn(chunk):
+        calls.append(len(chunk))
+        if len(chunk) > 2:
+            raise ValueError("out of gas")
+        return [item * 2 for item in chunk]
+
+    assert call_chunk(fn, list(range(8)), sizer) == [item * 2 for item in range(8)]
+    assert calls == [8, 4, 2, 2, 4, 2, 2]
+    assert sizer.chunk_size == MIN_CHUNK_SIZE
+
+
+def test_other_errors_are_not_split():
+    calls = []
+
+    def fn(chunk):
+        calls.append(len(chunk))
+        raise ValueError("execution reverted")
+
+    with pytest.raises(ValueError):
+        call_chunk(fn, list(range(8)), BatchSizer())
+    assert calls == [8]
+
+
+def test_splitting_stops_at_the_depth_cap():
+    calls = []
+
+    def fn(chunk):
+        calls.append(len(chunk))
+        raise ValueError("out of gas")
+
+    with pytest.raises(ValueError):
+        call_chunk(fn, list(range(64)), BatchSizer())
+    # 64 -> 32 -> 16 -> 8 -> 4, the first chunk at the cap raises
+    assert calls == [64, 32, 16, 8, 4]
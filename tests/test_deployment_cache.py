@@ -0,0 +1,78 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+from synthetix.contracts import contracts as sdk_contracts
+
+from utils import deployment_cache
+from utils.deployment_cache import install_deployment_cache
+from utils.snapshot import read_json
+
+ABI = [{"type": "function", "name": "owner", "inputs": [], "outputs": []}]
+
+
+@pytest.fixture
+def registry(monkeypatch, tmp_path):
+    registry = SimpleNamespace(ipfs_hash="Qm1", hash_reads=[], ipfs_reads=[])
+
+    def get_deployment_hash(snx):
+        registry.hash_reads.append(registry.ipfs_hash)
+        return registry.ipfs_hash
+
+    def fetch_deploy_from_ipfs(snx, ipfs_hash):
+        registry.ipfs_reads.append(ipfs_hash)
+        return {"CoreProxy": {"address": "0x01", "abi": ABI, "contract": object()}}
+
+    monkeypatch.setattr(sdk_contracts, "get_deployment_hash", get_deployment_hash)
+    monkeypatch.setattr(sdk_contracts, "fetch_deploy_from_ipfs", fetch_deploy_from_ipfs)
+    # the background check runs when it is started
+    monkeypatch.setattr(
+        deployment_cache.threading,
+        "Thread",
+        lambda target, args, daemon: SimpleNamespace(start=lambda: target(*args)),
+    )
+    install_deployment_cache(str(tmp_path))
+    return registry
+
+
+def make_snx():
+    return SimpleNamespace(
+        logger=logging.getLogger("test"),
+        network_id=8453,
+        cannon_config={
+            "package": "synthetix-omnibus",
+            "version": "latest",
+            "preset": "andromeda",
+        },
+        web3=SimpleNamespace(
+            eth=SimpleNamespace(contract=lambda address, abi: ("contract", address))
+        ),
+    )
+
+
+def test_deployment_hash_is_cached_and_checked_in_the_background(registry, tmp_path):
+    snx = make_snx()
+    assert sdk_contracts.get_deployment_hash(snx) == "Qm1"
+
+    registry.ipfs_hash = "Qm2"
+    assert sdk_contracts.get_deployment_hash(snx) == "Qm1"
+
+    # the changed deployment is fetched and saved for the next start
+    assert registry.hash_reads == ["Qm1", "Qm2"]
+    assert registry.ipfs_reads == ["Qm2"]
+    assert read_json(str(tmp_path / "deployment_hashes.json")) == {
+        "synthetix-omnibus:latest@8453-andromeda": "Qm2"
+    }
+    assert sdk_contracts.get_deployment_hash(snx) == "Qm2"
+
+
+def test_deployments_are_loaded_from_disk(registry):
+    snx = make_snx()
+
+    fetched = sdk_contracts.fetch_deploy_from_ipfs(snx, "Qm1")
+    cached = sdk_contracts.fetch_deploy_from_ipfs(snx, "Qm1")
+
+    assert registry.ipfs_reads == ["Qm1"]
+    assert "contract" in fetched["CoreProxy"]
+    assert cached["CoreProxy"]["address"] == "0x01"
+    assert cached["CoreProxy"]["contract"] == ("contract", "0x01")
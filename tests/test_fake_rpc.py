@@ -0,0 +1,85 @@
+import threading
+
+import pytest
+from eth_abi import encode
+from eth_utils import encode_hex
+
+from benchmarks.fake_rpc import (
+    ACCOUNT_PROXY_ADDRESS,
+    AGGREGATE_SELECTOR,
+    INJECTED_ERROR,
+    LIQUIDATE_GAS,
+    MULTICALL_ADDRESS,
+    FakePerpsChain,
+    FakeRpcServer,
+    FakeSynthetix,
+    get_selector,
+)
+
+
+@pytest.fixture
+def server():
+    chain = FakePerpsChain(200, active_fraction=0.5, liquidatable_fraction=0.2)
+    server = FakeRpcServer(chain)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def get_url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_multicalls_read_the_fake_chain(server):
+    snx = FakeSynthetix(get_url(server))
+    account_ids = server.chain.account_ids
+
+    can_liquidates = snx.perps.get_can_liquidates(account_ids)
+
+    assert len(server.chain.liquidatable) > 0
+    assert {
+        account_id for account_id, can_liquidate in can_liquidates if can_liquidate
+    } == server.chain.liquidatable
+
+
+def test_transactions_are_mined_immediately(server):
+    snx = FakeSynthetix(get_url(server))
+    block_number = server.chain.block_number
+    account_id = sorted(server.chain.liquidatable)[0]
+
+    receipt = snx.wait(snx.perps.liquidate(account_id, submit=True))
+
+    assert receipt["status"] == 1
+    assert receipt["blockNumber"] == block_number + 1
+    assert receipt["gasUsed"] >= LIQUIDATE_GAS
+
+
+def test_requests_are_counted_until_reset(server):
+    snx = FakeSynthetix(get_url(server))
+    snx.reset_stats()
+
+    snx.perps.get_can_liquidates(server.chain.account_ids[:10])
+    stats = snx.get_stats()
+
+    assert stats["requests"] > 0
+    assert stats["methods"]["eth_call"] >= 1
+    assert "bench_stats" not in stats["methods"]
+
+    snx.reset_stats()
+    assert snx.get_stats()["requests"] == 0
+
+
+def test_injected_errors_fail_multicalls():
+    server = FakeRpcServer(FakePerpsChain(10), error_rate=1)
+    calls = [(ACCOUNT_PROXY_ADDRESS, True, 0, get_selector("totalSupply()"))]
+    data = AGGREGATE_SELECTOR + encode(["(address,bool,uint256,bytes)[]"], [calls])
+    request = {
+        "id": 1,
+        "method": "eth_call",
+        "params": [{"to": MULTICALL_ADDRESS, "data": encode_hex(data)}],
+    }
+
+    assert server.handle(request)["error"] == INJECTED_ERROR
+    server.server_close()
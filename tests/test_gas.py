@@ -0,0 +1,82 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from utils.gas import GasPricer
+
+
+def make_pricer(fee_histories):
+    calls = []
+
+    def fee_history(blocks, newest, percentiles):
+        calls.append(blocks)
+        fee_history = fee_histories.pop(0)
+        if isinstance(fee_history, Exception):
+            raise fee_history
+        return fee_history
+
+    snx = SimpleNamespace(
+        logger=logging.getLogger("test"),
+        web3=SimpleNamespace(eth=SimpleNamespace(fee_history=fee_history)),
+    )
+    return GasPricer(snx), calls
+
+
+def make_history(base_fee, rewards):
+    return {"baseFeePerGas": [base_fee - 1, base_fee], "reward": rewards}
+
+
+def test_fees_use_the_median_of_the_urgency_percentile():
+    rewards = [[1, 2, 3, 4, 5], [11, 12, 13, 14, 15], [21, 22, 23, 24, 25], []]
+    pricer, _ = make_pricer([make_history(100, rewards)])
+    pricer.update(1)
+
+    assert pricer.get_fees("liquidation") == {
+        "maxFeePerGas": 215,
+        "maxPriorityFeePerGas": 15,
+    }
+    assert pricer.get_fees("swap") == {
+        "maxFeePerGas": 137,
+        "maxPriorityFeePerGas": 12,
+    }
+
+
+def test_fees_are_updated_once_per_block():
+    pricer, calls = make_pricer([make_history(100, []), make_history(200, [])])
+
+    pricer.update(1)
+    pricer.update(1)
+    pricer.update(2)
+
+    assert len(calls) == 2
+    assert pricer.base_fee == 200
+
+
+def test_failed_refreshes_keep_the_last_fees():
+    pricer, _ = make_pricer([make_history(100, []), ValueError("rpc error")])
+
+    pricer.refresh(1)
+    pricer.refresh(2)
+
+    assert pricer.base_fee == 100
+    assert pricer.block_number == 1
+
+
+def test_replacement_fees_bump_or_match_the_current_fees():
+    pricer, _ = make_pricer([make_history(100, [[0, 0, 0, 50, 0]])])
+    pricer.update(1)
+
+    assert pricer.get_replacement_fees(
+        {"maxFeePerGas": 1000, "maxPriorityFeePerGas": 10}, "settlement"
+    ) == {"maxFeePerGas": 1125, "maxPriorityFeePerGas": 50}
+
+
+def test_apply_replaces_legacy_gas_price():
+    pricer, _ = make_pricer([make_history(100, [[1, 2, 3, 4, 5]])])
+    pricer.update(1)
+    tx_params = pricer.apply({"gasPrice": 7}, "price_update")
+
+    assert "gasPrice" not in tx_params
+    assert tx_params["maxFeePerGas"] == 153
+    assert pricer.estimate_cost(10**18, "price_update") == pytest.approx(103)
@@ -0,0 +1,76 @@
+import logging
+from types import SimpleNamespace
+
+from utils import perps_l1
+
+
+def make_snx():
+    return SimpleNamespace(
+        logger=logging.getLogger("test"),
+        perps=SimpleNamespace(market_proxy="proxy", markets_by_id={}),
+    )
+
+
+def test_positions_and_margins_are_checked_together(monkeypatch, fake_plan):
+    monkeypatch.setattr(perps_l1, "ReadPlan", fake_plan)
+    fake_plan.results = {
+        "isPositionLiquidatable": {
+            (1, 100): True,
+            (2, 100): False,
+            (3, 100): True,
+            (4, 100): False,
+        }.get,
+        "isMarginLiquidatable": {
+            (1, 100): True,
+            (2, 100): True,
+            (3, 100): None,
+            (4, 100): False,
+        }.get,
+    }
+
+    positions, margins, failed = perps_l1.get_liquidatable_positions(
+        make_snx(), [(1, 100), (2, 100), (3, 100), (4, 100)]
+    )
+
+    assert positions == [(1, 100), (3, 100)]
+    assert margins == [(2, 100)]
+    assert failed == []
+
+
+def test_failed_checks_are_returned(monkeypatch, fake_plan):
+    monkeypatch.setattr(perps_l1, "ReadPlan", fake_plan)
+    fake_plan.results = {
+        "isPositionLiquidatable": {(1, 100): None, (2, 100): False}.get,
+        "isMarginLiquidatable": {(1, 100): False, (2, 100): None}.get,
+    }
+
+    positions, margins, failed = perps_l1.get_liquidatable_positions(
+        make_snx(), [(1, 100), (2, 100), (3, 100)]
+    )
+
+    assert positions == [] and margins == []
+    assert failed == [(1, 100), (2, 100), (3, 100)]
+
+
+def test_margins_are_liquidated_without_flagging(monkeypatch):
+    sent = []
+    monkeypatch.setattr(
+        perps_l1,
+        "build_liquidation_tx",
+        lambda snx, account_id, market_id: ("liquidatePosition", account_id),
+    )
+    monkeypatch.setattr(
+        perps_l1,
+        "write_erc7412",
+        lambda snx, contract, fn_name, args: (fn_name, args[0]),
+    )
+    monkeypatch.setattr(
+        perps_l1,
+        "simulate_transactions",
+        lambda snx, txs, estimate_gas=False: (list(range(len(txs))), None),
+    )
+    pipeline = SimpleNamespace(submit=lambda tx, urgency=None: sent.append(tx))
+
+    perps_l1.liquidate_positions(make_snx(), [(1, 100)], [(2, 100)], pipeline=pipeline)
+
+    assert sent == [("liquidatePosition", 1), ("liquidateMarginOnly", 2)]
@@ -0,0 +1,61 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils import parallel
+from utils.parallel import map_chunks
+
+
+def make_snx(uri):
+    return SimpleNamespace(
+        web3=SimpleNamespace(provider=SimpleNamespace(endpoint_uri=uri))
+    )
+
+
+def test_map_chunks_keeps_the_input_order():
+    snx = make_snx("http://order")
+
+    def fn(chunk):
+        # later chunks finish first
+        time.sleep(0.01 * (10 - chunk[0] // 10))
+        return [item * 2 for item in chunk]
+
+    results = map_chunks(
+        snx, fn, list(range(100)), function_name="order", chunk_size=10
+    )
+
+    assert results == [item * 2 for item in range(100)]
+
+
+def test_map_chunks_limits_requests_in_flight(monkeypatch):
+    monkeypatch.setattr(parallel, "MAX_IN_FLIGHT", 2)
+    snx = make_snx("http://limited")
+    lock = threading.Lock()
+    in_flight = [0, 0]
+
+    def fn(chunk):
+        with lock:
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight[1], in_flight[0])
+        time.sleep(0.02)
+        with lock:
+            in_flight[0] -= 1
+        return chunk
+
+    map_chunks(snx, fn, list(range(40)), function_name="limited", chunk_size=5)
+
+    assert in_flight[1] == 2
+
+
+def test_map_chunks_handles_no_items():
+    assert map_chunks(make_snx("http://empty"), lambda chunk: chunk, []) == []
+
+
+def test_map_chunks_raises_chunk_errors():
+    def fn(chunk):
+        raise ValueError("execution reverted")
+
+    with pytest.raises(ValueError):
+        map_chunks(make_snx("http://error"), fn, list(range(10)), chunk_size=5)
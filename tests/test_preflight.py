@@ -0,0 +1,57 @@
+import logging
+from types import SimpleNamespace
+
+from utils.preflight import filter_calls, simulate_transactions
+
+MULTICALL = "0x00000000000000000000000000000000000000ca"
+
+
+class FakeAggregate:
+    def __init__(self, multicall, calls):
+        self.multicall = multicall
+        self.calls = calls
+
+    def call(self, tx_params):
+        return [(call[3] not in self.multicall.failing, b"") for call in self.calls]
+
+    def estimate_gas(self, tx_params):
+        self.multicall.estimated.append(self.calls)
+        return 1000 * len(self.calls)
+
+
+def make_snx(failing=()):
+    multicall = SimpleNamespace(address=MULTICALL, failing=set(failing), estimated=[])
+    multicall.functions = SimpleNamespace(
+        aggregate3Value=lambda calls: FakeAggregate(multicall, calls)
+    )
+    return SimpleNamespace(
+        logger=logging.getLogger("test"),
+        address="0x00000000000000000000000000000000000000aa",
+        multicall=multicall,
+        gas_multiplier=2,
+    )
+
+
+def make_tx(data):
+    return {"to": "0x00000000000000000000000000000000000000bb", "data": data}
+
+
+def test_filter_calls_keeps_the_passing_calls():
+    snx = make_snx(failing=["b"])
+    calls = [(MULTICALL, False, 0, data) for data in ["a", "b", "c"]]
+
+    assert filter_calls(snx, calls) == [0, 2]
+    assert filter_calls(snx, calls, setup_calls=calls[:1]) == [0, 2]
+
+
+def test_simulate_transactions_estimates_the_gas_of_the_passing_ones():
+    snx = make_snx(failing=["b"])
+    txs = [make_tx(data) for data in ["a", "b", "c"]]
+
+    assert simulate_transactions(snx, txs) == ([0, 2], None)
+    assert snx.multicall.estimated == []
+
+    passing_indexes, gas = simulate_transactions(snx, txs, estimate_gas=True)
+    assert passing_indexes == [0, 2]
+    assert [call[3] for call in snx.multicall.estimated[0]] == ["a", "c"]
+    assert gas == 2 * 2000
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from utils.price_cache import PriceCache, install_price_cache
+
+
+def make_snx(responses=None):
+    fetches = []
+
+    def get_price_from_ids(feed_ids, publish_time=None):
+        fetches.append((tuple(feed_ids), publish_time))
+        if responses is not None:
+            return responses.pop(0)
+        return {
+            "timestamp": 1,
+            "price_update_data": [f"{','.join(feed_ids)}@{publish_time}"],
+            "meta": {feed_id: {"publish_time": publish_time} for feed_id in feed_ids},
+        }
+
+    snx = SimpleNamespace(pyth=SimpleNamespace(get_price_from_ids=get_price_from_ids))
+    install_price_cache(snx, PriceCache())
+    return snx, fetches
+
+
+def test_prices_are_cached_per_feed_and_publish_time():
+    snx, fetches = make_snx()
+
+    snx.pyth.get_price_from_ids(["0xeth", "0xbtc"])
+    snx.pyth.get_price_from_ids(["0xeth"], publish_time=100)
+    pyth_data = snx.pyth.get_price_from_ids(["0xbtc", "0xsol"], publish_time=100)
+    snx.pyth.get_price_from_ids(["0xsol"], publish_time=100)
+
+    assert fetches == [
+        (("0xeth", "0xbtc"), None),
+        (("0xeth",), 100),
+        (("0xbtc", "0xsol"), 100),
+    ]
+    assert pyth_data["price_update_data"] == ["0xbtc,0xsol@100"]
+    assert set(pyth_data["meta"]) == {"0xbtc", "0xsol"}
+
+
+def test_failed_fetches_are_not_cached():
+    snx, fetches = make_snx(
+        responses=[None, {"timestamp": 1, "price_update_data": [b""], "meta": {}}]
+    )
+
+    assert snx.pyth.get_price_from_ids(["0xeth"]) is None
+    assert snx.pyth.get_price_from_ids(["0xeth"]) is not None
+    assert len(fetches) == 2
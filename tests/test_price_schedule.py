@@ -0,0 +1,35 @@
+from utils.price_schedule import PriceSchedule
+
+
+def test_due_feeds_are_popped_in_deadline_order():
+    schedule = PriceSchedule(staleness_tolerance=100)
+    schedule.update("eth", 50)
+    schedule.update("btc", 10)
+    schedule.update("sol", 500)
+
+    assert schedule.next_deadline() == 110
+    assert schedule.pop_due(150) == ["btc", "eth"]
+    assert schedule.next_deadline() == 600
+    assert "eth" not in schedule.deadlines
+
+
+def test_updates_replace_the_previous_deadline():
+    schedule = PriceSchedule(staleness_tolerance=100)
+    schedule.update("eth", 10)
+    schedule.update("btc", 20)
+    schedule.update("eth", 200)
+
+    assert schedule.next_deadline() == 120
+    assert schedule.pop_due(150) == ["btc"]
+    assert schedule.pop_due(300) == ["eth"]
+    assert schedule.next_deadline() is None
+
+
+def test_popped_feeds_can_be_scheduled_again():
+    schedule = PriceSchedule(staleness_tolerance=100)
+    schedule.update("eth", 10)
+
+    assert schedule.pop_due(110) == ["eth"]
+    schedule.update("eth", 10)
+
+    assert schedule.pop_due(110) == ["eth"]
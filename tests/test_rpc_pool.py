@@ -0,0 +1,44 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.rpc_pool import RpcPool
+
+
+def test_reads_are_limited_per_endpoint(monkeypatch):
+    pool = RpcPool(
+        "http://primary", ["http://reader"], max_in_flight=1, min_hedge_delay=10
+    )
+    assert pool.max_in_flight == 2
+
+    lock = threading.Lock()
+    in_flight = {}
+    peaks = {}
+
+    def post(endpoint, request_data):
+        with lock:
+            in_flight[endpoint.uri] = in_flight.get(endpoint.uri, 0) + 1
+            peaks[endpoint.uri] = max(
+                peaks.get(endpoint.uri, 0), in_flight[endpoint.uri]
+            )
+        time.sleep(0.05)
+        with lock:
+            in_flight[endpoint.uri] -= 1
+        request = json.loads(request_data)
+        return json.dumps(
+            {"jsonrpc": "2.0", "id": request["id"], "result": "0x1"}
+        ).encode()
+
+    for endpoint in pool.readers:
+        monkeypatch.setattr(
+            endpoint, "post", lambda data, endpoint=endpoint: post(endpoint, data)
+        )
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        results = list(
+            executor.map(lambda _: pool.make_request("eth_blockNumber", []), range(8))
+        )
+
+    assert all(result["result"] == "0x1" for result in results)
+    assert peaks == {"http://primary": 1, "http://reader": 1}
@@ -0,0 +1,70 @@
+import pytest
+
+from utils.accounts import new_account_index
+from utils.screening import MarginScreen
+
+
+def make_screen(num_accounts, sweep_blocks):
+    account_index = new_account_index()
+    for account_id in range(num_accounts):
+        account_index["margins"][account_id] = {
+            "margin": 100.0 if account_id > 0 else 1.0,
+            "required": 10.0,
+            "positions": [[1, 1.0, 100.0]],
+        }
+    screen = MarginScreen(sweep_blocks=sweep_blocks)
+    screen.load(account_index, list(range(num_accounts)))
+    return screen
+
+
+def test_critical_accounts_are_due_every_block():
+    screen = make_screen(10, sweep_blocks=0)
+
+    assert screen.get_due_accounts({1: 100.0}) == [0]
+    assert screen.get_due_accounts({1: 100.0}) == [0]
+
+
+def test_sweep_checks_every_healthy_account_within_sweep_blocks():
+    screen = make_screen(10, sweep_blocks=4)
+
+    checked = set()
+    for _ in range(4):
+        due_accounts = screen.get_due_accounts({1: 100.0})
+        assert 0 in due_accounts
+        assert len(due_accounts) <= 4
+        checked.update(due_accounts)
+    assert checked == set(range(10))
+
+
+def test_warning_accounts_are_due_when_the_warning_band_is_checked():
+    account_index = new_account_index()
+    # health of 1.1, 1.5 and 10 at the recorded prices
+    for account_id, margin in [(1, 11.0), (2, 15.0), (3, 100.0)]:
+        account_index["margins"][account_id] = {
+            "margin": margin,
+            "required": 10.0,
+            "positions": [[1, 1.0, 100.0]],
+        }
+    screen = MarginScreen(sweep_blocks=0)
+    screen.load(account_index, [1, 2, 3, 4])
+
+    # account 4 has no recorded margins and is always checked
+    assert screen.get_due_accounts({1: 100.0}) == [4, 1]
+    assert screen.get_due_accounts({1: 100.0}, check_warning=True) == [4, 1, 2]
+
+
+def test_price_moves_change_the_estimated_health():
+    screen = make_screen(3, sweep_blocks=0)
+
+    # a long position of 1 at 100 with a margin of 100 and 10 required
+    account_ids, health = screen.estimate_health({1: 20.0})
+    assert account_ids == [0, 1, 2]
+    assert health[1] == pytest.approx((100.0 - 80.0) / (10.0 * 0.2))
+
+
+def test_liquidatable_accounts_stay_due_until_the_next_load():
+    screen = make_screen(3, sweep_blocks=0)
+
+    screen.mark_due([2])
+
+    assert screen.get_due_accounts({1: 100.0}) == [0, 2]
@@ -0,0 +1,185 @@
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from utils import perps_l1, perps_v3
+
+PRICE_SERVICE = "https://hermes.example"
+
+
+class FakeProxy:
+    address = "0x0000000000000000000000000000000000000001"
+
+    def encodeABI(self, fn_name, args):
+        return (fn_name, tuple(args))
+
+
+def make_snx(markets, orders, market_meta=None):
+    transactions = []
+    perps = SimpleNamespace(
+        markets_by_id=markets,
+        market_proxy=FakeProxy(),
+        get_order=lambda account_id, market_id=None: orders[account_id],
+    )
+    if market_meta is not None:
+        perps.market_meta = market_meta
+
+    def execute_transaction(tx):
+        transactions.append(tx)
+        return "0xhash"
+
+    return SimpleNamespace(
+        logger=logging.getLogger("test"),
+        perps=perps,
+        transactions=transactions,
+        execute_transaction=execute_transaction,
+        wait=lambda tx_hash: {"status": 1},
+    )
+
+
+@pytest.fixture
+def settled(monkeypatch):
+    """Patch the network calls of both modules and record what they are given"""
+    record = {"fetches": [], "singles": [], "filtered": set(), "batches": []}
+
+    def fetch_price_update_data(
+        endpoint, feed_ids, publish_time=None, price_cache=None
+    ):
+        record["fetches"].append((tuple(feed_ids), publish_time))
+        return [f"update@{publish_time}"]
+
+    def filter_calls(snx, calls, setup_calls=None):
+        return [
+            ind for ind, call in enumerate(calls) if call[3] not in record["filtered"]
+        ]
+
+    def settle_perps_order(snx, event, pipeline=None, tracer=None):
+        record["singles"].append(event["accountId"])
+
+    def write_erc7412(snx, contract, fn_name, args, calls=None):
+        record["batches"].append((fn_name, args, calls))
+        return {"maxFeePerGas": 1}
+
+    def build_aggregate_transaction(snx, calls):
+        record["batches"].append(calls)
+        return {"maxFeePerGas": 1}
+
+    for module in (perps_v3, perps_l1):
+        monkeypatch.setattr(module, "fetch_price_update_data", fetch_price_update_data)
+        monkeypatch.setattr(module, "filter_calls", filter_calls)
+        monkeypatch.setattr(module, "settle_perps_order", settle_perps_order)
+    monkeypatch.setattr(perps_v3, "write_erc7412", write_erc7412)
+    monkeypatch.setattr(
+        perps_v3,
+        "build_oracle_fulfillment_call",
+        lambda snx, feed_ids, publish_time, data: ("oracle", publish_time),
+    )
+    monkeypatch.setattr(perps_l1, "get_update_fee", lambda snx, data: 1)
+    monkeypatch.setattr(
+        perps_l1, "build_aggregate_transaction", build_aggregate_transaction
+    )
+    return record
+
+
+V3_MARKETS = {
+    100: {"market_name": "ETH", "feed_id": "0xeth"},
+    200: {"market_name": "BTC", "feed_id": "0xbtc"},
+}
+
+
+def v3_order(commitment_time=1000, price_delay=2):
+    return {
+        "size_delta": 1,
+        "commitment_time": commitment_time,
+        "settlement_strategy": {"commitment_price_delay": price_delay},
+    }
+
+
+def test_v3_batch_groups_orders_by_expected_price_time(settled):
+    snx = make_snx(V3_MARKETS, {1: v3_order(), 2: v3_order(), 3: v3_order()})
+    events = [
+        {"accountId": 1, "marketId": 100, "expectedPriceTime": 1002},
+        {"accountId": 2, "marketId": 200, "expectedPriceTime": 1002},
+        {"accountId": 3, "marketId": 100, "expectedPriceTime": 1005},
+    ]
+
+    perps_v3.settle_perps_orders(snx, events, price_service_endpoint=PRICE_SERVICE)
+
+    assert sorted(settled["fetches"]) == [
+        (("0xbtc", "0xeth"), 1002),
+        (("0xeth",), 1005),
+    ]
+    assert settled["singles"] == []
+    [(fn_name, args, calls)] = settled["batches"]
+    assert (fn_name, args) == ("settleOrder", [3])
+    assert ("oracle", 1002) in calls and ("oracle", 1005) in calls
+    assert len(snx.transactions) == 1
+
+
+def test_v3_batch_falls_back_to_the_order_strategy(settled):
+    snx = make_snx(V3_MARKETS, {1: v3_order(1000, 3), 2: v3_order(1001, 3)})
+    events = [
+        {"accountId": 1, "marketId": 100, "commitmentTime": 1000},
+        {"accountId": 2, "marketId": 200, "commitmentTime": 1001},
+    ]
+
+    perps_v3.settle_perps_orders(snx, events, price_service_endpoint=PRICE_SERVICE)
+
+    assert sorted(settled["fetches"]) == [(("0xbtc",), 1004), (("0xeth",), 1003)]
+    assert len(settled["batches"]) == 1
+
+
+def test_v3_orders_failing_preflight_are_settled_one_by_one(settled):
+    settled["filtered"].add(("settleOrder", (2,)))
+    snx = make_snx(V3_MARKETS, {1: v3_order(), 2: v3_order(), 3: v3_order()})
+    events = [
+        {"accountId": account_id, "marketId": 100, "expectedPriceTime": 1002}
+        for account_id in (1, 2, 3)
+    ]
+
+    perps_v3.settle_perps_orders(snx, events, price_service_endpoint=PRICE_SERVICE)
+
+    [(_, args, calls)] = settled["batches"]
+    assert args == [3]
+    assert ("settleOrder", (2,)) not in calls
+    assert settled["singles"] == [2]
+
+
+def test_bfp_batch_prices_orders_after_their_commitment(settled):
+    markets = {100: {"market_name": "ETH", "feed_id": "0xeth"}}
+    market_meta = {100: {"system_config": {"pyth_publish_time_min": 4}}}
+    orders = {
+        account_id: {"size_delta": 1, "is_stale": False, "commitment_time": time}
+        for account_id, time in ((1, 1000), (2, 1000), (3, 1010))
+    }
+    snx = make_snx(markets, orders, market_meta=market_meta)
+    events = [{"accountId": account_id, "marketId": 100} for account_id in orders]
+
+    perps_l1.settle_perps_orders(snx, events, price_service_endpoint=PRICE_SERVICE)
+
+    assert sorted(settled["fetches"]) == [(("0xeth",), 1004), (("0xeth",), 1014)]
+    [calls] = settled["batches"]
+    assert [call[3][1] for call in calls] == [
+        (1, 100, "update@1004"),
+        (2, 100, "update@1004"),
+        (3, 100, "update@1014"),
+    ]
+
+
+def test_bfp_orders_failing_preflight_are_settled_one_by_one(settled):
+    settled["filtered"].add(("settleOrder", (1, 100, "update@1004")))
+    markets = {100: {"market_name": "ETH", "feed_id": "0xeth"}}
+    market_meta = {100: {"system_config": {"pyth_publish_time_min": 4}}}
+    orders = {
+        account_id: {"size_delta": 1, "is_stale": False, "commitment_time": 1000}
+        for account_id in (1, 2)
+    }
+    snx = make_snx(markets, orders, market_meta=market_meta)
+    events = [{"accountId": account_id, "marketId": 100} for account_id in orders]
+
+    perps_l1.settle_perps_orders(snx, events, price_service_endpoint=PRICE_SERVICE)
+
+    [calls] = settled["batches"]
+    assert len(calls) == 1
+    assert settled["singles"] == [1]
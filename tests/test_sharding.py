@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from utils.sharding import Shard, claim_signer, get_signer_path
+from utils.snapshot import read_json, write_json
+
+
+def test_shards_must_not_share_a_signer(tmp_path):
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xAAAA")
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 2), "0xbbbb")
+
+    with pytest.raises(ValueError):
+        claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 2), "0xaaaa")
+
+
+def test_conflicting_claims_are_not_written(tmp_path):
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xaaaa")
+
+    with pytest.raises(ValueError):
+        claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 2), "0xaaaa")
+
+    # the first shard can still restart with its signer
+    assert read_json(get_signer_path(tmp_path, "perps_v3", 8453, 1)) is None
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xaaaa")
+
+
+def test_claims_of_another_shard_count_are_ignored(tmp_path):
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 3), "0xaaaa")
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xaaaa")
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 1), "0xaaaa")
+
+
+def test_claims_recorded_for_another_index_are_ignored(tmp_path):
+    write_json(
+        get_signer_path(tmp_path, "perps_v3", 8453, 1),
+        {
+            "address": "0xaaaa",
+            "shard_index": 0,
+            "shard_count": 2,
+            "claimed_at": time.time(),
+        },
+    )
+
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xaaaa")
+
+
+def test_expired_claims_are_ignored(tmp_path):
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(0, 2), "0xaaaa")
+
+    with pytest.raises(ValueError):
+        claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 2), "0xaaaa", ttl=60)
+    claim_signer(tmp_path, "perps_v3", 8453, Shard(1, 2), "0xaaaa", ttl=-1)
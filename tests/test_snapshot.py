@@ -0,0 +1,75 @@
+import json
+
+from utils.accounts import new_account_index
+from utils.snapshot import (
+    SNAPSHOT_VERSION,
+    get_snapshot_path,
+    load_snapshot,
+    read_json,
+    save_snapshot,
+    write_json,
+)
+
+
+def make_index():
+    account_index = new_account_index()
+    account_index["cursor"] = 3
+    account_index["account_ids"] = [1, 2, 3]
+    account_index["values"] = {1: 10**18, 2: 0}
+    account_index["margins"] = {
+        1: {"margin": 10.0, "required": 1.0, "positions": [[100, 1.0, 2000.0]]},
+        (2, 100): {"margin": 5.0, "required": 1.0, "positions": []},
+    }
+    account_index["markets"] = {2: [100]}
+    account_index["dead_offset"] = 1
+    return account_index
+
+
+def test_json_round_trip(tmp_path):
+    path = str(tmp_path / "nested" / "data.json")
+
+    write_json(path, {"a": [1, 2]})
+
+    assert read_json(path) == {"a": [1, 2]}
+    assert not (tmp_path / "nested" / "data.json.tmp").exists()
+
+
+def test_read_json_ignores_missing_and_partial_files(tmp_path):
+    path = tmp_path / "data.json"
+    assert read_json(str(path)) is None
+
+    path.write_text('{"a": ')
+    assert read_json(str(path)) is None
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = get_snapshot_path(str(tmp_path), "perps_v3", 8453)
+    account_index = make_index()
+
+    save_snapshot(path, 8453, 1234, account_index)
+    loaded_index, block_number = load_snapshot(path, 8453)
+
+    assert block_number == 1234
+    assert loaded_index == account_index
+
+
+def test_snapshots_of_another_version_or_network_are_ignored(tmp_path):
+    path = get_snapshot_path(str(tmp_path), "perps_v3", 8453)
+    save_snapshot(path, 8453, 1234, make_index())
+
+    assert load_snapshot(path, 10) == (None, None)
+
+    with open(path) as f:
+        snapshot = json.load(f)
+    snapshot["version"] = SNAPSHOT_VERSION - 1
+    write_json(path, snapshot)
+    assert load_snapshot(path, 8453) == (None, None)
+
+
+def test_shards_keep_separate_snapshots():
+    assert get_snapshot_path("snapshots", "perps_v3", 8453) == get_snapshot_path(
+        "snapshots", "perps_v3", 8453, 0
+    )
+    assert get_snapshot_path("snapshots", "perps_v3", 8453, 1).endswith(
+        "perps_v3_8453_shard1.json"
+    )
@@ -0,0 +1,104 @@
+import logging
+import threading
+from types import SimpleNamespace
+
+from utils.tasks import BlockInterval, TaskScheduler, task_priority, wait_for_priority
+
+
+def make_scheduler(background=False):
+    return TaskScheduler(
+        SimpleNamespace(logger=logging.getLogger("test")), background=background
+    )
+
+
+def test_intervals_are_due_on_multiples_and_catch_up_once():
+    interval = BlockInterval(10)
+
+    assert not interval.is_due(3)
+    assert interval.is_due(10)
+    assert interval.is_due(27)
+    assert interval.get_lag(27) == 17
+
+    interval.complete(27)
+    assert not interval.is_due(29)
+    assert interval.is_due(30)
+
+
+def test_jobs_run_for_the_latest_block():
+    scheduler = make_scheduler()
+    scheduler.add_lane("accounts", priority=2)
+    runs = []
+    scheduler.add_job("refresh", runs.append, "accounts", blocks=10)
+
+    for block_number in [5, 10, 11, 35]:
+        scheduler.on_block(block_number)
+
+    assert runs == [10, 35]
+
+
+def test_blocks_older_than_the_head_are_dropped():
+    scheduler = make_scheduler()
+    scheduler.add_lane("liquidation", priority=1)
+    runs = []
+    scheduler.add_job("liquidation", runs.append, "liquidation")
+
+    scheduler.on_block(10)
+    scheduler.on_block(9)
+    scheduler.on_block(10)
+
+    assert runs == [10]
+    assert scheduler.is_stale(10)
+    assert not scheduler.is_stale(11)
+
+
+def test_waiting_tasks_are_replaced_by_the_latest():
+    scheduler = make_scheduler(background=True)
+    scheduler.add_lane("prices", priority=0)
+    release = threading.Event()
+    done = threading.Event()
+    runs = []
+
+    def task(value):
+        if value == "first":
+            release.wait(5)
+        runs.append(value)
+        if value == "third":
+            done.set()
+
+    assert scheduler.submit("prices", task, "first")
+    assert not scheduler.submit("prices", task, "second")
+    assert not scheduler.submit("prices", task, "third")
+    release.set()
+
+    assert done.wait(5)
+    assert runs == ["first", "third"]
+
+
+def test_tasks_with_other_keys_are_not_replaced():
+    scheduler = make_scheduler(background=True)
+    scheduler.add_lane("prices", priority=0)
+    release = threading.Event()
+    finished = threading.Semaphore(0)
+    runs = []
+
+    def task(value):
+        if value == "first":
+            release.wait(5)
+        runs.append(value)
+        finished.release()
+
+    scheduler.submit("prices", task, "first")
+    scheduler.submit("prices", task, "second", key="feeds")
+    scheduler.submit("prices", task, "third")
+    release.set()
+
+    for _ in range(3):
+        assert finished.acquire(timeout=5)
+    assert runs == ["first", "second", "third"]
+
+
+def test_lower_priorities_wait_for_running_tasks():
+    with task_priority(0):
+        assert wait_for_priority(0, timeout=0)
+        assert not wait_for_priority(1, timeout=0)
+    assert wait_for_priority(1, timeout=0)
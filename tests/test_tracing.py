@@ -0,0 +1,79 @@
+import json
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from utils import tracing
+from utils.tracing import SettlementTracer
+
+
+class Event(dict):
+    def __init__(self, block_number, **args):
+        super().__init__(**args)
+        self.block_number = block_number
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000)
+    monkeypatch.setattr(tracing, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def make_tracer(trace_path=None):
+    snx = SimpleNamespace(
+        logger=logging.getLogger("test"),
+        perps=SimpleNamespace(markets_by_id={100: {"market_name": "ETH"}}),
+        web3=SimpleNamespace(to_hex=lambda tx_hash: tx_hash),
+    )
+    return SettlementTracer(snx, trace_path=trace_path)
+
+
+def test_stages_are_timed_from_commitment_to_receipt(clock, tmp_path):
+    trace_path = tmp_path / "traces.jsonl"
+    tracer = make_tracer(str(trace_path))
+    event = Event(7, accountId=1, marketId=100, commitmentTime=998)
+
+    tracer.start(event)
+    clock.now = 1003
+    tracer.mark([event], "delay_wait")
+    clock.now = 1004
+    tracer.mark([event], "submit")
+    clock.now = 1010
+    tracer.finish([event], {"transactionHash": "0xabc", "status": 1})
+
+    (trace,) = [json.loads(line) for line in trace_path.read_text().splitlines()]
+    assert trace["market_name"] == "ETH"
+    assert trace["tx_hash"] == "0xabc"
+    assert trace["stages"] == {
+        "event_lag": 2,
+        "delay_wait": 3,
+        "submit": 1,
+        "inclusion": 6,
+        "total": 12,
+    }
+    assert tracer.summarize()["ETH"]["total"] == {"p50": 12, "p99": 12, "count": 1}
+
+
+def test_orders_are_traced_by_commitment_block(clock):
+    tracer = make_tracer()
+    first_event = Event(7, accountId=1, marketId=100, commitmentTime=1000)
+    second_event = Event(8, accountId=1, marketId=100, commitmentTime=1000)
+
+    tracer.start(first_event)
+    tracer.start(second_event)
+    tracer.discard([first_event])
+    tracer.finish([first_event, second_event], {"transactionHash": "0x", "status": 1})
+
+    assert tracer.summarize()["ETH"]["inclusion"]["count"] == 1
+
+
+def test_orders_without_commitment_time_skip_the_event_lag(clock):
+    tracer = make_tracer()
+    event = Event(7, accountId=1, marketId=200)
+
+    tracer.start(event)
+    tracer.finish([event], {"transactionHash": "0x", "status": 0})
+
+    assert set(tracer.summarize()["200"]) == {"inclusion"}
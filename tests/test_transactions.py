@@ -0,0 +1,165 @@
+import logging
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils.transactions import CANCEL_GAS, TransactionPipeline
+
+ADDRESS = "0x00000000000000000000000000000000000000aa"
+TARGET = "0x00000000000000000000000000000000000000bb"
+
+
+class FakeEth:
+    def __init__(self):
+        self.pending_nonce = 0
+        self.mined_nonce = 0
+        self.sent = []
+        self.receipts = {}
+        self.errors = {}
+        self.on_send = None
+        self._lock = threading.Lock()
+
+    def get_transaction_count(self, address, block):
+        return self.pending_nonce if block == "pending" else self.mined_nonce
+
+    def send_transaction(self, tx_params):
+        if self.on_send is not None:
+            on_send, self.on_send = self.on_send, None
+            on_send()
+        error = self.errors.pop(tx_params["nonce"], None)
+        if error is not None:
+            raise error
+        with self._lock:
+            self.sent.append(dict(tx_params))
+            return f"0x{len(self.sent):064x}"
+
+    def get_transaction_receipt(self, tx_hash):
+        if tx_hash not in self.receipts:
+            raise Exception(f"Transaction {tx_hash} not found")
+        return self.receipts[tx_hash]
+
+
+def make_pipeline():
+    eth = FakeEth()
+    snx = SimpleNamespace(
+        logger=logging.getLogger("test"),
+        address=ADDRESS,
+        rpc_signers=[ADDRESS],
+        use_estimate_gas=False,
+        web3=SimpleNamespace(eth=eth, to_hex=lambda tx_hash: tx_hash),
+    )
+    # the watcher thread is left idle, polls are run by the tests
+    return eth, TransactionPipeline(snx, replace_after=30, poll_interval=3600)
+
+
+def make_tx(**tx_params):
+    return dict(
+        {"from": ADDRESS, "to": TARGET, "data": "0x", "gas": 100000}, **tx_params
+    )
+
+
+def test_concurrent_submits_get_distinct_nonces():
+    eth, pipeline = make_pipeline()
+    threads = [
+        threading.Thread(target=pipeline.submit, args=(make_tx(),)) for _ in range(20)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(tx["nonce"] for tx in eth.sent) == list(range(20))
+    assert pipeline.pending_count() == 20
+
+
+def test_failed_send_reuses_its_nonce():
+    eth, pipeline = make_pipeline()
+    eth.errors[0] = ValueError("insufficient funds")
+
+    with pytest.raises(ValueError):
+        pipeline.submit(make_tx())
+    pipeline.submit(make_tx())
+
+    assert [tx["nonce"] for tx in eth.sent] == [0]
+    assert pipeline.pending_count() == 1
+
+
+def test_failed_send_fills_the_gap_before_later_nonces():
+    eth, pipeline = make_pipeline()
+    eth.errors[0] = ValueError("insufficient funds")
+    # a second transaction takes the next nonce while the first is sending
+    eth.on_send = lambda: pipeline.submit(make_tx())
+
+    with pytest.raises(ValueError):
+        pipeline.submit(make_tx(maxFeePerGas=100, maxPriorityFeePerGas=10))
+
+    fill_tx = eth.sent[-1]
+    assert [tx["nonce"] for tx in eth.sent] == [1, 0]
+    assert fill_tx["to"] == ADDRESS
+    assert fill_tx["gas"] == CANCEL_GAS
+    assert fill_tx["maxFeePerGas"] == 100
+    assert pipeline.pending_count() == 2
+
+
+def test_nonce_too_low_resyncs_with_the_chain():
+    eth, pipeline = make_pipeline()
+    eth.pending_nonce = 3
+    eth.errors[0] = ValueError("nonce too low")
+
+    with pytest.raises(ValueError):
+        pipeline.submit(make_tx())
+    pipeline.submit(make_tx())
+
+    assert [tx["nonce"] for tx in eth.sent] == [3]
+
+
+def test_stuck_transactions_are_replaced_with_bumped_fees():
+    eth, pipeline = make_pipeline()
+    tx_hash = pipeline.submit(make_tx(maxFeePerGas=1000, maxPriorityFeePerGas=100))
+    pipeline._pending[0]["sent_at"] = time.time() - 60
+
+    pipeline._poll()
+
+    replacement_tx = eth.sent[-1]
+    assert len(eth.sent) == 2
+    assert replacement_tx["nonce"] == 0
+    assert replacement_tx["maxFeePerGas"] == 1125
+    assert replacement_tx["maxPriorityFeePerGas"] == 112
+
+    eth.receipts[f"0x{2:064x}"] = {"status": 1, "gasUsed": 21000}
+    pipeline._poll()
+
+    assert pipeline.wait(tx_hash, timeout=1)["status"] == 1
+    assert pipeline.pending_count() == 0
+
+
+def test_failed_replacements_back_off_and_bump_again():
+    eth, pipeline = make_pipeline()
+    pipeline.submit(make_tx(maxFeePerGas=1000, maxPriorityFeePerGas=100))
+    pipeline._pending[0]["sent_at"] = time.time() - 60
+    eth.errors[0] = ValueError("replacement transaction underpriced")
+
+    pipeline._poll()
+    pipeline._poll()
+
+    assert len(eth.sent) == 1
+    assert pipeline._pending[0]["sent_at"] > time.time() - 30
+
+    pipeline._pending[0]["sent_at"] = time.time() - 60
+    pipeline._poll()
+
+    assert eth.sent[-1]["maxFeePerGas"] == 1265
+
+
+def test_nonces_used_elsewhere_release_their_waiters():
+    eth, pipeline = make_pipeline()
+    tx_hash = pipeline.submit(make_tx())
+    eth.mined_nonce = 1
+
+    pipeline._poll()
+
+    assert pipeline.pending_count() == 0
+    with pytest.raises(RuntimeError):
+        pipeline.wait(tx_hash, timeout=1)
@@ -0,0 +1,182 @@
+import threading
+from synthetix.utils import wei_to_ether
+from utils.parallel import multicall_chunks
+
+# by default each refresh re-checks 1 / DEAD_SWEEP_FRACTION of the inactive
+# accounts
+DEAD_SWEEP_FRACTION = 10
+
+
+def new_account_index():
+    """Create an empty account index"""
+    return {
+        # next position in the account token list to scan
+        "cursor": 0,
+        # every account id seen so far, in mint order
+        "account_ids": [],
+        # last seen collateral value for each account, in wei
+        "values": {},
+        # last seen margins and positions of each active account, in ether
+        "margins": {},
+        # markets each account is active in, for markets with isolated margin
+        "markets": {},
+        # position of the rotating sweep over inactive accounts
+        "dead_offset": 0,
+    }
+
+
+def is_active_value(value):
+    """Accounts with at least 1 USD of collateral are considered active"""
+    return wei_to_ether(value) >= 1
+
+
+def scan_new_accounts(snx, account_index):
+    """Fetch account ids minted since the last scan and add them to the index"""
+    account_proxy = snx.perps.account_proxy
+
+    # get the total number of accounts
+    total_supply = account_proxy.functions.totalSupply().call()
+    cursor = account_index["cursor"]
+
+    # fetch only the new account ids
+    new_account_ids = multicall_chunks(
+        snx, account_proxy, "tokenByIndex", range(cursor, max(cursor, total_supply))
+    )
+
+    account_index["account_ids"].extend(new_account_ids)
+    account_index["cursor"] = max(cursor, total_supply)
+    return new_account_ids
+
+
+def get_indexed_account_ids(account_index, shard=None):
+    """List the account ids in the index, only those owned by ``shard`` if set"""
+    if shard is None:
+        return account_index["account_ids"]
+    return shard.filter(account_index["account_ids"])
+
+
+def accounts_to_refresh(
+    account_index, new_account_ids, shard=None, dead_sweep_fraction=DEAD_SWEEP_FRACTION
+):
+    """
+    Choose the accounts whose margin could have changed since the last refresh.
+
+    New, active and never read accounts are always refreshed. Inactive accounts
+    are revisited in a rotating window, so each of them is checked once every
+    ``dead_sweep_fraction`` refreshes, or on every refresh if it is 1. With a
+    ``shard``, only the accounts it owns are chosen.
+    """
+    values = account_index["values"]
+    new_ids = set(new_account_ids)
+
+    unread_ids = []
+    active_ids = []
+    dead_ids = []
+    for account_id in get_indexed_account_ids(account_index, shard):
+        if account_id in new_ids:
+            continue
+        if account_id not in values:
+            # moved to this shard, or never read
+            unread_ids.append(account_id)
+        elif is_active_value(values[account_id]):
+            active_ids.append(account_id)
+        else:
+            dead_ids.append(account_id)
+
+    # take the next window of inactive accounts
+    sweep_ids = []
+    if len(dead_ids) > 0:
+        window = -(-len(dead_ids) // dead_sweep_fraction)
+        offset = account_index["dead_offset"] % len(dead_ids)
+        sweep_ids = dead_ids[offset : offset + window]
+        sweep_ids.extend(dead_ids[: max(0, offset + window - len(dead_ids))])
+        account_index["dead_offset"] = (offset + window) % len(dead_ids)
+
+    return list(new_account_ids) + unread_ids + active_ids + sweep_ids
+
+
+def update_account_values(account_index, account_ids, values):
+    """Record the latest collateral values for a list of accounts"""
+    account_index["values"].update(zip(account_ids, values))
+
+
+def update_account_markets(account_index, account_ids, market_ids):
+    """Record the markets each account holds collateral or a position in"""
+    account_index["markets"].update(zip(account_ids, market_ids))
+
+
+def update_account_margins(account_index, account_ids, margins):
+    """
+    Record the latest margins and positions for a list of accounts.
+
+    Accounts with isolated margin are recorded per (account id, market id) pair.
+
+    Each entry is a dict with the ``margin`` and ``required`` margin of the
+    account, and its ``positions`` as ``[market_id, size, price]`` lists, where
+    ``price`` is the market price the margins were read at.
+    """
+    account_index["margins"].update(zip(account_ids, margins))
+
+
+def prune_account_margins(account_index, active_account_ids):
+    """Forget the margins of accounts that are no longer active"""
+    active_ids = set(active_account_ids)
+    margins = account_index["margins"]
+    for account_id in [
+        account_id for account_id in margins if account_id not in active_ids
+    ]:
+        del margins[account_id]
+
+
+def prune_unowned_accounts(account_index, shard):
+    """Forget the state of accounts owned by other shards, keeping their ids"""
+    for name in ["values", "markets", "margins"]:
+        entries = account_index[name]
+        for key in [
+            key
+            for key in entries
+            if not shard.owns(key[0] if isinstance(key, tuple) else key)
+        ]:
+            del entries[key]
+
+
+def get_indexed_active_accounts(account_index, shard=None):
+    """List the active accounts in the index, only those owned by ``shard`` if set"""
+    values = account_index["values"]
+    return [
+        account_id
+        for account_id in get_indexed_account_ids(account_index, shard)
+        if is_active_value(values.get(account_id, 0))
+    ]
+
+
+def get_indexed_active_positions(account_index, shard=None):
+    """List the (account id, market id) pairs of the active accounts in the index"""
+    markets = account_index["markets"]
+    return [
+        (account_id, market_id)
+        for account_id in get_indexed_active_accounts(account_index, shard)
+        for market_id in markets.get(account_id, [])
+    ]
+
+
+class PendingAccounts:
+    """Accounts changed by events, waiting to be refreshed"""
+
+    def __init__(self, shard=None):
+        self.shard = shard
+        self._account_ids = set()
+        self._lock = threading.Lock()
+
+    def add(self, account_ids):
+        if self.shard is not None:
+            account_ids = self.shard.filter(account_ids)
+        with self._lock:
+            self._account_ids.update(account_ids)
+
+    def pop_all(self):
+        """Take every pending account id"""
+        with self._lock:
+            account_ids = sorted(self._account_ids)
+            self._account_ids = set()
+        return account_ids
@@ -0,0 +1,112 @@
+def get_aggregate_calls(snx, tx_params):
+    """
+    Get the multicall calls made by a transaction, allowing each to fail.
+
+    Transactions built with ``write_erc7412`` already go through the multicall
+    and include any oracle update calls, other transactions become a single call.
+
+    :return: list of ``(target, allowFailure, value, callData)`` tuples
+    :rtype: list
+    """
+    if tx_params["to"].lower() != snx.multicall.address.lower():
+        return [(tx_params["to"], True, tx_params.get("value", 0), tx_params["data"])]
+
+    _, fn_args = snx.multicall.decode_function_input(tx_params["data"])
+    calls = []
+    for call in fn_args["calls"]:
+        if isinstance(call, dict):
+            call = (
+                call["target"],
+                call["allowFailure"],
+                call["value"],
+                call["callData"],
+            )
+        target, _, value, call_data = call
+        calls.append((target, True, value, call_data))
+    return calls
+
+
+def pack_call_groups(call_groups, gas_estimates, gas_budget):
+    """
+    Pack groups of calls into batches that fit a gas budget.
+
+    Groups are kept whole and in order, and a group larger than the budget gets
+    a batch of its own. Calls repeated across groups in a batch, such as
+    identical oracle updates, are only included once.
+
+    :param call_groups: list of call lists, one per action
+    :param gas_estimates: gas estimate for each group
+    :param gas_budget: maximum estimated gas for a batch
+
+    :return: list of batches, each a tuple of the group indexes and the calls
+    :rtype: list
+    """
+    batches = []
+    indexes, calls, batch_gas = [], [], 0
+    for ind, (group, gas) in enumerate(zip(call_groups, gas_estimates)):
+        if len(indexes) > 0 and batch_gas + gas > gas_budget:
+            batches.append((indexes, calls))
+            indexes, calls, batch_gas = [], [], 0
+
+        indexes.append(ind)
+        calls.extend([call for call in group if call not in calls])
+        batch_gas += gas
+
+    if len(indexes) > 0:
+        batches.append((indexes, calls))
+    return batches
+
+
+def build_aggregate_transaction(snx, calls, gas=None):
+    """
+    Build a multicall transaction for a list of calls
+
+    A known ``gas`` limit, for example from a simulation, skips gas estimation.
+    """
+    total_value = sum([call[2] for call in calls])
+    tx_params = snx._get_tx_params(value=total_value)
+    if gas is not None:
+        tx_params["gas"] = gas
+    return snx.multicall.functions.aggregate3Value(calls).build_transaction(tx_params)
+
+
+def build_batched_transactions(snx, txs, gas_budget, gas_limit=None):
+    """
+    Combine transactions into aggregate transactions that fit a gas budget.
+
+    A failing call inside a batch does not revert the other calls. Batches
+    holding a single transaction, or that fail to build, reuse the original
+    transactions unchanged.
+
+    :param txs: list of transaction params with gas estimates
+    :param gas_budget: maximum estimated gas for each aggregate transaction
+    :param gas_limit: gas of sending every transaction in one batch, from
+        ``simulate_transactions``, which caps the gas limit of each batch
+
+    :return: list of tuples of the indexes of ``txs`` in each batch and the
+        batch transaction params
+    :rtype: list
+    """
+    call_groups = [get_aggregate_calls(snx, tx_params) for tx_params in txs]
+    gas_estimates = [tx_params.get("gas", gas_budget) for tx_params in txs]
+
+    batched_txs = []
+    for indexes, calls in pack_call_groups(call_groups, gas_estimates, gas_budget):
+        if len(indexes) == 1:
+            batched_txs.append((indexes, txs[indexes[0]]))
+            continue
+
+        # the estimates of the individual transactions bound the batch gas,
+        # as does the simulated gas of all of them
+        batch_gas = sum([gas_estimates[ind] for ind in indexes])
+        if gas_limit is not None:
+            batch_gas = min(batch_gas, gas_limit)
+        try:
+            batched_txs.append(
+                (indexes, build_aggregate_transaction(snx, calls, gas=batch_gas))
+            )
+        except Exception as e:
+            # fall back to sending the transactions one by one
+            snx.logger.error(f"Error building batch transaction: {e}")
+            batched_txs.extend([([ind], txs[ind]) for ind in indexes])
+    return batched_txs
@@ -0,0 +1,65 @@
+import threading
+
+DEFAULT_CHUNK_SIZE = 500
+MIN_CHUNK_SIZE = 10
+MAX_CHUNK_SIZE = 5000
+
+# chunks that return faster than this grow, slower ones shrink
+TARGET_CHUNK_SECONDS = 3.0
+GROWTH_FACTOR = 1.25
+
+# a failed chunk is split in halves at most this many times
+MAX_SPLIT_DEPTH = 4
+
+# substrings of rpc errors caused by a chunk being too large, timeouts,
+# connection errors and rate limits are not, and are left to the caller
+OVERSIZE_ERRORS = [
+    "out of gas",
+    "gas required exceeds",
+    "exceeds block gas limit",
+    "response size",
+    "response is too big",
+    "too large",
+]
+
+
+def is_oversize_error(error):
+    """Check if an error was caused by sending too many calls at once"""
+    message = str(error).lower()
+    return any(pattern in message for pattern in OVERSIZE_ERRORS)
+
+
+class BatchSizer:
+    """Learns a chunk size for one function on one provider"""
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+
+    def record_success(self, size, elapsed):
+        """Grow after fast full chunks, shrink towards the target after slow ones"""
+        with self._lock:
+            if elapsed > TARGET_CHUNK_SECONDS:
+                scaled = int(size * TARGET_CHUNK_SECONDS / elapsed)
+                self.chunk_size = max(MIN_CHUNK_SIZE, min(self.chunk_size, scaled))
+            elif size >= self.chunk_size and elapsed < TARGET_CHUNK_SECONDS / 2:
+                grown = int(self.chunk_size * GROWTH_FACTOR)
+                self.chunk_size = min(MAX_CHUNK_SIZE, grown)
+
+    def record_failure(self, size):
+        """Halve the chunk size below the size that failed"""
+        with self._lock:
+            self.chunk_size = max(MIN_CHUNK_SIZE, min(self.chunk_size, size // 2))
+
+
+_sizers = {}
+_sizers_lock = threading.Lock()
+
+
+def get_batch_sizer(endpoint, function_name):
+    """Get the batch sizer for a function on an endpoint"""
+    key = (endpoint, function_name)
+    with _sizers_lock:
+        if key not in _sizers:
+            _sizers[key] = BatchSizer()
+        return _sizers[key]
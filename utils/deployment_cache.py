@@ -0,0 +1,118 @@
+import os
+import threading
+from synthetix.contracts import contracts as sdk_contracts
+from utils.snapshot import write_json, read_json
+
+DEPLOYMENT_CACHE_VERSION = 1
+
+_lock = threading.Lock()
+
+
+class LazyContract(dict):
+    """A contract entry that only builds its web3 contract when first used"""
+
+    def __init__(self, web3, address, abi):
+        super().__init__(address=address, abi=abi)
+        self._web3 = web3
+
+    def __missing__(self, key):
+        if key != "contract":
+            raise KeyError(key)
+        contract = self._web3.eth.contract(address=self["address"], abi=self["abi"])
+        self["contract"] = contract
+        return contract
+
+
+def get_deployment_key(snx):
+    """Identify the cannon package, version and preset of ``snx``"""
+    cannon_config = snx.cannon_config
+    return (
+        f"{cannon_config['package']}:{cannon_config['version']}"
+        f"@{snx.network_id}-{cannon_config['preset']}"
+    )
+
+
+def dump_contracts(contracts):
+    """Strip the web3 contracts from a contract tree, keeping addresses and ABIs"""
+    if "address" in contracts and "abi" in contracts:
+        return {"address": contracts["address"], "abi": contracts["abi"]}
+    return {name: dump_contracts(value) for name, value in contracts.items()}
+
+
+def build_contracts(web3, contracts):
+    """Rebuild a contract tree with lazily built web3 contracts"""
+    if "address" in contracts and "abi" in contracts:
+        return LazyContract(web3, contracts["address"], contracts["abi"])
+    return {name: build_contracts(web3, value) for name, value in contracts.items()}
+
+
+def install_deployment_cache(cache_dir):
+    """
+    Cache the cannon deployments loaded by the SDK in ``cache_dir``.
+
+    The deployment hash resolved for a package version is reused on the next
+    start, and checked again in the background. A changed hash is saved and
+    used from the next start. Deployments are stored by their IPFS hash, so
+    starting with a cached deployment needs neither the registry nor IPFS.
+    Must be called before ``Synthetix`` is created.
+    """
+    hashes_path = os.path.join(cache_dir, "deployment_hashes.json")
+    get_deployment_hash = sdk_contracts.get_deployment_hash
+    fetch_deploy_from_ipfs = sdk_contracts.fetch_deploy_from_ipfs
+
+    def save_deployment_hash(deployment_key, ipfs_hash):
+        with _lock:
+            hashes = read_json(hashes_path) or {}
+            hashes[deployment_key] = ipfs_hash
+            write_json(hashes_path, hashes)
+
+    def refresh_deployment_hash(snx, deployment_key, cached_hash):
+        try:
+            ipfs_hash = get_deployment_hash(snx)
+            if ipfs_hash != cached_hash:
+                snx.logger.warning(
+                    f"Deployment {deployment_key} changed to {ipfs_hash}, "
+                    "restart to load it"
+                )
+                fetch_deployment(snx, ipfs_hash)
+                save_deployment_hash(deployment_key, ipfs_hash)
+        except Exception as e:
+            snx.logger.error(f"Error checking deployment {deployment_key}: {e}")
+
+    def cached_get_deployment_hash(snx):
+        deployment_key = get_deployment_key(snx)
+        cached_hash = (read_json(hashes_path) or {}).get(deployment_key)
+        if cached_hash is None:
+            ipfs_hash = get_deployment_hash(snx)
+            save_deployment_hash(deployment_key, ipfs_hash)
+            return ipfs_hash
+
+        threading.Thread(
+            target=refresh_deployment_hash,
+            args=(snx, deployment_key, cached_hash),
+            daemon=True,
+        ).start()
+        return cached_hash
+
+    def fetch_deployment(snx, ipfs_hash):
+        deployment_path = os.path.join(cache_dir, f"deployment_{ipfs_hash}.json")
+        deployment = read_json(deployment_path)
+        if (
+            deployment is not None
+            and deployment.get("version") == DEPLOYMENT_CACHE_VERSION
+        ):
+            snx.logger.info(f"Loaded cached deployment {ipfs_hash}")
+            return build_contracts(snx.web3, deployment["contracts"])
+
+        contracts = fetch_deploy_from_ipfs(snx, ipfs_hash)
+        write_json(
+            deployment_path,
+            {
+                "version": DEPLOYMENT_CACHE_VERSION,
+                "contracts": dump_contracts(contracts),
+            },
+        )
+        return contracts
+
+    sdk_contracts.get_deployment_hash = cached_get_deployment_hash
+    sdk_contracts.fetch_deploy_from_ipfs = fetch_deployment
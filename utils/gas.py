@@ -0,0 +1,107 @@
+import threading
+
+# priority fee percentiles tracked from fee history
+FEE_PERCENTILES = [10, 25, 50, 75, 90]
+
+# urgency profiles: the priority fee percentile to pay, and the headroom
+# over the next base fee for the max fee
+URGENCY_PROFILES = {
+    "liquidation": {"priority_percentile": 90, "base_fee_multiplier": 2},
+    "settlement": {"priority_percentile": 75, "base_fee_multiplier": 2},
+    "price_update": {"priority_percentile": 50, "base_fee_multiplier": 1.5},
+    "swap": {"priority_percentile": 25, "base_fee_multiplier": 1.25},
+}
+
+# replacement transactions must raise fees by at least 10%
+REPLACEMENT_BUMP = 1.125
+
+
+class GasPricer:
+    """
+    Computes EIP-1559 fees from recent fee history, once per block.
+
+    Every handler shares the same fee estimates for a block instead of
+    estimating fees for each transaction.
+    """
+
+    def __init__(self, snx, history_blocks=20):
+        self.snx = snx
+        self.history_blocks = history_blocks
+
+        self.block_number = None
+        self.base_fee = None
+        self.priority_fees = {}
+        self._lock = threading.Lock()
+
+    def update(self, block_number=None):
+        """Refresh the fee estimates, unless they are already from ``block_number``"""
+        with self._lock:
+            if block_number is not None and block_number == self.block_number:
+                return
+
+            fee_history = self.snx.web3.eth.fee_history(
+                self.history_blocks, "latest", FEE_PERCENTILES
+            )
+
+            # the last base fee is the one for the next block
+            self.base_fee = fee_history["baseFeePerGas"][-1]
+
+            # use the median of each percentile over the history
+            rewards = [reward for reward in fee_history["reward"] if len(reward) > 0]
+            self.priority_fees = {}
+            for ind, percentile in enumerate(FEE_PERCENTILES):
+                fees = sorted([reward[ind] for reward in rewards])
+                self.priority_fees[percentile] = fees[len(fees) // 2] if fees else 0
+
+            self.block_number = block_number
+
+    def refresh(self, block_number):
+        """Update the fees for a new block, keeping the last fees if that fails"""
+        try:
+            self.update(block_number)
+        except Exception as e:
+            self.snx.logger.error(f"Error updating gas fees: {e}")
+
+    def get_fees(self, urgency):
+        """
+        Get the fees for an urgency profile.
+
+        :return: dict with ``maxFeePerGas`` and ``maxPriorityFeePerGas``
+        :rtype: dict
+        """
+        if self.base_fee is None:
+            self.update()
+
+        profile = URGENCY_PROFILES[urgency]
+        priority_fee = self.priority_fees[profile["priority_percentile"]]
+        max_fee = int(self.base_fee * profile["base_fee_multiplier"]) + priority_fee
+        return {"maxFeePerGas": max_fee, "maxPriorityFeePerGas": priority_fee}
+
+    def apply(self, tx_params, urgency):
+        """Set the fees of a transaction for an urgency profile"""
+        tx_params.pop("gasPrice", None)
+        tx_params.update(self.get_fees(urgency))
+        return tx_params
+
+    def get_replacement_fees(self, tx_params, urgency=None):
+        """
+        Get the fees to replace a pending transaction.
+
+        Fees are bumped by at least ``REPLACEMENT_BUMP``, or raised to the current
+        estimate for the urgency profile if that is higher.
+        """
+        fees = {}
+        current_fees = self.get_fees(urgency) if urgency is not None else {}
+        for fee_key in ["maxFeePerGas", "maxPriorityFeePerGas"]:
+            bumped_fee = int(tx_params.get(fee_key, 0) * REPLACEMENT_BUMP)
+            fees[fee_key] = max(bumped_fee, current_fees.get(fee_key, 0))
+        return fees
+
+    def estimate_cost(self, gas, urgency):
+        """Estimate the ETH cost of a transaction at the expected gas price"""
+        if self.base_fee is None:
+            self.update()
+
+        profile = URGENCY_PROFILES[urgency]
+        gas_price = self.base_fee + self.priority_fees[profile["priority_percentile"]]
+        return gas * gas_price / 1e18
@@ -0,0 +1,230 @@
+import time
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60]
+CHUNK_SIZE_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+_registry = []
+
+
+def format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    pairs = [f'{name}="{value}"' for name, value in labels]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    """A named metric with a value for each combination of labels"""
+
+    metric_type = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.metric_type}",
+        ]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(self._render_value(key, value))
+        return lines
+
+    def _render_value(self, key, value):
+        return [f"{self.name}{format_labels(key)} {value}"]
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = {
+                    "buckets": [0] * len(self.buckets),
+                    "sum": 0,
+                    "count": 0,
+                }
+            histogram = self._values[key]
+            for ind, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    histogram["buckets"][ind] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def _render_value(self, key, histogram):
+        lines = [
+            f"{self.name}_bucket{format_labels(key + (('le', str(bucket)),))} {count}"
+            for bucket, count in zip(self.buckets, histogram["buckets"])
+        ]
+        lines.append(
+            f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} "
+            f"{histogram['count']}"
+        )
+        lines.append(f"{self.name}_sum{format_labels(key)} {histogram['sum']}")
+        lines.append(f"{self.name}_count{format_labels(key)} {histogram['count']}")
+        return lines
+
+
+# handlers
+HANDLER_SECONDS = Histogram(
+    "keeper_handler_seconds", "Time spent in each handler, in seconds"
+)
+HANDLER_ERRORS = Counter("keeper_handler_errors_total", "Errors raised by handlers")
+TASKS_REPLACED = Counter(
+    "keeper_tasks_replaced_total",
+    "Waiting tasks replaced by newer work before they ran, by lane",
+)
+JOB_LAG_BLOCKS = Gauge(
+    "keeper_job_lag_blocks",
+    "Blocks between the deadline of each block job and the start of its last run",
+)
+STALE_BLOCKS = Counter(
+    "keeper_stale_blocks_total", "Blocks received after a later block, and dropped"
+)
+
+# rpc calls
+RPC_CALLS = Counter(
+    "keeper_rpc_calls_total", "Multicalls sent to the rpc, by contract function"
+)
+RPC_ERRORS = Counter(
+    "keeper_rpc_errors_total", "Failed multicalls, by contract function"
+)
+RPC_SECONDS = Histogram(
+    "keeper_rpc_seconds", "Duration of multicalls, by contract function, in seconds"
+)
+RPC_HEDGES = Counter("keeper_rpc_hedges_total", "Reads sent again to another endpoint")
+RPC_EJECTIONS = Counter(
+    "keeper_rpc_ejections_total", "Endpoints ejected from the read pool"
+)
+MULTICALL_CHUNK_SIZE = Histogram(
+    "keeper_multicall_chunk_size",
+    "Number of calls in each multicall chunk",
+    buckets=CHUNK_SIZE_BUCKETS,
+)
+
+# settlements
+SETTLEMENT_STAGE_SECONDS = Histogram(
+    "keeper_settlement_stage_seconds",
+    "Duration of each order settlement stage, by market, in seconds",
+)
+
+# accounts
+ACTIVE_ACCOUNTS = Gauge("keeper_active_accounts", "Number of active accounts")
+LIQUIDATABLE_ACCOUNTS = Counter(
+    "keeper_liquidatable_accounts_total", "Accounts found to be liquidatable"
+)
+
+# transactions
+TRANSACTIONS_SENT = Counter(
+    "keeper_transactions_sent_total", "Transactions sent, by urgency"
+)
+TRANSACTIONS_REVERTED = Counter(
+    "keeper_transactions_reverted_total", "Transactions that reverted, by urgency"
+)
+TRANSACTIONS_REPLACED = Counter(
+    "keeper_transactions_replaced_total",
+    "Stuck transactions replaced with higher fees, by urgency",
+)
+GAS_USED = Counter("keeper_gas_used_total", "Gas used by mined transactions")
+FEES_PAID = Counter("keeper_fees_paid_eth_total", "Fees paid for mined transactions")
+
+
+def record_receipt(tx_receipt, urgency=None):
+    """Record the outcome and cost of a mined transaction"""
+    urgency = urgency or "none"
+    if tx_receipt["status"] != 1:
+        TRANSACTIONS_REVERTED.inc(urgency=urgency)
+
+    gas_used = tx_receipt["gasUsed"]
+    GAS_USED.inc(gas_used, urgency=urgency)
+    if "effectiveGasPrice" in tx_receipt:
+        FEES_PAID.inc(
+            gas_used * tx_receipt["effectiveGasPrice"] / 1e18, urgency=urgency
+        )
+
+
+def observe_handler(handler_name):
+    """Decorate a handler to record its duration and errors"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start_time = time.time()
+            try:
+                return fn(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=handler_name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.time() - start_time, handler=handler_name)
+
+        return wrapper
+
+    return decorator
+
+
+def render_metrics():
+    """Render every metric in the Prometheus text format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serve the metrics at ``/metrics`` on ``port`` from a background thread"""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
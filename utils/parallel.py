@@ -0,0 +1,119 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from synthetix.utils.multicall import multicall_erc7412
+from utils.batching import get_batch_sizer, is_oversize_error, MAX_SPLIT_DEPTH
+from utils.metrics import RPC_CALLS, RPC_ERRORS, RPC_SECONDS, MULTICALL_CHUNK_SIZE
+from utils.tasks import get_task_priority, wait_for_priority
+
+# maximum number of concurrent requests to a single rpc endpoint, an rpc pool
+# applies it to each of its endpoints
+MAX_IN_FLIGHT = os.getenv("MULTICALL_MAX_IN_FLIGHT")
+MAX_IN_FLIGHT = 8 if MAX_IN_FLIGHT is None else int(MAX_IN_FLIGHT)
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def get_endpoint(snx):
+    """Get a key identifying the rpc endpoint of ``snx``"""
+    return getattr(snx.web3.provider, "endpoint_uri", None) or id(snx)
+
+
+def get_max_in_flight(snx):
+    """Get the number of concurrent requests the provider of ``snx`` can serve"""
+    return getattr(snx.web3.provider, "max_in_flight", MAX_IN_FLIGHT)
+
+
+def get_endpoint_semaphore(snx):
+    """Get the semaphore limiting in-flight requests to the provider of ``snx``"""
+    endpoint = get_endpoint(snx)
+    with _semaphores_lock:
+        if endpoint not in _semaphores:
+            _semaphores[endpoint] = threading.BoundedSemaphore(get_max_in_flight(snx))
+        return _semaphores[endpoint]
+
+
+def call_chunk(fn, chunk, sizer, function_name=None, depth=0):
+    """
+    Call ``fn`` on a chunk, feeding the timing back to ``sizer``.
+
+    If the chunk fails because it is too large, it is split in half and each
+    half is retried, up to ``MAX_SPLIT_DEPTH`` times.
+    """
+    function_name = function_name or fn.__name__
+    RPC_CALLS.inc(function=function_name)
+    MULTICALL_CHUNK_SIZE.observe(len(chunk), function=function_name)
+
+    start_time = time.time()
+    try:
+        results = list(fn(chunk))
+    except Exception as e:
+        RPC_ERRORS.inc(function=function_name)
+        if len(chunk) <= 1 or depth >= MAX_SPLIT_DEPTH or not is_oversize_error(e):
+            raise
+        sizer.record_failure(len(chunk))
+
+        middle = len(chunk) // 2
+        return call_chunk(
+            fn, chunk[:middle], sizer, function_name, depth + 1
+        ) + call_chunk(fn, chunk[middle:], sizer, function_name, depth + 1)
+
+    elapsed = time.time() - start_time
+    RPC_SECONDS.observe(elapsed, function=function_name)
+    sizer.record_success(len(chunk), elapsed)
+    return results
+
+
+def map_chunks(snx, fn, items, function_name=None, chunk_size=None):
+    """
+    Call ``fn`` on chunks of ``items`` concurrently.
+
+    :param fn: function taking a chunk and returning a list of results
+    :param items: sliceable sequence of inputs
+    :param function_name: name used to learn a chunk size for this call
+    :param chunk_size: fixed number of items in each chunk, overrides the
+        learned chunk size
+
+    :return: the results of every chunk, concatenated in input order
+    :rtype: list
+    """
+    function_name = function_name or fn.__name__
+    sizer = get_batch_sizer(get_endpoint(snx), function_name)
+    if chunk_size is None:
+        chunk_size = sizer.chunk_size
+
+    chunks = [items[x : x + chunk_size] for x in range(0, len(items), chunk_size)]
+    if len(chunks) == 0:
+        return []
+
+    semaphore = get_endpoint_semaphore(snx)
+    # chunks run in other threads, keep the priority of the calling task
+    priority = get_task_priority()
+
+    def run_chunk(chunk):
+        # let running tasks of a higher priority use the endpoint first
+        wait_for_priority(priority)
+        with semaphore:
+            return call_chunk(fn, chunk, sizer, function_name)
+
+    if len(chunks) == 1:
+        return run_chunk(chunks[0])
+
+    max_workers = min(get_max_in_flight(snx), len(chunks))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunk_results = list(executor.map(run_chunk, chunks))
+
+    return [result for chunk_result in chunk_results for result in chunk_result]
+
+
+def multicall_chunks(snx, contract, function_name, inputs, chunk_size=None):
+    """Run ``multicall_erc7412`` over ``inputs`` in concurrent chunks"""
+    return map_chunks(
+        snx,
+        lambda chunk: multicall_erc7412(snx, contract, function_name, chunk),
+        inputs,
+        function_name=function_name,
+        chunk_size=chunk_size,
+    )
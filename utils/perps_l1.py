@@ -1,149 +1,522 @@
-import time
-from synthetix.utils.multicall import write_erc7412, multicall_erc7412
-from synthetix.utils import wei_to_ether
+from contextlib import nullcontext
+from synthetix.utils.multicall import write_erc7412
+from utils.preflight import filter_calls, simulate_transactions
+from utils.aggregate import build_aggregate_transaction, build_batched_transactions
+from utils.settlement import (
+    fetch_price_update_data,
+    get_market_config,
+    get_update_fee,
+)
+from utils.metrics import LIQUIDATABLE_ACCOUNTS
+from utils.parallel import multicall_chunks
+from utils.planner import ReadPlan
+from utils.accounts import (
+    new_account_index,
+    scan_new_accounts,
+    accounts_to_refresh,
+    update_account_values,
+    update_account_markets,
+    update_account_margins,
+    prune_account_margins,
+    is_active_value,
+    prune_unowned_accounts,
+    get_indexed_active_positions,
+)
 
-MARKET_ID = 3
 
+def settle_perps_order(snx, order_committed_event, pipeline=None, tracer=None):
+    """
+    Settle a committed order
 
-def settle_perps_order(snx, order_committed_event, settle_delay=0):
+    With a transaction ``pipeline`` the settlement is submitted without waiting
+    for the receipt, which is logged when the transaction is mined. The stages
+    of the settlement are timed by ``tracer`` when one is given.
+    """
     account_id = order_committed_event["accountId"]
     market_id = order_committed_event["marketId"]
     market_name = snx.perps.markets_by_id[market_id]["market_name"]
 
-    # add a delay
     snx.logger.info(f"{market_name} Order committed by {account_id}")
 
-    if settle_delay > 0:
-        time.sleep(settle_delay)
-
     order = snx.perps.get_order(account_id, market_id=market_id)
+    if tracer is not None:
+        tracer.mark([order_committed_event], "get_order")
+
     if order["size_delta"] != 0 and order["is_stale"] == False:
         snx.logger.info(f"Settling {market_name} order committed by {account_id}")
         order_settlement_tx = snx.perps.settle_order(
             account_id, market_id=market_id, submit=False
         )
+        if tracer is not None:
+            tracer.mark([order_committed_event], "build")
 
-        # double the base fee
-        order_settlement_tx["maxFeePerGas"] = order_settlement_tx["maxFeePerGas"] * 2
-        tx_hash = snx.execute_transaction(order_settlement_tx)
-        tx_receipt = snx.wait(tx_hash)
+        def log_receipt(tx_receipt):
+            if tracer is not None:
+                tracer.finish([order_committed_event], tx_receipt)
+            if tx_receipt["status"] == 1:
+                snx.logger.info(
+                    f"Keeper settled {market_name} order committed by {account_id}"
+                )
+            else:
+                snx.logger.error(
+                    f"Keeper failed to settle {market_name} order committed by {account_id}"
+                )
 
-        if tx_receipt["status"] == 1:
+        if pipeline is None:
+            # double the base fee
+            order_settlement_tx["maxFeePerGas"] = (
+                order_settlement_tx["maxFeePerGas"] * 2
+            )
+            tx_hash = snx.execute_transaction(order_settlement_tx)
+            if tracer is not None:
+                tracer.mark([order_committed_event], "submit")
+            log_receipt(snx.wait(tx_hash))
+        else:
+            pipeline.submit(
+                order_settlement_tx, on_receipt=log_receipt, urgency="settlement"
+            )
+            if tracer is not None:
+                tracer.mark([order_committed_event], "submit")
+    else:
+        snx.logger.info(f"Keeper settled {market_name} order committed by {account_id}")
+        if tracer is not None:
+            tracer.discard([order_committed_event])
+
+
+def settle_each(snx, order_committed_events, pipeline=None, tracer=None):
+    """Settle orders one by one, so one failing order does not stop the others"""
+    for order_committed_event in order_committed_events:
+        try:
+            settle_perps_order(
+                snx, order_committed_event, pipeline=pipeline, tracer=tracer
+            )
+        except Exception as e:
+            snx.logger.error(f"Error settling order {order_committed_event}: {e}")
+            if tracer is not None:
+                tracer.discard([order_committed_event])
+
+
+def settle_perps_orders(
+    snx,
+    order_committed_events,
+    pipeline=None,
+    price_service_endpoint=None,
+    price_cache=None,
+    tracer=None,
+):
+    """
+    Settle several committed orders in one transaction
+
+    Orders are settled with prices published ``pyth_publish_time_min`` seconds
+    after their commitment, orders committed at the same time share one Pyth
+    price update for the union of their feeds. Orders are settled one by one if
+    the batch can not be built. Price updates are shared with other handlers
+    through ``price_cache``.
+    """
+    if tracer is not None:
+        tracer.mark(order_committed_events, "delay_wait")
+
+    if len(order_committed_events) == 1 or price_service_endpoint is None:
+        for order_committed_event in order_committed_events:
+            settle_perps_order(
+                snx, order_committed_event, pipeline=pipeline, tracer=tracer
+            )
+        return
+
+    market_proxy = snx.perps.market_proxy
+
+    # collect the orders that still need settling, grouped by price time
+    price_feeds = {}
+    settle_orders = []
+    settle_events = []
+    for order_committed_event in order_committed_events:
+        account_id = order_committed_event["accountId"]
+        market_id = order_committed_event["marketId"]
+        market = snx.perps.markets_by_id[market_id]
+        market_name = market["market_name"]
+        snx.logger.info(f"{market_name} Order committed by {account_id}")
+
+        order = snx.perps.get_order(account_id, market_id=market_id)
+        if tracer is not None:
+            tracer.mark([order_committed_event], "get_order")
+
+        if order["size_delta"] == 0 or order["is_stale"] == True:
             snx.logger.info(
                 f"Keeper settled {market_name} order committed by {account_id}"
             )
+            if tracer is not None:
+                tracer.discard([order_committed_event])
+            continue
+
+        config = get_market_config(snx, market_id)
+        if "feed_id" not in market or config is None:
+            # not enough information to share the price update
+            settle_each(snx, [order_committed_event], pipeline=pipeline, tracer=tracer)
+            continue
+
+        publish_time = order["commitment_time"] + config["pyth_publish_time_min"]
+        price_feeds.setdefault(publish_time, set()).add(market["feed_id"])
+        settle_orders.append((account_id, market_id, publish_time))
+        settle_events.append(order_committed_event)
+
+    if len(settle_events) == 0:
+        return
+
+    account_ids = [account_id for account_id, _, _ in settle_orders]
+    snx.logger.info(f"Settling orders committed by {account_ids}")
+    failing_events = []
+    try:
+        # one price update per price time, covering every feed
+        price_updates = {}
+        for publish_time, feed_ids in price_feeds.items():
+            price_update_data = fetch_price_update_data(
+                price_service_endpoint,
+                sorted(feed_ids),
+                publish_time=publish_time,
+                price_cache=price_cache,
+            )
+            price_updates[publish_time] = (
+                price_update_data[0],
+                get_update_fee(snx, price_update_data),
+            )
+        if tracer is not None:
+            tracer.mark(settle_events, "price_fetch")
+
+        settle_calls = []
+        for account_id, market_id, publish_time in settle_orders:
+            price_update, update_fee = price_updates[publish_time]
+            settle_calls.append(
+                (
+                    market_proxy.address,
+                    False,
+                    update_fee,
+                    market_proxy.encodeABI(
+                        fn_name="settleOrder",
+                        args=[account_id, market_id, price_update],
+                    ),
+                )
+            )
+
+        # orders that would fail with these prices are settled on their own
+        passing_indexes = filter_calls(snx, settle_calls)
+        failing_events = [
+            event
+            for ind, event in enumerate(settle_events)
+            if ind not in passing_indexes
+        ]
+        if len(failing_events) > 0:
+            snx.logger.info(
+                "Settling orders that would fail in the batch one by one: "
+                f"{[event['accountId'] for event in failing_events]}"
+            )
+        settle_calls = [settle_calls[ind] for ind in passing_indexes]
+        account_ids = [account_ids[ind] for ind in passing_indexes]
+        settle_events = [settle_events[ind] for ind in passing_indexes]
+        if len(settle_calls) == 0:
+            settle_each(snx, failing_events, pipeline=pipeline, tracer=tracer)
+            return
+        order_settlement_tx = build_aggregate_transaction(snx, settle_calls)
+        if tracer is not None:
+            tracer.mark(settle_events, "build")
+    except Exception as e:
+        snx.logger.error(f"Error building settlement batch: {e}")
+        settle_each(snx, settle_events, pipeline=pipeline, tracer=tracer)
+        return
+
+    def log_receipt(tx_receipt):
+        if tracer is not None:
+            tracer.finish(settle_events, tx_receipt)
+        if tx_receipt["status"] == 1:
+            snx.logger.info(f"Keeper settled orders committed by {account_ids}")
         else:
             snx.logger.error(
-                f"Keeper failed to settle {market_name} order committed by {account_id}"
+                f"Keeper failed to settle orders committed by {account_ids}"
             )
+
+    if pipeline is None:
+        # double the base fee
+        order_settlement_tx["maxFeePerGas"] = order_settlement_tx["maxFeePerGas"] * 2
+        tx_hash = snx.execute_transaction(order_settlement_tx)
+        if tracer is not None:
+            tracer.mark(settle_events, "submit")
+        log_receipt(snx.wait(tx_hash))
     else:
-        snx.logger.info(f"Keeper settled {market_name} order committed by {account_id}")
+        pipeline.submit(
+            order_settlement_tx, on_receipt=log_receipt, urgency="settlement"
+        )
+        if tracer is not None:
+            tracer.mark(settle_events, "submit")
 
+    settle_each(snx, failing_events, pipeline=pipeline, tracer=tracer)
 
-def get_active_accounts(snx):
-    """Fetch a list of accounts that have some collateral and have open positions"""
-    account_proxy = snx.perps.account_proxy
-    market_proxy = snx.perps.market_proxy
 
-    # get the total number of accounts
-    total_supply = account_proxy.functions.totalSupply().call()
+def get_market_ids(snx):
+    """Fetch the active market ids, reloading market metadata when markets are added"""
+    market_ids = snx.perps.market_proxy.functions.getActiveMarketIds().call()
+    if any(market_id not in snx.perps.markets_by_id for market_id in market_ids):
+        snx.perps.get_markets()
+    return market_ids
 
-    # fetch the account ids
-    account_ids = []
-    supply_chunks = [
-        range(x, min(x + 500, total_supply)) for x in range(0, total_supply, 500)
-    ]
-    for supply_chunk in supply_chunks:
-        accounts = multicall_erc7412(snx, account_proxy, "tokenByIndex", supply_chunk)
-        account_ids.extend(accounts)
-
-    # check those accounts margin requirements
-    digests = []
-    margin_chunks = [
-        account_ids[x : min(x + 500, total_supply)] for x in range(0, total_supply, 500)
+
+def read_account_digests(snx, account_index, account_ids, market_ids, lock=None):
+    """
+    Read the account digests of accounts in every market into the account index
+
+    With a ``lock``, it is only held while the account index changes.
+    """
+    market_proxy = snx.perps.market_proxy
+
+    fn_inputs = [
+        (account_id, market_id)
+        for account_id in account_ids
+        for market_id in market_ids
     ]
-    for margin_chunk in margin_chunks:
-        fn_inputs = [(account_id, MARKET_ID) for account_id in margin_chunk]
-        chunk_digests = multicall_erc7412(
-            snx, market_proxy, "getAccountDigest", fn_inputs
+    digests = multicall_chunks(snx, market_proxy, "getAccountDigest", fn_inputs)
+
+    values = {account_id: 0 for account_id in account_ids}
+    markets = {account_id: [] for account_id in account_ids}
+    margins = {}
+    for (account_id, market_id), digest in zip(fn_inputs, digests):
+        position = digest[3]
+        values[account_id] += digest[1]
+        if not is_active_value(digest[1]) and position[11] == 0:
+            continue
+
+        # margin is isolated, so each market is tracked separately
+        markets[account_id].append(market_id)
+
+        # record the position and the oracle price the margins were read at,
+        # so margins can be estimated at new prices between refreshes
+        margins[(account_id, market_id)] = {
+            "margin": position[2] / 1e18,
+            "required": position[13] / 1e18,
+            "positions": (
+                [[market_id, position[11] / 1e18, position[10] / 1e18]]
+                if position[11] != 0
+                else []
+            ),
+        }
+
+    with nullcontext() if lock is None else lock:
+        update_account_values(
+            account_index,
+            account_ids,
+            [values[account_id] for account_id in account_ids],
+        )
+        update_account_markets(
+            account_index,
+            account_ids,
+            [markets[account_id] for account_id in account_ids],
         )
+        update_account_margins(account_index, list(margins), list(margins.values()))
+
 
-        digests.extend(chunk_digests)
+def get_active_positions(snx, account_index=None, shard=None, lock=None):
+    """
+    Fetch the (account id, market id) pairs of accounts with collateral or a
+    position in a market
+
+    When an ``account_index`` is passed, only accounts minted since the last call
+    are fetched and margin is only refreshed for accounts that could have changed.
+    With a ``shard``, only the accounts it owns are refreshed and returned.
+    With a ``lock``, it is held while the account index changes and released
+    during the reads, so other updates of the index are not blocked.
+    """
+    if account_index is None:
+        account_index = new_account_index()
+    index_lock = nullcontext() if lock is None else lock
+
+    # fetch the new account ids
+    with index_lock:
+        new_account_ids = scan_new_accounts(snx, account_index)
+        if shard is not None:
+            # accounts of other shards are only kept as ids
+            new_account_ids = shard.filter(new_account_ids)
+            prune_unowned_accounts(account_index, shard)
+        # margin deposits emit no event with the account id, so inactive
+        # accounts are all re-read on every refresh
+        refresh_ids = accounts_to_refresh(
+            account_index, new_account_ids, shard, dead_sweep_fraction=1
+        )
+
+    # check those accounts margin requirements in every market
+    market_ids = get_market_ids(snx)
+    read_account_digests(snx, account_index, refresh_ids, market_ids, lock=lock)
 
     # filter accounts without a margin requirement
     # this eliminates accounts that have no open positions or small amounts of collateral
-    account_infos = zip(account_ids, digests)
-    active_accounts = [
-        account[0] for account in account_infos if wei_to_ether(account[1][1]) >= 1
-    ]
+    with index_lock:
+        active_positions = get_indexed_active_positions(account_index, shard)
+        prune_account_margins(account_index, active_positions)
     snx.logger.info(
-        f"Updating active accounts list with {len(active_accounts)} accounts"
+        f"Updating active positions list with {len(active_positions)} positions "
+        f"in {len(market_ids)} markets "
+        f"({len(new_account_ids)} new accounts, {len(refresh_ids)} refreshed)"
     )
-    return active_accounts
+    return active_positions
 
 
-def get_liquidatable_accounts(snx, account_ids):
-    # break it into chunks
-    chunks = [account_ids[x : x + 500] for x in range(0, len(account_ids), 500)]
+def update_accounts(snx, account_index, account_ids, shard=None):
+    """
+    Refresh accounts changed by events, returning the updated active positions
 
-    all_liq_accounts = []
-    for chunk in chunks:
-        fn_inputs = [(account_id, MARKET_ID) for account_id in chunk]
-        # check if the account can be liquidated
-        # TODO: check margin liquidation as well
-        is_position_liquidatables = multicall_erc7412(
-            snx, snx.perps.market_proxy, "isPositionLiquidatable", fn_inputs
-        )
-        is_margin_liquidatables = multicall_erc7412(
-            snx, snx.perps.market_proxy, "isMarginLiquidatable", fn_inputs
+    Accounts minted since the last scan are added to the index first, so the
+    changed accounts are always indexed. With a ``shard``, accounts owned by
+    other shards are skipped.
+    """
+    scan_new_accounts(snx, account_index)
+    if shard is not None:
+        account_ids = shard.filter(account_ids)
+    read_account_digests(snx, account_index, account_ids, get_market_ids(snx))
+
+    active_positions = get_indexed_active_positions(account_index, shard)
+    prune_account_margins(account_index, active_positions)
+    snx.logger.info(f"Updated {len(account_ids)} accounts changed by events")
+    return active_positions
+
+
+def get_liquidatable_positions(snx, positions):
+    """
+    Check a list of (account id, market id) pairs for liquidation
+
+    :return: a tuple of the pairs whose position is liquidatable, the pairs
+        without a position whose margin is liquidatable, and the pairs that
+        could not be checked
+    :rtype: tuple
+    """
+    # check positions and margins in one pass of parallel chunks
+    market_proxy = snx.perps.market_proxy
+    plan = ReadPlan()
+    plan.add(market_proxy, "isPositionLiquidatable", positions)
+    plan.add(market_proxy, "isMarginLiquidatable", positions)
+    is_position_liquidatables, is_margin_liquidatables = plan.run(snx)
+
+    liq_positions = []
+    liq_margins = []
+    failed_positions = []
+    for position, is_position_liquidatable, is_margin_liquidatable in zip(
+        positions, is_position_liquidatables, is_margin_liquidatables
+    ):
+        if is_position_liquidatable:
+            liq_positions.append(position)
+        elif is_margin_liquidatable:
+            liq_margins.append(position)
+        elif is_position_liquidatable is None or is_margin_liquidatable is None:
+            # a failed read is not a healthy account
+            failed_positions.append(position)
+
+    snx.logger.info(
+        f"Found {len(liq_positions)} liquidatable positions "
+        f"and {len(liq_margins)} liquidatable margins"
+    )
+    if len(failed_positions) > 0:
+        snx.logger.error(
+            f"Error checking {len(failed_positions)} positions for liquidation"
         )
-        can_liquidates = zip(chunk, is_position_liquidatables)
+    LIQUIDATABLE_ACCOUNTS.inc(len(liq_positions) + len(liq_margins))
+    return liq_positions, liq_margins, failed_positions
 
-        liq_accounts = [
-            can_liquidate[0] for can_liquidate in can_liquidates if can_liquidate[1]
-        ]
-        all_liq_accounts.extend(liq_accounts)
 
-    snx.logger.info(f"Found {len(all_liq_accounts)} liquidatable accounts")
-    return all_liq_accounts
+def build_margin_liquidation_tx(snx, account_id, market_id):
+    """Build a transaction that liquidates the margin of an account without a position"""
+    return write_erc7412(
+        snx, snx.perps.market_proxy, "liquidateMarginOnly", [account_id, market_id]
+    )
 
 
-def liquidate_accounts(snx, liquidatable_accounts):
-    for account_id in liquidatable_accounts:
-        snx.logger.info(f"Liquidating account {account_id}")
-        try:
-            # first to to flag the account
-            # if it fails, we skip flagging
-            flag_tx = snx.perps.flag(
-                account_id=account_id, market_id=MARKET_ID, submit=False
+def build_liquidation_tx(snx, account_id, market_id):
+    """Build a transaction that flags and liquidates a position"""
+    try:
+        # first to to flag the account
+        # if it fails, we skip flagging
+        flag_tx = snx.perps.flag(
+            account_id=account_id, market_id=market_id, submit=False
+        )
+        calls = [
+            (
+                flag_tx["to"],
+                True,
+                0,
+                flag_tx["data"],
             )
-            calls = [
-                (
-                    flag_tx["to"],
-                    True,
-                    0,
-                    flag_tx["data"],
-                )
-            ]
-        except Exception as e:
-            snx.logger.error(f"Error flagging account {account_id}: {e}")
-            calls = []
+        ]
+    except Exception as e:
+        snx.logger.error(f"Error flagging account {account_id}: {e}")
+        calls = []
 
-        try:
-            # liquidate the account, prepending the flag call
-            liquidate_tx_params = tx_params = write_erc7412(
-                snx,
-                snx.perps.market_proxy,
-                "liquidatePosition",
-                [account_id, MARKET_ID],
-                calls=calls,
-            )
+    # liquidate the account, prepending the flag call
+    return write_erc7412(
+        snx,
+        snx.perps.market_proxy,
+        "liquidatePosition",
+        [account_id, market_id],
+        calls=calls,
+    )
 
-            # double the base fee
-            liquidate_tx_params["maxFeePerGas"] = (
-                liquidate_tx_params["maxFeePerGas"] * 2
+
+def liquidate_positions(
+    snx, liquidatable_positions, liquidatable_margins=None, gas_budget=0, pipeline=None
+):
+    """
+    Liquidate lists of (account id, market id) pairs
+
+    Pairs in ``liquidatable_positions`` have their position flagged and
+    liquidated, pairs in ``liquidatable_margins`` only have their margin
+    liquidated. With a ``gas_budget``, liquidations are packed into aggregate
+    transactions of at most that much estimated gas. Otherwise one transaction
+    is sent per position. Transactions are sent through the ``pipeline`` when
+    one is given.
+    """
+    liquidatable_margins = [] if liquidatable_margins is None else liquidatable_margins
+    positions = []
+    liquidation_txs = []
+    for build_tx, liquidatable in [
+        (build_liquidation_tx, liquidatable_positions),
+        (build_margin_liquidation_tx, liquidatable_margins),
+    ]:
+        for account_id, market_id in liquidatable:
+            market_name = snx.perps.markets_by_id.get(market_id, {}).get(
+                "market_name", market_id
             )
+            snx.logger.info(f"Liquidating account {account_id} in {market_name}")
+            try:
+                liquidation_txs.append(build_tx(snx, account_id, market_id))
+                positions.append((account_id, market_id))
+            except Exception as e:
+                snx.logger.error(f"Error liquidating account {account_id}: {e}")
+
+    # drop liquidations that would revert, for example if another keeper
+    # got there first or the account recovered
+    passing_indexes, gas_limit = simulate_transactions(
+        snx, liquidation_txs, estimate_gas=gas_budget > 0
+    )
+    skipped_positions = [
+        position for ind, position in enumerate(positions) if ind not in passing_indexes
+    ]
+    if len(skipped_positions) > 0:
+        snx.logger.info(f"Skipping liquidations that would fail: {skipped_positions}")
+    positions = [positions[ind] for ind in passing_indexes]
+    liquidation_txs = [liquidation_txs[ind] for ind in passing_indexes]
+
+    if gas_budget > 0:
+        batches = build_batched_transactions(
+            snx, liquidation_txs, gas_budget, gas_limit=gas_limit
+        )
+    else:
+        batches = [([ind], tx_params) for ind, tx_params in enumerate(liquidation_txs)]
 
-            liquidate_tx = snx.execute_transaction(liquidate_tx_params)
+    for indexes, liquidate_tx_params in batches:
+        batch_positions = [positions[ind] for ind in indexes]
+        try:
+            if pipeline is None:
+                # double the base fee
+                liquidate_tx_params["maxFeePerGas"] = (
+                    liquidate_tx_params["maxFeePerGas"] * 2
+                )
+                snx.execute_transaction(liquidate_tx_params)
+            else:
+                pipeline.submit(liquidate_tx_params, urgency="liquidation")
+            if len(batch_positions) > 1:
+                snx.logger.info(f"Sent batch liquidation for {batch_positions}")
         except Exception as e:
-            snx.logger.error(f"Error liquidating account {account_id}: {e}")
+            snx.logger.error(f"Error liquidating positions {batch_positions}: {e}")
@@ -1,111 +1,466 @@
-import time
-from synthetix.utils.multicall import multicall_erc7412
-from synthetix.utils import wei_to_ether
+from contextlib import nullcontext
+from synthetix.utils.multicall import write_erc7412
+from utils.preflight import filter_calls, simulate_transactions
+from utils.aggregate import build_batched_transactions
+from utils.settlement import (
+    get_event_arg,
+    fetch_price_update_data,
+    build_oracle_fulfillment_call,
+)
+from utils.metrics import LIQUIDATABLE_ACCOUNTS
+from utils.parallel import map_chunks, multicall_chunks
+from utils.planner import ReadPlan
+from utils.accounts import (
+    new_account_index,
+    scan_new_accounts,
+    is_active_value,
+    accounts_to_refresh,
+    update_account_values,
+    update_account_margins,
+    prune_account_margins,
+    prune_unowned_accounts,
+    get_indexed_active_accounts,
+)
 
 
-def settle_perps_order(snx, order_committed_event, settle_delay=0):
+def settle_perps_order(snx, order_committed_event, pipeline=None, tracer=None):
+    """
+    Settle a committed order
+
+    With a transaction ``pipeline`` the settlement is submitted without waiting
+    for the receipt, which is logged when the transaction is mined. The stages
+    of the settlement are timed by ``tracer`` when one is given.
+    """
     account_id = order_committed_event["accountId"]
     market_id = order_committed_event["marketId"]
     market_name = snx.perps.markets_by_id[market_id]["market_name"]
 
-    # add a delay
     snx.logger.info(f"{market_name} Order committed by {account_id}")
 
-    if settle_delay > 0:
-        time.sleep(settle_delay)
-
     order = snx.perps.get_order(account_id)
+    if tracer is not None:
+        tracer.mark([order_committed_event], "get_order")
+
     if order["size_delta"] != 0:
         snx.logger.info(f"Settling {market_name} order committed by {account_id}")
         order_settlement_tx = snx.perps.settle_order(account_id, submit=False)
+        if tracer is not None:
+            tracer.mark([order_committed_event], "build")
 
-        # double the base fee
-        order_settlement_tx["maxFeePerGas"] = order_settlement_tx["maxFeePerGas"] * 2
-        tx_hash = snx.execute_transaction(order_settlement_tx)
-        tx_receipt = snx.wait(tx_hash)
+        def log_receipt(tx_receipt):
+            if tracer is not None:
+                tracer.finish([order_committed_event], tx_receipt)
+            if tx_receipt["status"] == 1:
+                snx.logger.info(
+                    f"Keeper settled {market_name} order committed by {account_id}"
+                )
+            else:
+                snx.logger.error(
+                    f"Keeper failed to settle {market_name} order committed by {account_id}"
+                )
 
-        if tx_receipt["status"] == 1:
+        if pipeline is None:
+            # double the base fee
+            order_settlement_tx["maxFeePerGas"] = (
+                order_settlement_tx["maxFeePerGas"] * 2
+            )
+            tx_hash = snx.execute_transaction(order_settlement_tx)
+            if tracer is not None:
+                tracer.mark([order_committed_event], "submit")
+            log_receipt(snx.wait(tx_hash))
+        else:
+            pipeline.submit(
+                order_settlement_tx, on_receipt=log_receipt, urgency="settlement"
+            )
+            if tracer is not None:
+                tracer.mark([order_committed_event], "submit")
+    else:
+        snx.logger.info(f"Keeper settled {market_name} order committed by {account_id}")
+        if tracer is not None:
+            tracer.discard([order_committed_event])
+
+
+def get_price_time(order_committed_event, order):
+    """
+    Get the time of the price an order is settled at.
+
+    The event emits it as ``expectedPriceTime``, otherwise it is the commitment
+    time plus the price delay of the order's settlement strategy.
+    """
+    price_time = get_event_arg(order_committed_event, "expectedPriceTime")
+    if price_time is not None:
+        return price_time
+
+    strategy = order.get("settlement_strategy") or {}
+    if "commitment_price_delay" not in strategy:
+        return None
+    return order["commitment_time"] + strategy["commitment_price_delay"]
+
+
+def settle_each(snx, order_committed_events, pipeline=None, tracer=None):
+    """Settle orders one by one, so one failing order does not stop the others"""
+    for order_committed_event in order_committed_events:
+        try:
+            settle_perps_order(
+                snx, order_committed_event, pipeline=pipeline, tracer=tracer
+            )
+        except Exception as e:
+            snx.logger.error(f"Error settling order {order_committed_event}: {e}")
+            if tracer is not None:
+                tracer.discard([order_committed_event])
+
+
+def settle_perps_orders(
+    snx,
+    order_committed_events,
+    pipeline=None,
+    price_service_endpoint=None,
+    price_cache=None,
+    tracer=None,
+):
+    """
+    Settle several committed orders in one transaction
+
+    Orders priced at the same time share one Pyth price update for the union of
+    their feeds. Orders are settled one by one if the batch can not be built.
+    Price updates are shared with other handlers through ``price_cache``.
+    """
+    if tracer is not None:
+        tracer.mark(order_committed_events, "delay_wait")
+
+    if len(order_committed_events) == 1 or price_service_endpoint is None:
+        for order_committed_event in order_committed_events:
+            settle_perps_order(
+                snx, order_committed_event, pipeline=pipeline, tracer=tracer
+            )
+        return
+
+    market_proxy = snx.perps.market_proxy
+
+    # collect the orders that still need settling, grouped by price time
+    price_feeds = {}
+    settle_calls = []
+    settle_events = []
+    for order_committed_event in order_committed_events:
+        account_id = order_committed_event["accountId"]
+        market_id = order_committed_event["marketId"]
+        market = snx.perps.markets_by_id[market_id]
+        market_name = market["market_name"]
+        snx.logger.info(f"{market_name} Order committed by {account_id}")
+
+        order = snx.perps.get_order(account_id)
+        if tracer is not None:
+            tracer.mark([order_committed_event], "get_order")
+
+        if order["size_delta"] == 0:
             snx.logger.info(
                 f"Keeper settled {market_name} order committed by {account_id}"
             )
+            if tracer is not None:
+                tracer.discard([order_committed_event])
+            continue
+
+        publish_time = get_price_time(order_committed_event, order)
+        if publish_time is None or "feed_id" not in market:
+            # not enough information to share the price update
+            settle_each(snx, [order_committed_event], pipeline=pipeline, tracer=tracer)
+            continue
+
+        price_feeds.setdefault(publish_time, set()).add(market["feed_id"])
+        settle_calls.append(
+            (
+                market_proxy.address,
+                False,
+                0,
+                market_proxy.encodeABI(fn_name="settleOrder", args=[account_id]),
+            )
+        )
+        settle_events.append(order_committed_event)
+
+    if len(settle_events) == 0:
+        return
+
+    account_ids = [event["accountId"] for event in settle_events]
+    snx.logger.info(f"Settling orders committed by {account_ids}")
+    failing_events = []
+    try:
+        # one price update per price time, covering every feed
+        oracle_calls = []
+        for publish_time, feed_ids in price_feeds.items():
+            feed_ids = sorted(feed_ids)
+            price_update_data = fetch_price_update_data(
+                price_service_endpoint,
+                feed_ids,
+                publish_time=publish_time,
+                price_cache=price_cache,
+            )
+            oracle_calls.append(
+                build_oracle_fulfillment_call(
+                    snx, feed_ids, publish_time, price_update_data
+                )
+            )
+        if tracer is not None:
+            tracer.mark(settle_events, "price_fetch")
+
+        # orders that would fail with these prices are settled on their own
+        passing_indexes = filter_calls(snx, settle_calls, setup_calls=oracle_calls)
+        failing_events = [
+            event
+            for ind, event in enumerate(settle_events)
+            if ind not in passing_indexes
+        ]
+        if len(failing_events) > 0:
+            snx.logger.info(
+                "Settling orders that would fail in the batch one by one: "
+                f"{[event['accountId'] for event in failing_events]}"
+            )
+        settle_calls = [settle_calls[ind] for ind in passing_indexes]
+        account_ids = [account_ids[ind] for ind in passing_indexes]
+        settle_events = [settle_events[ind] for ind in passing_indexes]
+        if len(settle_calls) == 0:
+            settle_each(snx, failing_events, pipeline=pipeline, tracer=tracer)
+            return
+
+        # settle the last order through ERC-7412 in case any price is missing
+        order_settlement_tx = write_erc7412(
+            snx,
+            market_proxy,
+            "settleOrder",
+            [account_ids[-1]],
+            calls=oracle_calls + settle_calls[:-1],
+        )
+        if tracer is not None:
+            tracer.mark(settle_events, "build")
+    except Exception as e:
+        snx.logger.error(f"Error building settlement batch: {e}")
+        settle_each(snx, settle_events, pipeline=pipeline, tracer=tracer)
+        return
+
+    def log_receipt(tx_receipt):
+        if tracer is not None:
+            tracer.finish(settle_events, tx_receipt)
+        if tx_receipt["status"] == 1:
+            snx.logger.info(f"Keeper settled orders committed by {account_ids}")
         else:
             snx.logger.error(
-                f"Keeper failed to settle {market_name} order committed by {account_id}"
+                f"Keeper failed to settle orders committed by {account_ids}"
             )
+
+    if pipeline is None:
+        # double the base fee
+        order_settlement_tx["maxFeePerGas"] = order_settlement_tx["maxFeePerGas"] * 2
+        tx_hash = snx.execute_transaction(order_settlement_tx)
+        if tracer is not None:
+            tracer.mark(settle_events, "submit")
+        log_receipt(snx.wait(tx_hash))
     else:
-        snx.logger.info(f"Keeper settled {market_name} order committed by {account_id}")
+        pipeline.submit(
+            order_settlement_tx, on_receipt=log_receipt, urgency="settlement"
+        )
+        if tracer is not None:
+            tracer.mark(settle_events, "submit")
+
+    settle_each(snx, failing_events, pipeline=pipeline, tracer=tracer)
+
 
+def read_account_margins(snx, account_index, account_ids, lock=None):
+    """
+    Read the margins and open positions of accounts into the account index
 
-def get_active_accounts(snx):
-    """Fetch a list of accounts that have some collateral and have open positions"""
-    account_proxy = snx.perps.account_proxy
+    With a ``lock``, it is only held while the account index changes.
+    """
     market_proxy = snx.perps.market_proxy
 
-    # get the total number of accounts
-    total_supply = account_proxy.functions.totalSupply().call()
+    # compare available margin with the margin at which each account is
+    # liquidatable, and find the markets of its open positions, in one pass
+    plan = ReadPlan()
+    plan.add(market_proxy, "getAvailableMargin", account_ids)
+    plan.add(market_proxy, "getRequiredMargins", account_ids)
+    plan.add(market_proxy, "getAccountOpenPositions", account_ids)
+    available_margins, required_margins, open_market_ids = plan.run(snx)
 
-    # fetch the account ids
-    account_ids = []
-    supply_chunks = [
-        range(x, min(x + 500, total_supply)) for x in range(0, total_supply, 500)
-    ]
-    for supply_chunk in supply_chunks:
-        accounts = multicall_erc7412(snx, account_proxy, "tokenByIndex", supply_chunk)
-        account_ids.extend(accounts)
+    # accounts with failed reads keep their last recorded margins
+    margins = {}
+    position_inputs = []
+    for account_id, available_margin, required, market_ids in zip(
+        account_ids, available_margins, required_margins, open_market_ids
+    ):
+        if available_margin is None or required is None or market_ids is None:
+            continue
+        margins[account_id] = {
+            "margin": available_margin / 1e18,
+            "required": (required[1] + required[2]) / 1e18,
+            "positions": [],
+        }
+        position_inputs.extend((account_id, market_id) for market_id in market_ids)
 
-    # check those accounts margin requirements
-    values = []
-    margin_chunks = [
-        account_ids[x : min(x + 500, total_supply)] for x in range(0, total_supply, 500)
-    ]
-    for margin_chunk in margin_chunks:
-        collateral_values = multicall_erc7412(
-            snx, market_proxy, "totalCollateralValue", margin_chunk
-        )
+    # record the open positions and the prices the margins were read at, so
+    # margins can be estimated at new prices between refreshes
+    market_ids = sorted({market_id for _, market_id in position_inputs})
+    plan = ReadPlan()
+    plan.add(market_proxy, "getOpenPositionSize", position_inputs)
+    plan.add(market_proxy, "indexPrice", market_ids)
+    position_sizes, prices = plan.run(snx)
+    index_prices = dict(zip(market_ids, prices))
 
-        values.extend(collateral_values)
+    for (account_id, market_id), size in zip(position_inputs, position_sizes):
+        price = index_prices[market_id]
+        if size is None or price is None:
+            margins.pop(account_id, None)
+        elif account_id in margins:
+            margins[account_id]["positions"].append(
+                [market_id, size / 1e18, price / 1e18]
+            )
+    with nullcontext() if lock is None else lock:
+        update_account_margins(account_index, list(margins), list(margins.values()))
+
+
+def get_active_accounts(snx, account_index=None, shard=None, lock=None):
+    """
+    Fetch a list of accounts that have some collateral and have open positions
+
+    When an ``account_index`` is passed, only accounts minted since the last call
+    are fetched and margin is only refreshed for accounts that could have changed.
+    With a ``shard``, only the accounts it owns are refreshed and returned.
+    With a ``lock``, it is held while the account index changes and released
+    during the reads, so other updates of the index are not blocked.
+    """
+    market_proxy = snx.perps.market_proxy
+    if account_index is None:
+        account_index = new_account_index()
+    index_lock = nullcontext() if lock is None else lock
+
+    # fetch the new account ids
+    with index_lock:
+        new_account_ids = scan_new_accounts(snx, account_index)
+        if shard is not None:
+            # accounts of other shards are only kept as ids
+            new_account_ids = shard.filter(new_account_ids)
+            prune_unowned_accounts(account_index, shard)
+        refresh_ids = accounts_to_refresh(account_index, new_account_ids, shard)
+
+    # check those accounts margin requirements
+    values = multicall_chunks(snx, market_proxy, "totalCollateralValue", refresh_ids)
 
     # filter accounts without a margin requirement
     # this eliminates accounts that have no open positions or small amounts of collateral
-    account_infos = zip(account_ids, values)
-    active_accounts = [
-        account[0] for account in account_infos if wei_to_ether(account[1]) >= 1
-    ]
+    with index_lock:
+        update_account_values(account_index, refresh_ids, values)
+        active_accounts = get_indexed_active_accounts(account_index, shard)
+
+    read_account_margins(snx, account_index, active_accounts, lock=lock)
+    with index_lock:
+        prune_account_margins(account_index, active_accounts)
+
     snx.logger.info(
-        f"Updating active accounts list with {len(active_accounts)} accounts"
+        f"Updating active accounts list with {len(active_accounts)} accounts "
+        f"({len(new_account_ids)} new, {len(refresh_ids)} refreshed)"
     )
     return active_accounts
 
 
-def get_liquidatable_accounts(snx, account_ids):
-    # break it into chunks
-    chunks = [account_ids[x : x + 500] for x in range(0, len(account_ids), 500)]
+def update_accounts(snx, account_index, account_ids, shard=None):
+    """
+    Refresh accounts changed by events, returning the updated active accounts
 
-    all_liq_accounts = []
-    for chunk in chunks:
-        # check if the account can be liquidated
-        can_liquidates = snx.perps.get_can_liquidates(chunk)
+    Accounts minted since the last scan are added to the index first, so the
+    changed accounts are always indexed. With a ``shard``, accounts owned by
+    other shards are skipped.
+    """
+    market_proxy = snx.perps.market_proxy
+    scan_new_accounts(snx, account_index)
+    if shard is not None:
+        account_ids = shard.filter(account_ids)
+
+    values = multicall_chunks(snx, market_proxy, "totalCollateralValue", account_ids)
+    update_account_values(account_index, account_ids, values)
+
+    read_account_margins(
+        snx,
+        account_index,
+        [
+            account_id
+            for account_id, value in zip(account_ids, values)
+            if is_active_value(value)
+        ],
+    )
+
+    active_accounts = get_indexed_active_accounts(account_index, shard)
+    prune_account_margins(account_index, active_accounts)
+    snx.logger.info(f"Updated {len(account_ids)} accounts changed by events")
+    return active_accounts
 
-        liq_accounts = [
-            can_liquidate[0] for can_liquidate in can_liquidates if can_liquidate[1]
-        ]
-        all_liq_accounts.extend(liq_accounts)
+
+def get_liquidatable_accounts(snx, account_ids):
+    # check if the accounts can be liquidated, in parallel chunks
+    can_liquidates = map_chunks(
+        snx,
+        snx.perps.get_can_liquidates,
+        account_ids,
+        function_name="getCanLiquidates",
+    )
+
+    all_liq_accounts = [
+        can_liquidate[0] for can_liquidate in can_liquidates if can_liquidate[1]
+    ]
 
     snx.logger.info(f"Found {len(all_liq_accounts)} liquidatable accounts")
+    LIQUIDATABLE_ACCOUNTS.inc(len(all_liq_accounts))
     return all_liq_accounts
 
 
-def liquidate_accounts(snx, liquidatable_accounts):
+def liquidate_accounts(snx, liquidatable_accounts, gas_budget=0, pipeline=None):
+    """
+    Liquidate a list of accounts
+
+    With a ``gas_budget``, liquidations are packed into aggregate transactions of
+    at most that much estimated gas. Otherwise one transaction is sent per account.
+    Transactions are sent through the ``pipeline`` when one is given.
+    """
+    account_ids = []
+    liquidation_txs = []
     for account in liquidatable_accounts:
         snx.logger.info(f"Liquidating account {account}")
         try:
-            liquidate_tx_params = snx.perps.liquidate(account, submit=False)
+            liquidation_txs.append(snx.perps.liquidate(account, submit=False))
+            account_ids.append(account)
+        except Exception as e:
+            snx.logger.error(f"Error liquidating account {account}: {e}")
 
-            # double the base fee
-            liquidate_tx_params["maxFeePerGas"] = (
-                liquidate_tx_params["maxFeePerGas"] * 2
-            )
+    # drop liquidations that would revert, for example if another keeper
+    # got there first or the account recovered
+    passing_indexes, gas_limit = simulate_transactions(
+        snx, liquidation_txs, estimate_gas=gas_budget > 0
+    )
+    skipped_account_ids = [
+        account_id
+        for ind, account_id in enumerate(account_ids)
+        if ind not in passing_indexes
+    ]
+    if len(skipped_account_ids) > 0:
+        snx.logger.info(f"Skipping liquidations that would fail: {skipped_account_ids}")
+    account_ids = [account_ids[ind] for ind in passing_indexes]
+    liquidation_txs = [liquidation_txs[ind] for ind in passing_indexes]
+
+    if gas_budget > 0:
+        batches = build_batched_transactions(
+            snx, liquidation_txs, gas_budget, gas_limit=gas_limit
+        )
+    else:
+        batches = [([ind], tx_params) for ind, tx_params in enumerate(liquidation_txs)]
 
-            snx.execute_transaction(liquidate_tx_params)
+    for indexes, liquidate_tx_params in batches:
+        batch_account_ids = [account_ids[ind] for ind in indexes]
+        try:
+            if pipeline is None:
+                # double the base fee
+                liquidate_tx_params["maxFeePerGas"] = (
+                    liquidate_tx_params["maxFeePerGas"] * 2
+                )
+                snx.execute_transaction(liquidate_tx_params)
+            else:
+                pipeline.submit(liquidate_tx_params, urgency="liquidation")
+            if len(batch_account_ids) > 1:
+                snx.logger.info(f"Sent batch liquidation for {batch_account_ids}")
         except Exception as e:
-            snx.logger.error(f"Error liquidating account {account}: {e}")
+            snx.logger.error(f"Error liquidating accounts {batch_account_ids}: {e}")
@@ -0,0 +1,148 @@
+from eth_abi import encode
+from eth_utils import decode_hex, encode_hex
+from web3.exceptions import ContractCustomError
+from synthetix.utils.multicall import (
+    SELECTOR_ERRORS,
+    SELECTOR_ORACLE_DATA_REQUIRED,
+    SELECTOR_ORACLE_DATA_REQUIRED_WITH_FEE,
+    decode_result,
+    handle_erc7412_error,
+)
+from utils.parallel import map_chunks
+
+# rounds of oracle data fulfillment before failing reads are given up on
+MAX_ORACLE_ROUNDS = 3
+
+
+def is_oracle_data_error(return_data):
+    """Check if a failed call asked for ERC-7412 oracle data"""
+    selector = encode_hex(return_data[:4])
+    return selector in [
+        SELECTOR_ERRORS,
+        SELECTOR_ORACLE_DATA_REQUIRED,
+        SELECTOR_ORACLE_DATA_REQUIRED_WITH_FEE,
+    ]
+
+
+def call_fused(snx, requests):
+    """
+    Run several reads in one multicall, fulfilling oracle data for all of them.
+
+    Failing reads that ask for oracle data are fulfilled together, with one
+    price update for the whole batch, and the batch is retried.
+
+    :param requests: list of ``(contract, function_name, args)``
+
+    :return: the decoded result of each read, or None if it failed
+    :rtype: list
+    """
+    calls = [
+        (
+            contract.address,
+            True,
+            0,
+            contract.encodeABI(fn_name=function_name, args=args),
+        )
+        for contract, function_name, args in requests
+    ]
+    num_calls = len(calls)
+
+    for oracle_round in range(MAX_ORACLE_ROUNDS + 1):
+        try:
+            total_value = sum(call[2] for call in calls)
+            results = snx.multicall.functions.aggregate3Value(calls).call(
+                {"value": total_value}, block_identifier="latest"
+            )
+        except Exception as e:
+            if oracle_round == MAX_ORACLE_ROUNDS:
+                raise
+            # raises if the error is not related to oracle data
+            calls = handle_erc7412_error(snx, e) + calls
+            continue
+
+        results = results[-num_calls:]
+        # many reads usually ask for the same feeds
+        oracle_errors = list(
+            dict.fromkeys(
+                return_data
+                for success, return_data in results
+                if not success and is_oracle_data_error(return_data)
+            )
+        )
+        if len(oracle_errors) == 0 or oracle_round == MAX_ORACLE_ROUNDS:
+            break
+
+        # fulfill every oracle request of the batch at once
+        error = ContractCustomError(
+            data=encode_hex(
+                decode_hex(SELECTOR_ERRORS) + encode(["bytes[]"], [oracle_errors])
+            )
+        )
+        calls = handle_erc7412_error(snx, error) + calls
+
+    decoded_results = []
+    for (contract, function_name, _), (success, return_data) in zip(requests, results):
+        if not success:
+            decoded_results.append(None)
+            continue
+        decoded_result = decode_result(contract, function_name, return_data)
+        decoded_results.append(
+            decoded_result if len(decoded_result) > 1 else decoded_result[0]
+        )
+    return decoded_results
+
+
+class ReadPlan:
+    """
+    Collects reads of several contract functions and runs them fused.
+
+    Reads are packed together into as few multicalls as the learned chunk size
+    allows, instead of one pass of multicalls per function::
+
+        plan = ReadPlan()
+        plan.add(market_proxy, "getAvailableMargin", account_ids)
+        plan.add(market_proxy, "getRequiredMargins", account_ids)
+        available_margins, required_margins = plan.run(snx)
+    """
+
+    def __init__(self):
+        self.groups = []
+
+    def add(self, contract, function_name, args_list):
+        """Add a read of ``function_name`` for each arguments in ``args_list``"""
+        args_list = [
+            args if isinstance(args, (list, tuple)) else (args,) for args in args_list
+        ]
+        self.groups.append((contract, function_name, args_list))
+
+    def get_name(self):
+        """Name the plan by its functions, to learn a chunk size for this mix"""
+        return "+".join(sorted({function_name for _, function_name, _ in self.groups}))
+
+    def run(self, snx, chunk_size=None):
+        """
+        Run every read of the plan.
+
+        :return: a list of results for each ``add``, in the order they were
+            added, with None for reads that failed
+        :rtype: list
+        """
+        requests = [
+            (contract, function_name, args)
+            for contract, function_name, args_list in self.groups
+            for args in args_list
+        ]
+        results = map_chunks(
+            snx,
+            lambda chunk: call_fused(snx, chunk),
+            requests,
+            function_name=self.get_name(),
+            chunk_size=chunk_size,
+        )
+
+        group_results = []
+        offset = 0
+        for _, _, args_list in self.groups:
+            group_results.append(results[offset : offset + len(args_list)])
+            offset += len(args_list)
+        return group_results
@@ -0,0 +1,100 @@
+import time
+from utils.aggregate import get_aggregate_calls
+from utils.metrics import RPC_CALLS, RPC_SECONDS
+
+
+def simulate_calls(snx, calls):
+    """
+    Simulate calls in order in one ``eth_call`` at the latest block.
+
+    Each call is allowed to fail without affecting the others.
+
+    :return: whether each call succeeded
+    :rtype: list
+    """
+    calls = [(target, True, value, call_data) for target, _, value, call_data in calls]
+    total_value = sum([call[2] for call in calls])
+    RPC_CALLS.inc(function="simulate")
+    start_time = time.time()
+    results = snx.multicall.functions.aggregate3Value(calls).call(
+        {"from": snx.address, "value": total_value}
+    )
+    RPC_SECONDS.observe(time.time() - start_time, function="simulate")
+    return [result[0] for result in results]
+
+
+def estimate_calls_gas(snx, calls):
+    """Estimate the gas of making calls in order in one multicall transaction"""
+    calls = [(target, True, value, call_data) for target, _, value, call_data in calls]
+    total_value = sum([call[2] for call in calls])
+    RPC_CALLS.inc(function="estimate_gas")
+    start_time = time.time()
+    gas = snx.multicall.functions.aggregate3Value(calls).estimate_gas(
+        {"from": snx.address, "value": total_value}
+    )
+    RPC_SECONDS.observe(time.time() - start_time, function="estimate_gas")
+    return int(gas * snx.gas_multiplier)
+
+
+def filter_calls(snx, calls, setup_calls=None):
+    """
+    Simulate calls after ``setup_calls``, such as oracle updates, and keep the
+    ones that would succeed. If the simulation itself fails, every call is kept.
+
+    :return: indexes of the calls that would succeed
+    :rtype: list
+    """
+    setup_calls = [] if setup_calls is None else setup_calls
+    try:
+        successes = simulate_calls(snx, setup_calls + calls)
+    except Exception as e:
+        snx.logger.error(f"Error simulating calls: {e}")
+        return list(range(len(calls)))
+
+    successes = successes[len(setup_calls) :]
+    return [ind for ind, success in enumerate(successes) if success]
+
+
+def simulate_transactions(snx, txs, estimate_gas=False):
+    """
+    Simulate candidate transactions together and keep the ones that would succeed.
+
+    A transaction passes if its final call, the action after any oracle updates,
+    succeeds. If the simulation itself fails, every transaction is kept. With
+    ``estimate_gas``, when several pass, the passing calls are simulated again
+    for their gas, which bounds the gas of any batch of those transactions.
+
+    :return: a tuple of the indexes of the transactions that would succeed, and
+        the gas of sending them in one batch, or None
+    :rtype: tuple
+    """
+    call_groups = [get_aggregate_calls(snx, tx_params) for tx_params in txs]
+    calls = []
+    final_indexes = []
+    for group in call_groups:
+        calls.extend(group)
+        final_indexes.append(len(calls) - 1)
+
+    try:
+        successes = simulate_calls(snx, calls)
+    except Exception as e:
+        snx.logger.error(f"Error simulating transactions: {e}")
+        return list(range(len(txs))), None
+
+    passing_indexes = [
+        ind for ind, final_ind in enumerate(final_indexes) if successes[final_ind]
+    ]
+    if not estimate_gas or len(passing_indexes) < 2:
+        return passing_indexes, None
+
+    passing_calls = []
+    for ind in passing_indexes:
+        passing_calls.extend(
+            [call for call in call_groups[ind] if call not in passing_calls]
+        )
+    try:
+        gas = estimate_calls_gas(snx, passing_calls)
+    except Exception as e:
+        snx.logger.error(f"Error estimating gas of transactions: {e}")
+        gas = None
+    return passing_indexes, gas
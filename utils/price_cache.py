@@ -0,0 +1,116 @@
+import functools
+import threading
+from concurrent.futures import Future
+
+
+class PriceCache:
+    """
+    Caches price service responses until the next block.
+
+    Concurrent requests for the same key share a single fetch.
+    """
+
+    def __init__(self):
+        self.block_number = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def new_block(self, block_number):
+        """Drop every cached price when a new block arrives"""
+        with self._lock:
+            if block_number != self.block_number:
+                self.block_number = block_number
+                self._entries = {}
+
+    def get_futures(self, keys):
+        """
+        Get the futures for a list of keys, reserving the missing ones.
+
+        :return: a tuple of a dict of futures by key, and the list of keys that
+            the caller must fetch and resolve with ``resolve``
+        :rtype: tuple
+        """
+        futures = {}
+        missing_keys = []
+        with self._lock:
+            for key in keys:
+                if key not in self._entries:
+                    self._entries[key] = Future()
+                    missing_keys.append(key)
+                futures[key] = self._entries[key]
+        return futures, missing_keys
+
+    def resolve(self, futures, keys, fetch_fn):
+        """Call ``fetch_fn`` and set its result, or error, on the futures for ``keys``"""
+        try:
+            result = fetch_fn()
+        except Exception as e:
+            with self._lock:
+                for key in keys:
+                    # do not cache failures
+                    if self._entries.get(key) is futures[key]:
+                        del self._entries[key]
+            for key in keys:
+                futures[key].set_exception(e)
+            raise
+
+        for key in keys:
+            futures[key].set_result(result)
+        return result
+
+    def get(self, key, fetch_fn):
+        """Get a cached value, calling ``fetch_fn`` to fetch it if missing"""
+        futures, missing_keys = self.get_futures([key])
+        if len(missing_keys) > 0:
+            return self.resolve(futures, missing_keys, fetch_fn)
+        return futures[key].result()
+
+
+class PriceFetchError(Exception):
+    """Raised when a price fetch returns nothing, so the failure is not cached"""
+
+
+def install_price_cache(snx, price_cache):
+    """
+    Route the price fetches of the Pyth client of ``snx`` through ``price_cache``.
+
+    This covers the fetches made for ERC-7412 oracle data by the SDK. Prices are
+    cached per feed and publish time, and only the missing feeds are fetched.
+    """
+    pyth = snx.pyth
+
+    get_price_from_ids = pyth.get_price_from_ids
+
+    @functools.wraps(get_price_from_ids)
+    def cached_get_price_from_ids(feed_ids, publish_time=None):
+        def fetch(fetch_feed_ids):
+            pyth_data = get_price_from_ids(fetch_feed_ids, publish_time=publish_time)
+            if pyth_data is None:
+                raise PriceFetchError(f"No price data for {fetch_feed_ids}")
+            return pyth_data
+
+        keys = [("pyth", feed_id, publish_time) for feed_id in feed_ids]
+        futures, missing_keys = price_cache.get_futures(keys)
+        try:
+            if len(missing_keys) > 0:
+                missing_feed_ids = [key[1] for key in missing_keys]
+                price_cache.resolve(
+                    futures, missing_keys, lambda: fetch(missing_feed_ids)
+                )
+            results = [futures[key].result() for key in keys]
+        except PriceFetchError:
+            # the client logged the error, callers expect None
+            return None
+
+        # merge the responses covering the requested feeds
+        pyth_data = {"timestamp": None, "price_update_data": [], "meta": {}}
+        for result in results:
+            if pyth_data["timestamp"] is None:
+                pyth_data["timestamp"] = result["timestamp"]
+            for data in result["price_update_data"]:
+                if data not in pyth_data["price_update_data"]:
+                    pyth_data["price_update_data"].append(data)
+            pyth_data["meta"].update(result["meta"])
+        return pyth_data
+
+    pyth.get_price_from_ids = cached_get_price_from_ids
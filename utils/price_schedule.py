@@ -0,0 +1,77 @@
+import heapq
+from eth_abi import decode
+from eth_utils import decode_hex
+
+
+class PriceSchedule:
+    """Priority queue of the times at which price feeds go stale"""
+
+    def __init__(self, staleness_tolerance):
+        self.staleness_tolerance = staleness_tolerance
+        self.deadlines = {}
+        self._heap = []
+
+    def update(self, feed_id, publish_time):
+        """Record the latest on-chain publish time of a feed"""
+        deadline = publish_time + self.staleness_tolerance
+        self.deadlines[feed_id] = deadline
+        heapq.heappush(self._heap, (deadline, feed_id))
+
+    def next_deadline(self):
+        """Get the earliest deadline, or None if no feeds are scheduled"""
+        self._drop_outdated()
+        return self._heap[0][0] if len(self._heap) > 0 else None
+
+    def pop_due(self, until):
+        """Remove and return the feeds whose deadline is at or before ``until``"""
+        due_feeds = []
+        self._drop_outdated()
+        while len(self._heap) > 0 and self._heap[0][0] <= until:
+            _, feed_id = heapq.heappop(self._heap)
+            del self.deadlines[feed_id]
+            due_feeds.append(feed_id)
+            self._drop_outdated()
+        return due_feeds
+
+    def _drop_outdated(self):
+        # entries are replaced lazily when a feed is updated
+        while len(self._heap) > 0:
+            deadline, feed_id = self._heap[0]
+            if self.deadlines.get(feed_id) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+
+def get_publish_times(snx, feed_ids):
+    """
+    Read the on-chain publish time of each feed.
+
+    Feeds without a price on-chain get a publish time of 0.
+
+    :return: dict of publish times by feed id
+    :rtype: dict
+    """
+    pyth_contract = snx.contracts["Pyth"]["contract"]
+    calls = [
+        (
+            pyth_contract.address,
+            True,
+            0,
+            pyth_contract.encodeABI(
+                fn_name="getPriceUnsafe", args=[decode_hex(feed_id)]
+            ),
+        )
+        for feed_id in feed_ids
+    ]
+    results = snx.multicall.functions.aggregate3Value(calls).call()
+
+    publish_times = {}
+    for feed_id, (success, return_data) in zip(feed_ids, results):
+        if success:
+            _, _, _, publish_time = decode(
+                ["int64", "uint64", "int32", "uint256"], return_data
+            )
+            publish_times[feed_id] = publish_time
+        else:
+            publish_times[feed_id] = 0
+    return publish_times
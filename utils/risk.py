@@ -0,0 +1,9 @@
+import os
+
+# accounts are bucketed by health, the ratio of their margin to the margin at
+# which they become liquidatable. A health of 1 or less is liquidatable.
+CRITICAL_HEALTH = os.getenv("RISK_CRITICAL_HEALTH")
+WARNING_HEALTH = os.getenv("RISK_WARNING_HEALTH")
+
+CRITICAL_HEALTH = 1.25 if CRITICAL_HEALTH is None else float(CRITICAL_HEALTH)
+WARNING_HEALTH = 2 if WARNING_HEALTH is None else float(WARNING_HEALTH)
@@ -0,0 +1,261 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import requests
+from web3.providers.base import JSONBaseProvider
+from utils.metrics import RPC_HEDGES, RPC_EJECTIONS
+from utils.parallel import MAX_IN_FLIGHT
+
+# methods that only read state and can be sent to any endpoint
+READ_METHODS = {
+    "eth_blockNumber",
+    "eth_call",
+    "eth_chainId",
+    "eth_estimateGas",
+    "eth_feeHistory",
+    "eth_gasPrice",
+    "eth_getBalance",
+    "eth_getBlockByNumber",
+    "eth_getCode",
+    "eth_getLogs",
+    "eth_getStorageAt",
+    "eth_getTransactionReceipt",
+    "eth_maxPriorityFeePerGas",
+}
+
+# position of the block parameter of reads pinned to the pool's head
+BLOCK_PARAM_INDEX = {
+    "eth_call": 1,
+    "eth_getBalance": 1,
+    "eth_getCode": 1,
+    "eth_getStorageAt": 2,
+}
+
+# errors from endpoints that are behind the pinned block or rate limiting,
+# other errors are valid answers, such as reverts
+RETRYABLE_ERRORS = [
+    "header not found",
+    "unknown block",
+    "block not found",
+    "missing trie node",
+    "rate limit",
+    "too many requests",
+]
+
+
+class EndpointError(Exception):
+    """An endpoint failed to answer a request"""
+
+
+class Endpoint:
+    """
+    An rpc endpoint with a persistent session and its recent latencies.
+
+    At most ``max_in_flight`` requests are sent to the endpoint at once.
+    """
+
+    def __init__(self, uri, timeout, history, max_in_flight=MAX_IN_FLIGHT):
+        self.uri = uri
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.latencies = deque(maxlen=history)
+        self.failures = 0
+        self.ejected_until = 0
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+
+    def is_healthy(self):
+        return time.time() >= self.ejected_until
+
+    def is_busy(self):
+        return self.in_flight >= self.max_in_flight
+
+    def get_latency(self, percentile):
+        if len(self.latencies) == 0:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, len(latencies) * percentile // 100)]
+
+    def post(self, request_data):
+        response = self.session.post(
+            self.uri,
+            data=request_data,
+            headers={"Content-Type": "application/json"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return response.content
+
+
+class RpcPool(JSONBaseProvider):
+    """
+    Web3 provider spreading reads over several endpoints.
+
+    Reads go to the fastest healthy endpoint. If it has not answered after its
+    ``hedge_percentile`` latency, the read is also sent to the next endpoint and
+    the first answer is used. Endpoints failing ``eject_after`` times in a row
+    are skipped for ``eject_seconds``. Once a head is set with ``set_head``,
+    reads of the latest state are pinned to that block on every endpoint.
+    Writes and every other request go to the primary endpoint.
+
+    Each endpoint has at most ``max_in_flight`` reads in flight, and endpoints
+    at their limit are tried last, so the pool as a whole serves
+    ``max_in_flight`` reads per endpoint.
+    """
+
+    def __init__(
+        self,
+        primary_uri,
+        read_uris,
+        timeout=120,
+        read_timeout=30,
+        hedge_percentile=90,
+        min_hedge_delay=0.25,
+        eject_after=3,
+        eject_seconds=60,
+        history=100,
+        max_in_flight=MAX_IN_FLIGHT,
+    ):
+        super().__init__()
+        self.endpoint_uri = primary_uri
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+
+        self.primary = Endpoint(primary_uri, timeout, history, max_in_flight)
+        self.readers = [self.primary] + [
+            Endpoint(uri, read_timeout, history, max_in_flight)
+            for uri in read_uris
+            if uri != primary_uri
+        ]
+        self.max_in_flight = max_in_flight * len(self.readers)
+
+        self.head = None
+        self._lock = threading.Lock()
+        # room for a hedge of every read in flight
+        self._executor = ThreadPoolExecutor(max_workers=2 * self.max_in_flight)
+
+    def set_head(self, block_number):
+        """Pin reads of the latest state to ``block_number``, or later blocks"""
+        with self._lock:
+            if self.head is None or block_number > self.head:
+                self.head = block_number
+
+    def make_request(self, method, params):
+        if method not in READ_METHODS:
+            request_data = self.encode_rpc_request(method, params)
+            return self.decode_rpc_response(self.primary.post(request_data))
+
+        params = self._pin_params(method, params)
+        request_data = self.encode_rpc_request(method, params)
+        return self._hedged_request(request_data)
+
+    def _pin_params(self, method, params):
+        ind = BLOCK_PARAM_INDEX.get(method)
+        head = self.head
+        if ind is None or head is None:
+            return params
+
+        params = list(params)
+        if len(params) <= ind:
+            params.extend([None] * (ind + 1 - len(params)))
+        if params[ind] in [None, "latest"]:
+            params[ind] = hex(head)
+        return params
+
+    def _get_readers(self):
+        """Healthy endpoints, fastest first, or every endpoint if none are healthy"""
+        readers = [endpoint for endpoint in self.readers if endpoint.is_healthy()]
+        if len(readers) == 0:
+            readers = list(self.readers)
+
+        # endpoints at their limit go last, endpoints without latency samples
+        # are tried first to measure them
+        return sorted(
+            readers,
+            key=lambda endpoint: (endpoint.is_busy(), endpoint.get_latency(50) or 0),
+        )
+
+    def _send(self, endpoint, request_data):
+        with endpoint.slots:
+            with self._lock:
+                endpoint.in_flight += 1
+            try:
+                return self._send_request(endpoint, request_data)
+            finally:
+                with self._lock:
+                    endpoint.in_flight -= 1
+
+    def _send_request(self, endpoint, request_data):
+        start_time = time.time()
+        try:
+            response = self.decode_rpc_response(endpoint.post(request_data))
+            error = response.get("error")
+            if error is not None:
+                message = str(error.get("message", "")).lower()
+                if any(pattern in message for pattern in RETRYABLE_ERRORS):
+                    raise EndpointError(f"{endpoint.uri}: {error}")
+        except Exception:
+            self._record_failure(endpoint)
+            raise
+
+        with self._lock:
+            endpoint.latencies.append(time.time() - start_time)
+            endpoint.failures = 0
+        return response
+
+    def _record_failure(self, endpoint):
+        with self._lock:
+            endpoint.failures += 1
+            if endpoint.failures >= self.eject_after and endpoint.is_healthy():
+                endpoint.ejected_until = time.time() + self.eject_seconds
+                RPC_EJECTIONS.inc()
+
+    def _hedged_request(self, request_data):
+        readers = self._get_readers()
+        pending = set()
+        error = None
+        for ind, endpoint in enumerate(readers):
+            pending.add(self._executor.submit(self._send, endpoint, request_data))
+            if ind > 0:
+                RPC_HEDGES.inc()
+
+            # wait for an answer before hedging to the next endpoint
+            is_last = ind == len(readers) - 1
+            hedge_delay = endpoint.get_latency(self.hedge_percentile)
+            hedge_delay = max(self.min_hedge_delay, hedge_delay or 0)
+            while len(pending) > 0:
+                done, pending = wait(
+                    pending,
+                    timeout=None if is_last else hedge_delay,
+                    return_when=FIRST_COMPLETED,
+                )
+                if len(done) == 0:
+                    # too slow, hedge to the next endpoint
+                    break
+
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+
+                if not is_last:
+                    # failed, try the next endpoint now
+                    break
+
+        raise error
+
+
+def install_rpc_pool(snx, read_uris, **kwargs):
+    """
+    Route the reads of ``snx`` through a pool of ``read_uris``.
+
+    The endpoint ``snx`` was created with stays the primary, and is used for
+    writes and as one of the readers.
+    """
+    pool = RpcPool(snx.provider_rpc, read_uris, **kwargs)
+    snx.web3.provider = pool
+    return pool
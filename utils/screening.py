@@ -0,0 +1,214 @@
+import threading
+import numpy as np
+from utils.risk import CRITICAL_HEALTH, WARNING_HEALTH
+
+
+def get_market_prices(snx, market_ids):
+    """
+    Get the latest Pyth price of each market with a price feed.
+
+    :return: dict of ``{market_id: price}``, markets without a price are left out
+    :rtype: dict
+    """
+    feed_ids = {}
+    for market_id in market_ids:
+        market = snx.perps.markets_by_id.get(market_id, {})
+        if "feed_id" in market:
+            feed_ids[market_id] = market["feed_id"]
+    if len(feed_ids) == 0:
+        return {}
+
+    pyth_data = snx.pyth.get_price_from_ids(sorted(set(feed_ids.values())))
+    if pyth_data is None:
+        return {}
+
+    meta = pyth_data["meta"]
+    return {
+        market_id: meta[feed_id]["price"]
+        for market_id, feed_id in feed_ids.items()
+        if feed_id in meta
+    }
+
+
+class MarginScreen:
+    """
+    Estimates the health of every active account from cached positions.
+
+    The margins and positions recorded in the account index at each refresh
+    are loaded into arrays. For new prices, the margin of each account is moved
+    by the pnl of its positions since they were read, and its required margin
+    is scaled with its notional value, in one vectorized pass. Accounts are
+    then checked on-chain according to their estimated health, so only
+    accounts near the liquidation threshold are checked every block.
+
+    As a backstop for estimates that drift from the on-chain state, a sweep
+    also rotates through the healthy accounts, checking each of them once
+    every ``sweep_blocks`` blocks.
+    """
+
+    def __init__(self, sweep_blocks=100):
+        self.sweep_blocks = sweep_blocks
+        self.sweep_offset = 0
+        self.account_ids = []
+        self.unscreened_ids = []
+        self.market_ids = []
+        self._arrays = None
+        self._lock = threading.Lock()
+
+    def load(self, account_index, account_ids):
+        """
+        Load the margins of ``account_ids`` recorded in the account index.
+
+        Accounts with isolated margin are loaded as (account id, market id) pairs.
+        """
+        margins = account_index["margins"]
+        screened_ids = [
+            account_id for account_id in account_ids if account_id in margins
+        ]
+        unscreened_ids = [
+            account_id for account_id in account_ids if account_id not in margins
+        ]
+        market_ids = sorted(
+            {
+                position[0]
+                for account_id in screened_ids
+                for position in margins[account_id]["positions"]
+            }
+        )
+        market_rows = {market_id: ind for ind, market_id in enumerate(market_ids)}
+
+        position_accounts = []
+        position_markets = []
+        sizes = []
+        prices = []
+        for ind, account_id in enumerate(screened_ids):
+            for market_id, size, price in margins[account_id]["positions"]:
+                position_accounts.append(ind)
+                position_markets.append(market_rows[market_id])
+                sizes.append(size)
+                prices.append(price)
+
+        arrays = {
+            "margins": np.array(
+                [margins[account_id]["margin"] for account_id in screened_ids],
+                dtype=float,
+            ),
+            "required": np.array(
+                [margins[account_id]["required"] for account_id in screened_ids],
+                dtype=float,
+            ),
+            "position_accounts": np.array(position_accounts, dtype=np.int64),
+            "position_markets": np.array(position_markets, dtype=np.int64),
+            "sizes": np.array(sizes, dtype=float),
+            "prices": np.array(prices, dtype=float),
+        }
+
+        # swap in the new arrays at once, estimates may run in another thread
+        with self._lock:
+            self.account_ids = screened_ids
+            self.unscreened_ids = unscreened_ids
+            self.market_ids = market_ids
+            self._arrays = arrays
+
+    def mark_due(self, account_ids):
+        """
+        Keep accounts in the critical band until the next load, such as accounts
+        found liquidatable or whose liquidation check failed.
+        """
+        account_rows = set(account_ids)
+        with self._lock:
+            if self._arrays is None:
+                return
+            for ind, account_id in enumerate(self.account_ids):
+                if account_id in account_rows:
+                    self._arrays["margins"][ind] = -np.inf
+
+    def estimate_health(self, prices):
+        """
+        Estimate the health of the loaded accounts at new market prices.
+
+        :param prices: dict of ``{market_id: price}``, markets without a price
+            are valued at the price their positions were read at
+
+        :return: a tuple of the account ids and an array of their health
+        :rtype: tuple
+        """
+        with self._lock:
+            account_ids = self.account_ids
+            market_ids = self.market_ids
+            arrays = self._arrays
+        if arrays is None or len(account_ids) == 0:
+            return [], np.zeros(0)
+
+        num_accounts = len(account_ids)
+        position_accounts = arrays["position_accounts"]
+        sizes = arrays["sizes"]
+        entry_prices = arrays["prices"]
+
+        market_prices = np.array(
+            [prices.get(market_id, np.nan) for market_id in market_ids], dtype=float
+        )
+        current_prices = market_prices[arrays["position_markets"]]
+        current_prices = np.where(
+            np.isnan(current_prices), entry_prices, current_prices
+        )
+
+        pnl = np.bincount(
+            position_accounts,
+            weights=sizes * (current_prices - entry_prices),
+            minlength=num_accounts,
+        )
+        entry_notional = np.bincount(
+            position_accounts,
+            weights=np.abs(sizes) * entry_prices,
+            minlength=num_accounts,
+        )
+        current_notional = np.bincount(
+            position_accounts,
+            weights=np.abs(sizes) * current_prices,
+            minlength=num_accounts,
+        )
+        notional_ratio = np.divide(
+            current_notional,
+            entry_notional,
+            out=np.ones(num_accounts),
+            where=entry_notional > 0,
+        )
+
+        margins = arrays["margins"] + pnl
+        required = arrays["required"] * notional_ratio
+        health = np.divide(
+            margins,
+            required,
+            out=np.full(num_accounts, np.inf),
+            where=required > 0,
+        )
+        return account_ids, health
+
+    def get_due_accounts(self, prices, check_warning=False):
+        """
+        Choose the loaded accounts to check for liquidation in this block.
+
+        Accounts with an estimated health under ``CRITICAL_HEALTH`` are checked
+        every block, and under ``WARNING_HEALTH`` when ``check_warning`` is set.
+        Healthier accounts are checked by the sweep, the next
+        ``1 / sweep_blocks`` of the accounts on each call. Accounts without
+        recorded margins are checked every block.
+
+        :return: the account ids to check
+        :rtype: list
+        """
+        screened_ids, health = self.estimate_health(prices)
+        is_due = health <= (WARNING_HEALTH if check_warning else CRITICAL_HEALTH)
+        with self._lock:
+            unscreened_ids = list(self.unscreened_ids)
+            num_accounts = len(screened_ids)
+            if num_accounts > 0 and self.sweep_blocks > 0:
+                sweep_size = -(-num_accounts // self.sweep_blocks)
+                sweep_start = self.sweep_offset % num_accounts
+                self.sweep_offset = sweep_start + sweep_size
+                sweep_rows = np.arange(sweep_start, sweep_start + sweep_size)
+                is_due[sweep_rows % num_accounts] = True
+        return unscreened_ids + [
+            screened_ids[ind] for ind in np.flatnonzero(is_due).tolist()
+        ]
@@ -0,0 +1,193 @@
+import time
+import heapq
+import itertools
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from eth_abi import encode
+from eth_utils import decode_hex
+
+# ERC-7412 update type for a price at a specific timestamp
+PRICE_AT_TIME_UPDATE_TYPE = 2
+
+
+def get_event_arg(event, name):
+    """Get an event argument, or None if the event does not have it"""
+    try:
+        return event[name]
+    except (KeyError, AttributeError, IndexError):
+        return None
+
+
+def get_market_config(snx, market_id):
+    """Get the configuration of a BFP market, or None for other perps markets"""
+    market_meta = getattr(snx.perps, "market_meta", {}).get(market_id, {})
+    return market_meta.get("system_config")
+
+
+def get_settlement_time(snx, order_committed_event, settle_delay=0):
+    """
+    Get the earliest time an order can be settled.
+
+    Uses the settlement time from the event when it is emitted, as V3 perps do,
+    otherwise the commitment time plus the minimum order age of the BFP market.
+    Orders are never settled sooner than ``settle_delay`` seconds from now.
+    """
+    earliest_time = time.time() + settle_delay
+
+    settlement_time = get_event_arg(order_committed_event, "settlementTime")
+    if settlement_time is None:
+        commitment_time = get_event_arg(order_committed_event, "commitmentTime")
+        config = get_market_config(snx, order_committed_event["marketId"])
+        if commitment_time is not None and config is not None:
+            settlement_time = commitment_time + config["min_order_age"]
+
+    if settlement_time is None:
+        return earliest_time
+    return max(earliest_time, settlement_time)
+
+
+def fetch_price_update_data(
+    price_service_endpoint, feed_ids, publish_time=None, price_cache=None
+):
+    """
+    Fetch one Pyth price update covering several feeds.
+
+    :param price_service_endpoint: url of the Pyth price service
+    :param feed_ids: list of hex feed ids
+    :param publish_time: timestamp of the prices, or None for the latest prices
+    :param price_cache: optional ``PriceCache``, only feeds missing from the
+        cache are fetched
+
+    :return: list of price update data
+    :rtype: list
+    """
+
+    def fetch(fetch_feed_ids):
+        path = "latest" if publish_time is None else str(publish_time)
+        params = [("ids[]", feed_id) for feed_id in fetch_feed_ids]
+        params.append(("encoding", "hex"))
+        response = requests.get(
+            f"{price_service_endpoint}/v2/updates/price/{path}",
+            params=params,
+            timeout=10,
+        )
+        response.raise_for_status()
+        return [decode_hex(data) for data in response.json()["binary"]["data"]]
+
+    if price_cache is None:
+        return fetch(feed_ids)
+
+    # fetch the missing feeds together, and wait for feeds fetched by others
+    keys = [("update", feed_id, publish_time) for feed_id in feed_ids]
+    futures, missing_keys = price_cache.get_futures(keys)
+    if len(missing_keys) > 0:
+        missing_feed_ids = [key[1] for key in missing_keys]
+        price_cache.resolve(futures, missing_keys, lambda: fetch(missing_feed_ids))
+
+    price_update_data = []
+    for key in keys:
+        for data in futures[key].result():
+            if data not in price_update_data:
+                price_update_data.append(data)
+    return price_update_data
+
+
+def get_update_fee(snx, price_update_data):
+    """Get the fee charged by Pyth to verify price update data"""
+    pyth_contract = snx.contracts["Pyth"]["contract"]
+    return pyth_contract.functions.getUpdateFee(price_update_data).call()
+
+
+def build_oracle_fulfillment_call(snx, feed_ids, publish_time, price_update_data):
+    """
+    Build an ERC-7412 call fulfilling prices for several feeds at a timestamp.
+
+    :return: a multicall call tuple for the Pyth ERC-7412 wrapper
+    :rtype: tuple
+    """
+    wrapper = snx.contracts["pyth_erc7412_wrapper"]["PythERC7412Wrapper"]["contract"]
+    signed_data = encode(
+        ["uint8", "uint64", "bytes32[]", "bytes[]"],
+        [
+            PRICE_AT_TIME_UPDATE_TYPE,
+            publish_time,
+            [decode_hex(feed_id) for feed_id in feed_ids],
+            price_update_data,
+        ],
+    )
+    return (
+        wrapper.address,
+        False,
+        get_update_fee(snx, price_update_data),
+        wrapper.encodeABI(fn_name="fulfillOracleQuery", args=[signed_data]),
+    )
+
+
+class SettlementQueue:
+    """
+    Holds committed orders until their settlement time, then settles them.
+
+    Orders that become due together are passed to ``settle_fn`` as one list, and
+    lists are settled concurrently on a worker pool, so a burst of commits does
+    not settle one after another. After the first order is due, the queue waits
+    ``batch_window`` seconds to collect orders due at nearly the same time.
+    """
+
+    def __init__(self, snx, settle_fn, max_workers=8, batch_window=0.2):
+        self.snx = snx
+        self.settle_fn = settle_fn
+        self.batch_window = batch_window
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def add(self, order_committed_event, settlement_time):
+        """Queue an order to be settled at ``settlement_time``"""
+        with self._condition:
+            heapq.heappush(
+                self._queue,
+                (settlement_time, next(self._counter), order_committed_event),
+            )
+            self._condition.notify()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._queue)
+
+    def _pop_due(self):
+        """Wait until at least one order is due and pop all due orders"""
+        with self._condition:
+            while True:
+                now = time.time()
+                if len(self._queue) > 0 and self._queue[0][0] <= now:
+                    break
+                timeout = self._queue[0][0] - now if len(self._queue) > 0 else None
+                self._condition.wait(timeout)
+
+        # let orders due at nearly the same time join the batch
+        time.sleep(self.batch_window)
+
+        with self._condition:
+            now = time.time()
+            due_orders = []
+            while len(self._queue) > 0 and self._queue[0][0] <= now:
+                due_orders.append(heapq.heappop(self._queue)[2])
+            return due_orders
+
+    def _dispatch(self):
+        while True:
+            self._executor.submit(self._settle, self._pop_due())
+
+    def _settle(self, order_committed_events):
+        try:
+            self.settle_fn(order_committed_events)
+        except Exception as e:
+            self.snx.logger.error(
+                f"Error settling orders {order_committed_events}: {e}"
+            )
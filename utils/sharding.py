@@ -0,0 +1,116 @@
+import os
+import time
+import hashlib
+import threading
+from utils.snapshot import write_json, read_json
+
+# seconds a signer claim holds without being renewed, running shards renew
+# their claims well within it
+SIGNER_CLAIM_TTL = 3600
+
+
+def get_shard_weight(account_id, shard_index):
+    """Hash an account id with a shard index"""
+    digest = hashlib.blake2b(
+        f"{account_id}:{shard_index}".encode(), digest_size=8
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+def get_account_shard(account_id, shard_count):
+    """Get the index of the shard owning ``account_id``"""
+    return max(
+        range(shard_count),
+        key=lambda shard_index: get_shard_weight(account_id, shard_index),
+    )
+
+
+class Shard:
+    """
+    One of ``count`` keeper replicas splitting the accounts between them.
+
+    Accounts are assigned with rendezvous hashing: each account belongs to the
+    shard with the highest hash of the account id and shard index. When the
+    number of shards changes, only the accounts of the added or removed shards
+    move, so replicas keep most of their accounts across a rebalance.
+    """
+
+    def __init__(self, index=0, count=1):
+        if count < 1 or not 0 <= index < count:
+            raise ValueError(f"Invalid shard {index} of {count}")
+        self.index = index
+        self.count = count
+        self._owned = {}
+        self._lock = threading.Lock()
+
+    def owns(self, account_id):
+        """Check if this shard owns ``account_id``"""
+        if self.count == 1:
+            return True
+
+        with self._lock:
+            owned = self._owned.get(account_id)
+        if owned is None:
+            owned = get_account_shard(account_id, self.count) == self.index
+            with self._lock:
+                self._owned[account_id] = owned
+        return owned
+
+    def filter(self, account_ids):
+        """Keep the account ids owned by this shard"""
+        return [account_id for account_id in account_ids if self.owns(account_id)]
+
+
+def get_signer_path(snapshot_dir, bot_name, network_id, shard_index):
+    """Build the path of the file recording the signer of a shard"""
+    return os.path.join(
+        snapshot_dir, f"{bot_name}_{network_id}_shard{shard_index}_signer.json"
+    )
+
+
+def claim_signer(
+    snapshot_dir, bot_name, network_id, shard, address, ttl=SIGNER_CLAIM_TTL
+):
+    """
+    Check that no other shard uses the signer of ``shard``, then claim it.
+
+    Replicas sharing a signer send transactions with colliding nonces, so every
+    shard must sign with its own key. Claims are kept in ``snapshot_dir``, which
+    the replicas must share for the check to see each other. Claims made for
+    another shard layout, or not renewed in ``ttl`` seconds, are ignored, and
+    calling this again renews the claim.
+
+    :raises ValueError: if another shard of the same layout claimed ``address``
+    """
+    if shard.count == 1 or address is None:
+        return
+
+    address = address.lower()
+    now = time.time()
+    for shard_index in range(shard.count):
+        if shard_index == shard.index:
+            continue
+        claim = read_json(
+            get_signer_path(snapshot_dir, bot_name, network_id, shard_index)
+        )
+        if (
+            claim is not None
+            and claim.get("shard_index") == shard_index
+            and claim.get("shard_count") == shard.count
+            and now - claim.get("claimed_at", 0) <= ttl
+            and claim.get("address") == address
+        ):
+            raise ValueError(
+                f"Shard {shard.index} signs with {address}, the signer of shard "
+                f"{shard_index}. Give every shard its own PRIVATE_KEY and ADDRESS."
+            )
+
+    write_json(
+        get_signer_path(snapshot_dir, bot_name, network_id, shard.index),
+        {
+            "address": address,
+            "shard_index": shard.index,
+            "shard_count": shard.count,
+            "claimed_at": now,
+        },
+    )
@@ -0,0 +1,107 @@
+import os
+import json
+
+SNAPSHOT_VERSION = 5
+
+
+def get_snapshot_path(snapshot_dir, bot_name, network_id, shard_index=0):
+    """Build the snapshot file path for a bot on a network"""
+    # the first shard shares the snapshot of an unsharded bot
+    suffix = "" if shard_index == 0 else f"_shard{shard_index}"
+    return os.path.join(snapshot_dir, f"{bot_name}_{network_id}{suffix}.json")
+
+
+def write_json(path, data):
+    """Write json to disk, replacing any previous file"""
+    # write to a temporary file first so a crash never leaves a partial file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """Read json from disk, or None if the file is missing or unreadable"""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_key(key):
+    """Format an account id, or an (account id, market id) pair, as a json key"""
+    if isinstance(key, tuple):
+        return ":".join(str(part) for part in key)
+    return str(key)
+
+
+def parse_key(key):
+    """Parse a json key written by ``format_key``"""
+    parts = [int(part) for part in key.split(":")]
+    return parts[0] if len(parts) == 1 else tuple(parts)
+
+
+def save_snapshot(path, network_id, block_number, account_index):
+    """Write the account index to disk, replacing any previous snapshot"""
+    snapshot = {
+        "version": SNAPSHOT_VERSION,
+        "network_id": network_id,
+        "block_number": block_number,
+        "cursor": account_index["cursor"],
+        "account_ids": account_index["account_ids"],
+        "dead_offset": account_index["dead_offset"],
+        # json keys must be strings
+        "values": {
+            str(account_id): value
+            for account_id, value in account_index["values"].items()
+        },
+        "margins": {
+            format_key(key): margins
+            for key, margins in account_index["margins"].items()
+        },
+        "markets": {
+            str(account_id): market_ids
+            for account_id, market_ids in account_index["markets"].items()
+        },
+    }
+
+    write_json(path, snapshot)
+
+
+def load_snapshot(path, network_id):
+    """
+    Load an account index snapshot from disk.
+
+    :return: a tuple of the account index and the block it was read at, or
+        ``(None, None)`` if there is no usable snapshot
+    :rtype: tuple
+    """
+    snapshot = read_json(path)
+    if (
+        snapshot is None
+        or snapshot.get("version") != SNAPSHOT_VERSION
+        or snapshot.get("network_id") != network_id
+    ):
+        return None, None
+
+    account_index = {
+        "cursor": snapshot["cursor"],
+        "account_ids": snapshot["account_ids"],
+        "values": {
+            int(account_id): value for account_id, value in snapshot["values"].items()
+        },
+        "margins": {
+            parse_key(key): margins for key, margins in snapshot["margins"].items()
+        },
+        "markets": {
+            int(account_id): market_ids
+            for account_id, market_ids in snapshot["markets"].items()
+        },
+        "dead_offset": snapshot["dead_offset"],
+    }
+    return account_index, snapshot["block_number"]
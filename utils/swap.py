@@ -1,5 +1,6 @@
 import requests
 from synthetix import Synthetix
+from utils.transactions import send_transaction
 
 address_url = "https://api.odos.xyz/info/router/v2"
 quote_url = "https://api.odos.xyz/sor/quote/v2"
@@ -7,7 +8,7 @@ assemble_url = "https://api.odos.xyz/sor/assemble"
 
 
 # approvals
-def base_approvals(snx):
+def base_approvals(snx, pipeline=None):
     # get odos address
     address_response = requests.get(f"{address_url}/{snx.network_id}")
     address_json = address_response.json()
@@ -32,25 +33,29 @@ def base_approvals(snx):
         tx_approve_susd = snx.approve(
             snx.contracts["system"]["USDProxy"]["address"],
             snx.spot.market_proxy.address,
-            submit=True,
+            submit=False,
+        )
+        receipt_approve_susd = send_transaction(
+            snx, tx_approve_susd, pipeline, urgency="swap"
         )
-        receipt_approve_susd = snx.wait(tx_approve_susd)
 
     # approve sUSDC to spot market
     if susdc_allowance == 0:
         tx_approve_susdc = snx.approve(
             snx.spot.markets_by_name["sUSDC"]["contract"].address,
             snx.spot.market_proxy.address,
-            submit=True,
+            submit=False,
+        )
+        receipt_approve_susdc = send_transaction(
+            snx, tx_approve_susdc, pipeline, urgency="swap"
         )
-        receipt_approve_susdc = snx.wait(tx_approve_susdc)
 
     if usdc_allowance == 0:
-        approve_tx = snx.approve(usdc_contract.address, odos_address, submit=True)
-        approve_receipt = snx.wait(approve_tx)
+        approve_tx = snx.approve(usdc_contract.address, odos_address, submit=False)
+        approve_receipt = send_transaction(snx, approve_tx, pipeline, urgency="swap")
 
 
-def arbitrum_approvals(snx):
+def arbitrum_approvals(snx, pipeline=None):
     # get odos address
     address_response = requests.get(f"{address_url}/{snx.network_id}")
     address_json = address_response.json()
@@ -70,9 +75,11 @@ def arbitrum_approvals(snx):
         tx_approve_susd = snx.approve(
             snx.contracts["system"]["USDProxy"]["address"],
             odos_address,
-            submit=True,
+            submit=False,
+        )
+        receipt_approve_susd = send_transaction(
+            snx, tx_approve_susd, pipeline, urgency="swap"
         )
-        receipt_approve_susd = snx.wait(tx_approve_susd)
 
 
 def get_quote(snx, amount, token_in, token_out):
@@ -140,8 +147,13 @@ def build_swap(snx, amount_in, token_in, token_out):
         raise Exception("Error in Transaction Assembly")
 
 
-def execute_base_swap(snx, swap_threshold):
-    """Swaps sUSD -> sUSDC -> USDC -> WETH -> ETH"""
+def execute_base_swap(snx, swap_threshold, pipeline=None):
+    """
+    Swaps sUSD -> sUSDC -> USDC -> WETH -> ETH
+
+    Each step waits for the previous one to be mined. With a transaction
+    ``pipeline`` the waits do not hold up transactions sent by other handlers.
+    """
     # contracts
     weth_contract = snx.contracts["WETH"]["contract"]
     usdc_contract = snx.contracts["USDC"]["contract"]
@@ -172,21 +184,25 @@ def execute_base_swap(snx, swap_threshold):
 
     if odos_swap_amount > swap_threshold:
         # check approvals
-        base_approvals(snx)
+        base_approvals(snx, pipeline)
 
         if spot_swap_amount > 0:
             tx_swap_susd = snx.spot.atomic_order(
-                "buy", spot_swap_amount, market_name="sUSDC", submit=True
+                "buy", spot_swap_amount, market_name="sUSDC", submit=False
+            )
+            receipt_swap_susd = send_transaction(
+                snx, tx_swap_susd, pipeline, urgency="swap"
             )
-            receipt_swap_susd = snx.wait(tx_swap_susd)
             assert receipt_swap_susd["status"] == 1
 
         # unwrap the sUSDC
         if spot_unwrap_amount > 0:
             tx_unwrap_susdc = snx.spot.wrap(
-                -spot_unwrap_amount, market_name="sUSDC", submit=True
+                -spot_unwrap_amount, market_name="sUSDC", submit=False
+            )
+            receipt_unwrap_susdc = send_transaction(
+                snx, tx_unwrap_susdc, pipeline, urgency="swap"
             )
-            receipt_unwrap_susdc = snx.wait(tx_unwrap_susdc)
             assert receipt_unwrap_susdc["status"] == 1
 
         # prepare the swap tx
@@ -204,9 +220,7 @@ def execute_base_swap(snx, swap_threshold):
 
         # remove the gas parameter
         del tx_params["gas"]
-        swap_tx = snx.execute_transaction(tx_params)
-
-        swap_receipt = snx.wait(swap_tx)
+        swap_receipt = send_transaction(snx, tx_params, pipeline, urgency="swap")
         snx.logger.info(f"Swap receipt: {swap_receipt['status']}")
 
     # if balance is above threshold, swap
@@ -214,13 +228,20 @@ def execute_base_swap(snx, swap_threshold):
     if eth_balance["weth"] > 0.01:
         unwrap_amount = -int(eth_balance["weth"] * 1e8) / 1e8
 
-        tx_unwrap_eth = snx.wrap_eth(unwrap_amount, submit=True)
-        receipt_unwrap_eth = snx.wait(tx_unwrap_eth)
+        tx_unwrap_eth = snx.wrap_eth(unwrap_amount, submit=False)
+        receipt_unwrap_eth = send_transaction(
+            snx, tx_unwrap_eth, pipeline, urgency="swap"
+        )
         snx.logger.info(f"Unwrap ETH receipt: {receipt_unwrap_eth['status']}")
 
 
-def execute_arbitrum_swap(snx, swap_threshold):
-    """Swaps sUSD -> WETH -> ETH"""
+def execute_arbitrum_swap(snx, swap_threshold, pipeline=None):
+    """
+    Swaps sUSD -> WETH -> ETH
+
+    With a transaction ``pipeline`` the waits do not hold up transactions sent by
+    other handlers.
+    """
     # contracts
     weth_contract = snx.contracts["WETH"]["contract"]
     susd_contract = snx.contracts["system"]["USDProxy"]["contract"]
@@ -240,7 +261,7 @@ def execute_arbitrum_swap(snx, swap_threshold):
     snx.logger.info(f"Trade route: {swap_amount} sUSD -> WETH")
     if swap_amount > swap_threshold:
         # do approvals
-        arbitrum_approvals(snx)
+        arbitrum_approvals(snx, pipeline)
 
         # prepare the swap tx
         odos_tx_info = build_swap(
@@ -257,9 +278,7 @@ def execute_arbitrum_swap(snx, swap_threshold):
 
         # remove the gas parameter
         del tx_params["gas"]
-        swap_tx = snx.execute_transaction(tx_params)
-
-        swap_receipt = snx.wait(swap_tx)
+        swap_receipt = send_transaction(snx, tx_params, pipeline, urgency="swap")
         snx.logger.info(f"Swap receipt: {swap_receipt['status']}")
 
     # if balance is above threshold, swap
@@ -267,6 +286,8 @@ def execute_arbitrum_swap(snx, swap_threshold):
     if eth_balance["weth"] > 0.01:
         unwrap_amount = -int(eth_balance["weth"] * 1e8) / 1e8
 
-        tx_unwrap_eth = snx.wrap_eth(unwrap_amount, submit=True)
-        receipt_unwrap_eth = snx.wait(tx_unwrap_eth)
+        tx_unwrap_eth = snx.wrap_eth(unwrap_amount, submit=False)
+        receipt_unwrap_eth = send_transaction(
+            snx, tx_unwrap_eth, pipeline, urgency="swap"
+        )
         snx.logger.info(f"Unwrap ETH receipt: {receipt_unwrap_eth['status']}")
@@ -0,0 +1,230 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from utils.metrics import (
+    HANDLER_SECONDS,
+    HANDLER_ERRORS,
+    TASKS_REPLACED,
+    JOB_LAG_BLOCKS,
+    STALE_BLOCKS,
+)
+
+# longest time a task waits for tasks of a higher priority, so housekeeping is
+# not held up forever by a stuck settlement
+MAX_PREEMPT_SECONDS = os.getenv("MAX_PREEMPT_SECONDS")
+MAX_PREEMPT_SECONDS = 10 if MAX_PREEMPT_SECONDS is None else float(MAX_PREEMPT_SECONDS)
+
+# number of running tasks for each priority
+_running = {}
+_condition = threading.Condition()
+_local = threading.local()
+
+
+def get_task_priority():
+    """Get the priority of the task running in this thread, or None"""
+    return getattr(_local, "priority", None)
+
+
+@contextmanager
+def task_priority(priority):
+    """Run the enclosed work as a task of ``priority``, lower numbers first"""
+    previous = get_task_priority()
+    _local.priority = priority
+    with _condition:
+        _running[priority] = _running.get(priority, 0) + 1
+    try:
+        yield
+    finally:
+        with _condition:
+            _running[priority] -= 1
+            if _running[priority] == 0:
+                del _running[priority]
+            _condition.notify_all()
+        _local.priority = previous
+
+
+def wait_for_priority(priority, timeout=MAX_PREEMPT_SECONDS):
+    """
+    Wait while tasks of a higher priority than ``priority`` are running.
+
+    :return: False if the wait timed out
+    :rtype: bool
+    """
+    if priority is None:
+        return True
+    with _condition:
+        return _condition.wait_for(
+            lambda: all(running >= priority for running in _running), timeout
+        )
+
+
+class BlockInterval:
+    """
+    Deadline of work due every ``blocks`` blocks, on multiples of ``blocks``.
+
+    The deadline only moves when the work is completed, so work that falls
+    behind is due once, at the next check, however many multiples it missed.
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.next_block = None
+
+    def is_due(self, block_number):
+        if self.next_block is None:
+            # first due at the next multiple
+            self.next_block = -(-block_number // self.blocks) * self.blocks
+        return block_number >= self.next_block
+
+    def get_lag(self, block_number):
+        """Get the number of blocks since the work was due"""
+        return max(0, block_number - self.next_block)
+
+    def complete(self, block_number):
+        self.next_block = (block_number // self.blocks + 1) * self.blocks
+
+
+class TaskScheduler:
+    """
+    Runs bot work as prioritized background tasks, in lanes.
+
+    Each lane has a priority, lower numbers first, and a limit on its running
+    tasks. While a task runs, tasks of lower priority wait before their next
+    multicall chunk, so settlement preempts housekeeping between rpc requests.
+    A task submitted to a lane at its limit replaces the task of the same
+    function waiting in that lane, so a slow lane runs the latest work instead
+    of a backlog.
+
+    Jobs are tasks due every few blocks. On each block, jobs past their deadline
+    are submitted, unless their previous run is still waiting or running. A job
+    runs for the latest block when it starts, so a job that fell behind catches
+    up with one run, and blocks older than the latest one are dropped.
+
+    With ``background=False`` tasks run in the submitting thread.
+    """
+
+    def __init__(self, snx, background=True):
+        self.snx = snx
+        self.background = background
+        self.lanes = {}
+        self.jobs = {}
+        self.head = None
+        self._lock = threading.Lock()
+
+    def add_lane(self, name, priority, max_tasks=1):
+        """Add a lane of tasks of ``priority`` with at most ``max_tasks`` running"""
+        self.lanes[name] = {
+            "priority": priority,
+            "max_tasks": max_tasks,
+            "running": 0,
+            "waiting": {},
+        }
+
+    def add_job(self, name, fn, lane, blocks=1):
+        """Add a job calling ``fn(block_number)`` in ``lane`` every ``blocks`` blocks"""
+        self.jobs[name] = {
+            "fn": fn,
+            "lane": lane,
+            "interval": BlockInterval(blocks),
+            "pending": False,
+        }
+
+    def is_stale(self, block_number):
+        """Check if a later block was already handled, and count it as dropped"""
+        head = self.head
+        if head is not None and block_number <= head:
+            STALE_BLOCKS.inc()
+            return True
+        return False
+
+    def on_block(self, block_number):
+        """Submit the jobs due at ``block_number``"""
+        with self._lock:
+            if self.head is not None and block_number <= self.head:
+                return
+            self.head = block_number
+
+            due_jobs = []
+            for name, job in self.jobs.items():
+                if not job["pending"] and job["interval"].is_due(block_number):
+                    job["pending"] = True
+                    due_jobs.append(name)
+
+        for name in due_jobs:
+            self.submit(self.jobs[name]["lane"], self._run_job, name, key=name)
+
+    def submit(self, name, fn, *args, key=None):
+        """
+        Run ``fn(*args)`` as a task of lane ``name``.
+
+        :param key: identifies the task replaced by this one if it has to wait,
+            defaults to ``fn``
+
+        :return: True if the task started, False if it waits for the lane
+        :rtype: bool
+        """
+        if not self.background:
+            self._run_task(name, fn, args)
+            return True
+
+        with self._lock:
+            lane = self.lanes[name]
+            if lane["running"] >= lane["max_tasks"]:
+                key = fn if key is None else key
+                if key in lane["waiting"]:
+                    TASKS_REPLACED.inc(lane=name)
+                lane["waiting"][key] = (fn, args)
+                return False
+            lane["running"] += 1
+
+        threading.Thread(
+            target=self._run_lane, args=(name, fn, args), daemon=True
+        ).start()
+        return True
+
+    def run(self, name, fn, *args):
+        """
+        Run ``fn(*args)`` in this thread as a task of lane ``name``
+
+        The task has the priority of the lane, but is not counted against its
+        ``max_tasks``, the caller bounds its own threads.
+        """
+        start_time = time.time()
+        with task_priority(self.lanes[name]["priority"]):
+            try:
+                return fn(*args)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.time() - start_time, handler=name)
+
+    def _run_job(self, name):
+        job = self.jobs[name]
+        with self._lock:
+            block_number = self.head
+            JOB_LAG_BLOCKS.set(job["interval"].get_lag(block_number), job=name)
+        try:
+            job["fn"](block_number)
+        finally:
+            with self._lock:
+                job["interval"].complete(block_number)
+                job["pending"] = False
+
+    def _run_task(self, name, fn, args):
+        try:
+            self.run(name, fn, *args)
+        except Exception as e:
+            self.snx.logger.error(f"Error in {name} task: {e}")
+
+    def _run_lane(self, name, fn, args):
+        while True:
+            self._run_task(name, fn, args)
+            with self._lock:
+                lane = self.lanes[name]
+                if len(lane["waiting"]) == 0:
+                    lane["running"] -= 1
+                    return
+                key = next(iter(lane["waiting"]))
+                fn, args = lane["waiting"].pop(key)
@@ -0,0 +1,146 @@
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from utils.settlement import get_event_arg
+from utils.metrics import SETTLEMENT_STAGE_SECONDS
+
+# number of open traces kept, older traces are dropped
+MAX_OPEN_TRACES = 10000
+
+
+def get_order_key(order_committed_event):
+    """Identify an order by its account, market and commitment block"""
+    return (
+        order_committed_event["accountId"],
+        order_committed_event["marketId"],
+        getattr(order_committed_event, "block_number", None),
+    )
+
+
+def get_percentile(values, percentile):
+    values = sorted(values)
+    ind = min(len(values) - 1, int(len(values) * percentile / 100))
+    return values[ind]
+
+
+class SettlementTracer:
+    """
+    Times each stage of an order's settlement, from commitment to receipt.
+
+    Each call to ``mark`` ends a stage that started at the previous mark. The
+    first stage, ``event_lag``, starts at the commitment time of the order.
+    Finished traces are recorded in the ``keeper_settlement_stage_seconds``
+    histogram, kept for percentile summaries per market, and appended to
+    ``trace_path`` as JSON lines if given.
+    """
+
+    def __init__(self, snx, trace_path=None, history=1000):
+        self.snx = snx
+        self.trace_path = trace_path
+        self.history = history
+
+        self._traces = OrderedDict()
+        self._durations = {}
+        self._lock = threading.Lock()
+
+    def start(self, order_committed_event):
+        """Start a trace when a committed order is received"""
+        now = time.time()
+        commitment_time = get_event_arg(order_committed_event, "commitmentTime")
+        trace = {
+            "account_id": order_committed_event["accountId"],
+            "market_id": order_committed_event["marketId"],
+            "block_number": getattr(order_committed_event, "block_number", None),
+            "committed_at": commitment_time,
+            "last_mark": now,
+            "stages": {},
+        }
+        if commitment_time is not None:
+            trace["stages"]["event_lag"] = max(0, now - commitment_time)
+
+        with self._lock:
+            self._traces[get_order_key(order_committed_event)] = trace
+            while len(self._traces) > MAX_OPEN_TRACES:
+                self._traces.popitem(last=False)
+
+    def mark(self, order_committed_events, stage):
+        """End ``stage`` for each order, timed from its previous mark"""
+        now = time.time()
+        with self._lock:
+            for order_committed_event in order_committed_events:
+                trace = self._traces.get(get_order_key(order_committed_event))
+                if trace is not None:
+                    trace["stages"][stage] = now - trace["last_mark"]
+                    trace["last_mark"] = now
+
+    def discard(self, order_committed_events):
+        """Drop the traces of orders that were not settled by us"""
+        with self._lock:
+            for order_committed_event in order_committed_events:
+                self._traces.pop(get_order_key(order_committed_event), None)
+
+    def finish(self, order_committed_events, tx_receipt):
+        """End the traces of orders once their settlement receipt arrives"""
+        self.mark(order_committed_events, "inclusion")
+        now = time.time()
+
+        finished = []
+        with self._lock:
+            for order_committed_event in order_committed_events:
+                trace = self._traces.pop(get_order_key(order_committed_event), None)
+                if trace is not None:
+                    finished.append(trace)
+
+        for trace in finished:
+            trace.pop("last_mark")
+            market = self.snx.perps.markets_by_id.get(trace["market_id"], {})
+            trace["market_name"] = market.get("market_name", str(trace["market_id"]))
+            trace["tx_hash"] = self.snx.web3.to_hex(tx_receipt["transactionHash"])
+            trace["status"] = tx_receipt["status"]
+            trace["finished_at"] = now
+            if trace["committed_at"] is not None:
+                trace["stages"]["total"] = now - trace["committed_at"]
+            self._record(trace)
+
+    def _record(self, trace):
+        market_name = trace["market_name"]
+        with self._lock:
+            for stage, seconds in trace["stages"].items():
+                SETTLEMENT_STAGE_SECONDS.observe(
+                    seconds, market=market_name, stage=stage
+                )
+                key = (market_name, stage)
+                if key not in self._durations:
+                    self._durations[key] = deque(maxlen=self.history)
+                self._durations[key].append(seconds)
+
+            if self.trace_path is not None:
+                with open(self.trace_path, "a") as f:
+                    f.write(json.dumps(trace) + "\n")
+
+    def summarize(self):
+        """
+        Summarize the recent stage durations of each market.
+
+        :return: dict of ``{market_name: {stage: {"p50", "p99", "count"}}}``
+        :rtype: dict
+        """
+        summary = {}
+        with self._lock:
+            for (market_name, stage), durations in self._durations.items():
+                summary.setdefault(market_name, {})[stage] = {
+                    "p50": get_percentile(durations, 50),
+                    "p99": get_percentile(durations, 99),
+                    "count": len(durations),
+                }
+        return summary
+
+    def log_summary(self):
+        """Log the p50 and p99 of each stage, per market"""
+        for market_name, stages in sorted(self.summarize().items()):
+            stage_summaries = ", ".join(
+                f"{stage} p50={durations['p50']:.2f}s p99={durations['p99']:.2f}s"
+                for stage, durations in stages.items()
+            )
+            self.snx.logger.info(f"{market_name} settlement latency: {stage_summaries}")
@@ -0,0 +1,303 @@
+import time
+import threading
+from collections import deque
+from utils.metrics import TRANSACTIONS_SENT, TRANSACTIONS_REPLACED, record_receipt
+
+# replacement transactions must raise fees by at least 10%
+FEE_BUMP = 1.125
+
+# number of mined transactions to keep receipts for
+RECEIPT_HISTORY = 1000
+
+# gas limit of the self transfer filling a nonce whose transaction failed to send
+CANCEL_GAS = 21000
+
+
+def is_nonce_too_low(error):
+    """Check if a send failed because its nonce was already used on-chain"""
+    message = str(error).lower()
+    return "nonce too low" in message or "already been used" in message
+
+
+class TransactionPipeline:
+    """
+    Submits transactions with locally allocated nonces, without waiting for receipts.
+
+    Receipts are tracked by a background thread. Transactions still pending
+    after ``replace_after`` seconds are resent with the same nonce and bumped fees.
+    With a ``gas_pricer``, fees are set from the urgency given for each transaction.
+    If a nonce is used by a transaction sent elsewhere, waiting for it raises.
+
+    Transactions are signed and sent here rather than through the SDK, which
+    moves to a fresh nonce when one is too low and would resend a replacement
+    as a duplicate. Nonces are allocated under a lock, but sent outside of it,
+    so a slow rpc does not hold up other submissions.
+    """
+
+    def __init__(self, snx, replace_after=30, poll_interval=1, gas_pricer=None):
+        self.snx = snx
+        self.gas_pricer = gas_pricer
+        self.replace_after = replace_after
+        self.poll_interval = poll_interval
+
+        self._lock = threading.Lock()
+        self._nonce = snx.web3.eth.get_transaction_count(snx.address, "pending")
+        # pending transactions by nonce
+        self._pending = {}
+        # nonce of every hash sent, and receipts once mined
+        self._nonces = {}
+        self._receipts = {}
+        self._events = {}
+        self._completed = deque()
+
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+        self._thread.start()
+
+    def submit(self, tx_params, on_receipt=None, urgency=None):
+        """
+        Sign and send a transaction with the next local nonce.
+
+        :param tx_params: transaction params, any nonce is overwritten
+        :param on_receipt: optional callback called with the receipt once mined
+        :param urgency: gas pricing urgency profile, fees are left as built if None
+
+        :return: transaction hash
+        :rtype: str
+        """
+        if self.gas_pricer is not None and urgency is not None:
+            self.gas_pricer.apply(tx_params, urgency)
+        if "gas" not in tx_params:
+            tx_params["gas"] = self._estimate_gas(tx_params)
+
+        with self._lock:
+            nonce = self._nonce
+            self._nonce += 1
+            tx_params["nonce"] = nonce
+            pending_tx = {
+                "tx_params": tx_params,
+                "tx_hashes": [],
+                # not sent yet, so not replaced by the watcher
+                "sent_at": None,
+                "on_receipt": on_receipt,
+                "urgency": urgency,
+            }
+            self._pending[nonce] = pending_tx
+            self._events[nonce] = threading.Event()
+
+        try:
+            tx_hash = self._send(tx_params)
+        except Exception as e:
+            self._release(nonce, pending_tx, e)
+            raise
+
+        TRANSACTIONS_SENT.inc(urgency=urgency or "none")
+        with self._lock:
+            pending_tx["tx_hashes"].append(tx_hash)
+            pending_tx["sent_at"] = time.time()
+            self._nonces[tx_hash] = nonce
+        return tx_hash
+
+    def wait(self, tx_hash, timeout=300):
+        """Block until a submitted transaction, or its replacement, is mined"""
+        nonce = self._nonces[tx_hash]
+        if not self._events[nonce].wait(timeout):
+            raise TimeoutError(f"Transaction {tx_hash} was not mined in {timeout}s")
+        receipt = self._receipts[nonce]
+        if receipt is None:
+            raise RuntimeError(f"Nonce of transaction {tx_hash} was used by another")
+        return receipt
+
+    def pending_count(self):
+        """Get the number of transactions waiting to be mined"""
+        with self._lock:
+            return len(self._pending)
+
+    def _estimate_gas(self, tx_params):
+        if not self.snx.use_estimate_gas:
+            return 1500000
+        return int(self.snx.web3.eth.estimate_gas(tx_params) * self.snx.gas_multiplier)
+
+    def _send(self, tx_params):
+        """Sign and send a transaction as is, without touching its nonce"""
+        web3 = self.snx.web3
+        if tx_params["from"] in self.snx.rpc_signers:
+            tx_hash = web3.eth.send_transaction(tx_params)
+        else:
+            signed_tx = web3.eth.account.sign_transaction(
+                tx_params, private_key=self.snx.private_key
+            )
+            tx_hash = web3.eth.send_raw_transaction(signed_tx.rawTransaction)
+        return web3.to_hex(tx_hash)
+
+    def _release(self, nonce, pending_tx, error):
+        """Give up the nonce of a transaction that failed to send"""
+        with self._lock:
+            if is_nonce_too_low(error):
+                # something else used our nonce, resync with the chain
+                self._pending.pop(nonce, None)
+                self._resync_nonce()
+                return
+            if self._nonce == nonce + 1:
+                # no later nonce was handed out, reuse this one
+                self._pending.pop(nonce, None)
+                self._nonce = nonce
+                return
+
+        # later transactions wait for this nonce, fill it with a self transfer
+        tx_params = pending_tx["tx_params"]
+        cancel_params = {
+            key: tx_params[key]
+            for key in [
+                "from",
+                "chainId",
+                "nonce",
+                "maxFeePerGas",
+                "maxPriorityFeePerGas",
+                "gasPrice",
+            ]
+            if key in tx_params
+        }
+        cancel_params.update({"to": tx_params["from"], "value": 0, "gas": CANCEL_GAS})
+        try:
+            tx_hash = self._send(cancel_params)
+        except Exception as e:
+            self.snx.logger.error(f"Error filling nonce {nonce}: {e}")
+            tx_hash = None
+
+        with self._lock:
+            pending_tx["tx_params"] = cancel_params
+            pending_tx["on_receipt"] = None
+            # if the fill failed to send, the watcher sends it again later
+            pending_tx["sent_at"] = time.time()
+            if tx_hash is not None:
+                pending_tx["tx_hashes"].append(tx_hash)
+                self._nonces[tx_hash] = nonce
+
+    def _resync_nonce(self):
+        chain_nonce = self.snx.web3.eth.get_transaction_count(
+            self.snx.address, "pending"
+        )
+        self._nonce = max(chain_nonce, max(self._pending.keys(), default=-1) + 1)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self._poll()
+
+    def _poll(self):
+        with self._lock:
+            pending = list(self._pending.items())
+        if len(pending) == 0:
+            return
+
+        try:
+            # nonces below the mined nonce are used, by our transactions or others
+            mined_nonce = self.snx.web3.eth.get_transaction_count(
+                self.snx.address, "latest"
+            )
+        except Exception as e:
+            self.snx.logger.error(f"Error fetching the mined nonce: {e}")
+            mined_nonce = None
+
+        for nonce, pending_tx in pending:
+            try:
+                self._check_pending(nonce, pending_tx, mined_nonce)
+            except Exception as e:
+                self.snx.logger.error(f"Error tracking transaction {nonce}: {e}")
+
+    def _check_pending(self, nonce, pending_tx, mined_nonce=None):
+        for tx_hash in pending_tx["tx_hashes"]:
+            receipt = self._get_receipt(tx_hash)
+            if receipt is not None:
+                self._complete(nonce, pending_tx, receipt)
+                return
+
+        sent_at = pending_tx["sent_at"]
+        if sent_at is not None and mined_nonce is not None and nonce < mined_nonce:
+            # the mined nonce was read before the receipts, so none of the
+            # transactions sent for this nonce were mined
+            self.snx.logger.warning(
+                f"Nonce {nonce} was used by a transaction sent elsewhere"
+            )
+            self._complete(nonce, pending_tx, None)
+            return
+
+        if sent_at is not None and time.time() - sent_at > self.replace_after:
+            self._replace(nonce, pending_tx)
+
+    def _get_receipt(self, tx_hash):
+        try:
+            return self.snx.web3.eth.get_transaction_receipt(tx_hash)
+        except Exception:
+            # web3 raises if the transaction is not mined yet
+            return None
+
+    def _complete(self, nonce, pending_tx, receipt):
+        with self._lock:
+            self._pending.pop(nonce, None)
+            self._receipts[nonce] = receipt
+            self._events[nonce].set()
+            self._prune(nonce, pending_tx["tx_hashes"])
+        if receipt is None:
+            return
+
+        record_receipt(receipt, pending_tx["urgency"])
+        if receipt["status"] != 1:
+            self.snx.logger.error(f"Transaction {receipt['transactionHash']} reverted")
+        if pending_tx["on_receipt"] is not None:
+            pending_tx["on_receipt"](receipt)
+
+    def _prune(self, nonce, tx_hashes):
+        """Forget the oldest mined transactions"""
+        self._completed.append((nonce, tx_hashes))
+        while len(self._completed) > RECEIPT_HISTORY:
+            old_nonce, old_hashes = self._completed.popleft()
+            self._receipts.pop(old_nonce, None)
+            self._events.pop(old_nonce, None)
+            for old_hash in old_hashes:
+                self._nonces.pop(old_hash, None)
+
+    def _replace(self, nonce, pending_tx):
+        """Resend a stuck transaction with the same nonce and higher fees"""
+        tx_params = dict(pending_tx["tx_params"])
+        if self.gas_pricer is not None and "maxFeePerGas" in tx_params:
+            tx_params.update(
+                self.gas_pricer.get_replacement_fees(tx_params, pending_tx["urgency"])
+            )
+        else:
+            for fee_key in ["maxFeePerGas", "maxPriorityFeePerGas", "gasPrice"]:
+                if fee_key in tx_params:
+                    tx_params[fee_key] = int(tx_params[fee_key] * FEE_BUMP)
+
+        try:
+            tx_hash = self._send(tx_params)
+        except Exception as e:
+            if not is_nonce_too_low(e):
+                self.snx.logger.error(f"Error replacing transaction {nonce}: {e}")
+            # if the original was mined its receipt is picked up on the next
+            # poll, otherwise retry after a delay with fees bumped from these
+            with self._lock:
+                pending_tx["tx_params"] = tx_params
+                pending_tx["sent_at"] = time.time()
+            return
+
+        self.snx.logger.info(f"Replaced stuck transaction {nonce} with {tx_hash}")
+        TRANSACTIONS_REPLACED.inc(urgency=pending_tx["urgency"] or "none")
+        with self._lock:
+            pending_tx["tx_params"] = tx_params
+            pending_tx["tx_hashes"].append(tx_hash)
+            pending_tx["sent_at"] = time.time()
+            self._nonces[tx_hash] = nonce
+
+
+def send_transaction(snx, tx_params, pipeline=None, urgency=None):
+    """Send a transaction and wait for its receipt"""
+    if pipeline is None:
+        tx_hash = snx.execute_transaction(tx_params)
+        TRANSACTIONS_SENT.inc(urgency=urgency or "none")
+        tx_receipt = snx.wait(tx_hash)
+        record_receipt(tx_receipt, urgency)
+        return tx_receipt
+
+    tx_hash = pipeline.submit(tx_params, urgency=urgency)
+    return pipeline.wait(tx_hash)